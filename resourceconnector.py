@@ -13,14 +13,17 @@
 #
 ###############################################################################
 
-from flask import Flask, jsonify, request
+from flask import Flask, abort, jsonify, make_response, request
 from optparse import OptionParser
+from collections import OrderedDict
 
 import threading
 import subprocess
+import hashlib
 import json
 import time
 import signal
+import sys
 import os
 
 WRAPPER_NAME = 'resourceconnector'
@@ -33,6 +36,12 @@ SCRIPT1 = 'bbic_stack'
 SCRIPT2 = 'brain_region_filtering'
 
 
+'''---------- TILE SERVER ----------'''
+BBIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services', 'bbic_stack')
+MAX_OPEN_FILES = 16  # BBIC files kept open by the tile server
+TILE_MAX_AGE = 3600  # Seconds tiles may be cached by clients before revalidation
+
+
 '''---------- GLOBALS ----------'''
 resource_process = None
 resource_process_pid = None
@@ -45,6 +54,7 @@ resource_stderr = 'STDERR:\n'
 message = 'Task starting...'
 script_command = 'Command empty!'
 progress = 0
+tile_root = None  # Directory of the BBIC files served as tiles, None to disable the tile route
 
 
 '''---------- API ROUTE DEFINITIONS ----------'''
@@ -62,7 +72,8 @@ def registry():
            description: Returns a list of options to be called on the API
            examples: "resourceconnector/v1/status": ["GET"]
     """
-    return jsonify({"resourceconnector/v1/status": ["GET"]})
+    return jsonify({"resourceconnector/v1/status": ["GET"],
+                    "resourceconnector/v1/tiles/<file>/<stack>/<level>/<slice>/<u>/<v>": ["GET"]})
 
 
 @app.route('/'+WRAPPER_NAME+'/v1/status')
@@ -226,6 +237,92 @@ def exit():
     return jsonify({'exit': not script_runs})
 
 
+class TileFilePool:
+    """Read-only BBIC files opened once and shared by the requests of all
+    threads, the least recently used ones being closed beyond max_files.
+
+    Files still being written in SWMR mode (bbic_stack.py --swmr) are opened
+    in SWMR mode and kept open while they change, see Stack.refresh()."""
+
+    def __init__(self, max_files=MAX_OPEN_FILES):
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # path -> (modification time or None for SWMR, bbic.File)
+
+    def get_file(self, path):
+        """Get the open file of a path, reopened if it has been modified
+        (unless it is read in SWMR mode)"""
+        if BBIC_PATH not in sys.path:
+            sys.path.append(BBIC_PATH)
+        import bbic
+
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._files.pop(path, None)
+            if entry is None or entry[0] not in (None, mtime):
+                try:
+                    entry = (mtime, bbic.File(path, 'r'))
+                except OSError:
+                    # Already open for write by a SWMR writer
+                    entry = (None, bbic.File(path, 'r', swmr=True))
+            self._files[path] = entry
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+            return entry[1]
+
+
+tile_files = TileFilePool()
+
+
+def get_tile_mimetype(stack):
+    """Get the MIME type of the tiles of a stack, raw codecs have none"""
+    if stack.format.startswith('RAW'):
+        return 'application/octet-stream'
+    return 'image/' + stack.format.lower()
+
+
+@app.route('/'+WRAPPER_NAME+'/v1/tiles/<path:filename>/<int:stack_index>/<int:level>/<int:slice_index>/<int:u>/<int:v>')
+def tile(filename, stack_index, level, slice_index, u, v):
+    """Endpoint serving the tiles of the BBIC stacks under the tile root, as stored.
+       ---
+       responses:
+         200:
+           description: Returns the encoded tile, with a strong ETag of its content
+           examples: resourceconnector/v1/tiles/output.h5/2/0/10/3/4
+         304:
+           description: The tile matches the ETag given in If-None-Match
+         404:
+           description: The file, stack, level or tile does not exist, or the tile route is disabled
+    """
+    if tile_root is None:
+        abort(404)
+    root = os.path.realpath(tile_root)
+    path = os.path.realpath(os.path.join(root, filename))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        abort(404)
+
+    try:
+        # The file stays open for this request even if the pool closes it
+        bbic_file = tile_files.get_file(path)
+        stack = bbic_file.get_stack(stack_index)
+        level = stack.get_level(level) if stack is not None else None
+        # Only the slices completed by a SWMR writer are served
+        num_slices = min(level.num_slices, stack.refresh()) if level is not None else 0
+        if level is None or not (0 <= slice_index < num_slices and
+                                 0 <= u < level.num_x_tiles and 0 <= v < level.num_y_tiles):
+            abort(404)
+        data = level.get_tile_data(u, v, slice_index).tobytes()
+    except (KeyError, OSError, ValueError):
+        abort(404)
+
+    response = make_response(data)
+    response.mimetype = get_tile_mimetype(stack)
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response.make_conditional(request)
+
+
 '''---------- OPTION PARSER ----------'''
 def vararg_callback(option, opt_str, value, parser):
     """ Option taking a variable number of arguments.
@@ -277,6 +374,10 @@ def parse_options():
                       help="Define which host the wrapper service should be run on",
                       action="store", type='string')
 
+    parser.add_option("-r", "--tile-root", dest="tile_root",
+                      help="Define the directory of the BBIC files served by the tile route, which is disabled otherwise",
+                      action="store", type='string')
+
     parser.add_option("-d", "--debug", dest="debug",
                       help="Choose to run the wrapper in debug mode",
                       action="store_true")
@@ -359,6 +460,7 @@ def run_flask(debug=False):
 if __name__ == "__main__":
     options, args = parse_options()
     script_command = options.script_multiarg
+    tile_root = options.tile_root
 
     script_thread = threading.Thread(name='Resource-Script-Thread', target=launch_script, args=script_command)
     script_thread.start()
@@ -4,14 +4,29 @@
 # Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
 # Do not distribute without further notice.
 
-__all__ = ["file", "volume", "stack", "image_stack", "image_utils", "slice_to_blocks"]
+__all__ = ["file", "volume", "stack", "image_stack", "image_utils", "slice_to_blocks", "pyramid", "codecs", "journal", "memmap_stack", "container_stack", "buffer_pool", "planner", "instrumentation", "profiling", "tracing", "level_scratch", "scheduler", "reslice_workers", "reader_processes", "tile_cache", "level_array", "image_export"]
 
 from .file import File
 from .stack import *
 from .volume import *
 from .image_stack import ImageStack
+from .memmap_stack import RawStack, TiffStack
+from .container_stack import MultiPageTiffStack, H5VolumeStack
 from .image_utils import *
 from .data_block import DataBlock
 from .block_provider import BlockProvider
 from .image_provider import ImageProvider
-from .slice_to_blocks import SliceToBlocks
\ No newline at end of file
+from .slice_to_blocks import SliceToBlocks
+from .pyramid import Pyramid
+from .buffer_pool import BufferPool, get_buffer_pool
+from .planner import WritePlan
+from .instrumentation import Instrumentation, get_instrumentation
+from .profiling import Profiler
+from .tracing import Tracer, get_tracer
+from .level_scratch import LevelScratch
+from .scheduler import BlockScheduler
+from .reslice_workers import ResliceWorkers
+from .tile_cache import TileCache
+from .level_array import LevelArray
+from .image_export import ImageWriter
+from .codecs import Codec, get_codec, get_codec_names, register_codec, benchmark_codec
@@ -0,0 +1,124 @@
+# BBIC buffer pool
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import threading
+import numpy as np
+
+MIN_BUFFER_SIZE = 4096
+
+# Unused buffers kept by the default pool, so that the buffers of finished
+# stages do not stay resident for the rest of the run
+DEFAULT_MAX_FREE_BYTES = 512 * 1024 * 1024
+
+# Larger buffers (e.g. the slabs of a fused write) are freed when released
+DEFAULT_MAX_POOLED_BYTES = 256 * 1024 * 1024
+
+
+def _get_size_class(num_bytes):
+    """Get the buffer size used for a request, the next power of two"""
+    size = MIN_BUFFER_SIZE
+    while size < num_bytes:
+        size <<= 1
+    return size
+
+
+class BufferPool:
+    """Thread-safe pool of reusable buffers, grouped in power-of-two size
+    classes so that blocks and slices of similar sizes share them.
+
+    Buffers that are not released are simply garbage collected, the pool
+    keeps no reference to the buffers in use."""
+
+    def __init__(self, max_free_bytes=None, max_pooled_bytes=None):
+        """The pool keeps at most *max_free_bytes* of unused buffers, and
+        none larger than *max_pooled_bytes*"""
+        self.max_free_bytes = max_free_bytes
+        self.max_pooled_bytes = max_pooled_bytes
+        self._lock = threading.Lock()
+        self._free = {}  # size class -> list of flat uint8 buffers
+        self.free_bytes = 0
+        self.in_use_bytes = 0
+        self.peak_in_use_bytes = 0
+        self.allocated_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __str__(self):
+        return "BufferPool peak in use: %.1f MB, allocated: %.1f MB, free: %.1f MB, " \
+               "hits: %d, misses: %d" % (self.peak_in_use_bytes / 1e6, self.allocated_bytes / 1e6,
+                                         self.free_bytes / 1e6, self.num_hits, self.num_misses)
+
+    def acquire(self, shape, dtype=np.uint8, fill_value=None):
+        """Get an array of the given shape, optionally filled with a value.
+        Its content is undefined otherwise."""
+        dtype = np.dtype(dtype)
+        num_bytes = int(np.prod(shape)) * dtype.itemsize
+        size = _get_size_class(num_bytes)
+        with self._lock:
+            buffers = self._free.get(size)
+            if buffers:
+                buffer = buffers.pop()
+                self.free_bytes -= size
+                self.num_hits += 1
+            else:
+                buffer = None
+                self.num_misses += 1
+            self.in_use_bytes += size
+            self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+        if buffer is None:
+            buffer = np.empty(size, dtype=np.uint8)
+            with self._lock:
+                self.allocated_bytes += size
+
+        array = buffer[:num_bytes].view(dtype).reshape(shape)
+        if fill_value is not None:
+            array.fill(fill_value)
+        return array
+
+    def release(self, array):
+        """Give back an array obtained from acquire(). It must not be used
+        afterwards."""
+        buffer = array if array.base is None else array.base
+        if not isinstance(buffer, np.ndarray) or buffer.ndim != 1 or \
+                buffer.dtype != np.uint8 or buffer.size != _get_size_class(buffer.size):
+            raise ValueError("Array not allocated by the buffer pool")
+        size = buffer.size
+        with self._lock:
+            buffers = self._free.setdefault(size, [])
+            if any(b is buffer for b in buffers):
+                raise ValueError("Buffer released twice")
+            self.in_use_bytes -= size
+            if (self.max_free_bytes is not None and self.free_bytes + size > self.max_free_bytes) or \
+                    (self.max_pooled_bytes is not None and size > self.max_pooled_bytes):
+                self.allocated_bytes -= size
+                return
+            buffers.append(buffer)
+            self.free_bytes += size
+
+    def clear(self):
+        """Drop all the unused buffers"""
+        with self._lock:
+            self.allocated_bytes -= self.free_bytes
+            self.free_bytes = 0
+            self._free = {}
+
+    def get_stats(self):
+        """Get the usage statistics of the pool as a dictionary"""
+        with self._lock:
+            return {'in_use_bytes': self.in_use_bytes,
+                    'peak_in_use_bytes': self.peak_in_use_bytes,
+                    'allocated_bytes': self.allocated_bytes,
+                    'free_bytes': self.free_bytes,
+                    'hits': self.num_hits,
+                    'misses': self.num_misses}
+
+
+_default_pool = BufferPool(DEFAULT_MAX_FREE_BYTES, DEFAULT_MAX_POOLED_BYTES)
+
+
+def get_buffer_pool():
+    """Get the buffer pool shared by the whole process"""
+    return _default_pool
@@ -0,0 +1,180 @@
+# BBIC tile codecs
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import struct
+import time
+import zlib
+from io import BytesIO
+from PIL import Image, features
+import numpy as np
+try:
+    import lz4.block
+    LZ4_ENABLED = True
+except ImportError:
+    LZ4_ENABLED = False
+
+_RAW_HEADER = struct.Struct('<II')
+
+
+class Codec:
+    """Abstract class for tile codecs, encoding 2D uint8 arrays"""
+
+    name = None
+
+    def encode(self, data):
+        """Encode a (height, width) uint8 array into a uint8 byte array"""
+        raise NotImplementedError
+
+    def decode(self, data):
+        """Decode a byte array into a (height, width) uint8 array"""
+        raise NotImplementedError
+
+    def decode_image(self, data):
+        """Decode a byte array into a PIL Image"""
+        return Image.fromarray(self.decode(data))
+
+
+class PILCodec(Codec):
+    """Codec for the image formats supported by PIL"""
+
+    def __init__(self, name, **save_options):
+        self.name = name
+        self.save_options = save_options
+
+    def encode(self, data):
+        bytes_buffer = BytesIO()
+        Image.fromarray(data).save(bytes_buffer, self.name, **self.save_options)
+        # Share the memory of the buffer instead of copying it
+        array = np.frombuffer(bytes_buffer.getbuffer(), dtype=np.uint8)
+        if len(array) == 0:
+            raise Exception('zero-length image')
+        return array
+
+    def decode(self, data):
+        return np.asarray(self.decode_image(data))
+
+    def decode_image(self, data):
+        im = Image.open(BytesIO(data))
+        # Some formats (e.g. lossy WebP) have no grayscale mode
+        if im.mode != 'L':
+            im = im.convert('L')
+        return im
+
+
+class JPEGCodec(PILCodec):
+    """JPEG codec with configurable quality and chroma subsampling"""
+
+    def __init__(self, quality=75, subsampling=None, optimize=False):
+        options = {'quality': quality, 'optimize': optimize}
+        # Only meaningful for color tiles, grayscale JPEG has no chroma
+        if subsampling is not None:
+            options['subsampling'] = subsampling
+        PILCodec.__init__(self, 'JPEG', **options)
+
+
+class WebPCodec(PILCodec):
+    """WebP codec, lossy or lossless"""
+
+    def __init__(self, quality=80, lossless=False, method=4):
+        PILCodec.__init__(self, 'WEBP', quality=quality, lossless=lossless, method=method)
+
+
+class RawCodec(Codec):
+    """Lossless codec storing the raw pixels behind a (width, height) header,
+    compressed with a generic byte compressor"""
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+
+    def encode(self, data):
+        height, width = data.shape
+        payload = self._compress(np.ascontiguousarray(data).data)
+        array = np.empty(_RAW_HEADER.size + len(payload), dtype=np.uint8)
+        _RAW_HEADER.pack_into(array, 0, width, height)
+        array[_RAW_HEADER.size:] = np.frombuffer(payload, dtype=np.uint8)
+        return array
+
+    def decode(self, data):
+        data = np.asarray(data, dtype=np.uint8)
+        width, height = _RAW_HEADER.unpack_from(data, 0)
+        raw = self._decompress(data[_RAW_HEADER.size:], width * height)
+        return np.frombuffer(raw, dtype=np.uint8).reshape((height, width))
+
+
+def _zlib_codec(level=1):
+    return RawCodec('RAW-ZLIB', lambda raw: zlib.compress(raw, level),
+                    lambda payload, size: zlib.decompress(payload, bufsize=size))
+
+
+def _lz4_codec(acceleration=1):
+    return RawCodec('RAW-LZ4', lambda raw: lz4.block.compress(raw, store_size=False,
+                                                              acceleration=acceleration),
+                    lambda payload, size: lz4.block.decompress(payload, uncompressed_size=size))
+
+
+_codecs = {}
+
+
+def register_codec(name, factory):
+    """Register a codec factory under a format name (as in the 'type'
+    attribute of the stacks, without the 'image/' prefix)"""
+    _codecs[name.upper()] = factory
+
+
+def get_codec_names():
+    """Get the names of all the available codecs"""
+    return sorted(_codecs.keys())
+
+
+def get_codec(format_, **options):
+    """Get a codec by its format name, configured with the given options"""
+    if isinstance(format_, Codec):
+        return format_
+    name = format_.upper()
+    if name not in _codecs:
+        raise ValueError("Unsupported tile format: %s" % format_)
+    try:
+        return _codecs[name](**options)
+    except TypeError:
+        raise ValueError("Invalid options for the %s codec: %s" % (name, options))
+
+
+register_codec('PNG', lambda compress_level=6: PILCodec('PNG', compress_level=compress_level))
+register_codec('JPEG', JPEGCodec)
+register_codec('TIFF', lambda: PILCodec('TIFF'))
+if features.check('webp'):
+    register_codec('WEBP', WebPCodec)
+register_codec('RAW-ZLIB', _zlib_codec)
+if LZ4_ENABLED:
+    register_codec('RAW-LZ4', _lz4_codec)
+
+
+def benchmark_codec(codec, tiles, repeat=1):
+    """Measure the encoding and decoding speeds (MB/s of raw pixels) and the
+    compression ratio of a codec on a list of 2D uint8 arrays"""
+    assert isinstance(codec, Codec)
+    assert isinstance(repeat, int)
+
+    raw_size = sum(tile.size for tile in tiles) * repeat
+    encoded = []
+    start = time.time()
+    for _ in range(repeat):
+        encoded = [codec.encode(tile) for tile in tiles]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for _ in range(repeat):
+        for data in encoded:
+            codec.decode(data)
+    decode_time = time.time() - start
+
+    encoded_size = sum(len(data) for data in encoded) * repeat
+    return {'codec': codec.name,
+            'encode_mbps': raw_size / (1000*1000) / max(encode_time, 1e-9),
+            'decode_mbps': raw_size / (1000*1000) / max(decode_time, 1e-9),
+            'ratio': float(raw_size) / max(encoded_size, 1)}
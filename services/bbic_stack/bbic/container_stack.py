@@ -0,0 +1,187 @@
+# BBIC single-container image stack readers
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import h5py
+from PIL import Image
+import numpy as np
+from .image_provider import ImageProvider
+from .image_utils import pad_array, pad_borders
+from .instrumentation import get_instrumentation
+from .memmap_stack import get_tiff_strips, get_contiguous_offset, copy_tiff_strips
+
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+
+class ContainerStack(ImageProvider):
+    """Abstract class for stacks of slices read from a single file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.num_slices = 0
+        self.width = 0
+        self.height = 0
+        self._padding_buffer = None
+
+    def __str__(self):
+        return "%s %s [%d, %d, %d]" % (type(self).__name__, self.filename, self.width,
+                                       self.height, self.num_slices)
+
+    def _get_padding_buffer(self):
+        """Get the buffer receiving the padded slices"""
+        if self._padding_buffer is None or self._padding_buffer.shape != (self.height, self.width):
+            self._padding_buffer = np.empty((self.height, self.width), dtype=np.uint8)
+        return self._padding_buffer
+
+    def _pad(self, data, padding_value):
+        """Pad an array to the stack dimensions, into a reused buffer"""
+        if data.shape == (self.height, self.width):
+            return data
+        with get_instrumentation().timer('pad'):
+            return pad_array(data, self._get_padding_buffer(), padding_value)
+
+    def get_dimensions(self):
+        """Get the dimensions of the stack"""
+        return self.width, self.height, self.num_slices
+
+    def get_image(self, index, padding_value=0):
+        """Get a slice, padded to the stack dimensions"""
+        return Image.fromarray(np.array(self.get_array(index, padding_value)))
+
+    def close(self):
+        """Close the file handles"""
+        pass
+
+
+class MultiPageTiffStack(ContainerStack):
+    """Stack of the pages of a multi-page TIFF file, kept open while reading.
+
+    Uncompressed 8-bit grayscale pages are memory-mapped, others decoded by
+    PIL. The pages following the last one read (with the same stride, as MPI
+    processes read every mpi_size-th slice) are prefetched by the kernel."""
+
+    def __init__(self, filename, readahead=2):
+        assert isinstance(readahead, int)
+        ContainerStack.__init__(self, filename)
+        self.readahead = readahead
+        self._file = open(filename, 'rb')
+        self._image = Image.open(self._file)
+        self._data = np.memmap(self._file, np.uint8, 'r')
+        self._last_index = None
+        self.num_slices = getattr(self._image, 'n_frames', 1)
+        # Reading all the page headers is cheap compared to decoding them
+        for index in range(self.num_slices):
+            self._image.seek(index)
+            self.width = max(self.width, self._image.size[0])
+            self.height = max(self.height, self._image.size[1])
+
+    def _prefetch(self, index):
+        """Ask the kernel to read the strips of a page in the background"""
+        if not hasattr(os, 'posix_fadvise') or not 0 <= index < self.num_slices:
+            return
+        self._image.seek(index)
+        tags = self._image.tag_v2
+        if STRIP_OFFSETS in tags:
+            offsets, byte_counts = tags[STRIP_OFFSETS], tags.get(STRIP_BYTE_COUNTS)
+        else:
+            offsets, byte_counts = tags.get(TILE_OFFSETS), tags.get(TILE_BYTE_COUNTS)
+        if not offsets or not byte_counts:
+            return
+        start = min(offsets)
+        end = max(offset + count for offset, count in zip(offsets, byte_counts))
+        os.posix_fadvise(self._file.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+
+    def get_array(self, index, padding_value=0):
+        """Get a page as an array, padded to the stack dimensions. The array
+        may be a view of the file or a buffer reused by the next call."""
+        assert isinstance(index, int)
+        if not 0 <= index < self.num_slices:
+            raise IndexError("Slice %d out of range" % index)
+
+        im = self._image
+        im.seek(index)
+        size = im.size
+        strips = get_tiff_strips(im)
+        if strips is None:
+            with get_instrumentation().timer('decode'):
+                page = np.asarray(im if im.mode == 'L' else im.convert('L'))
+            data = self._pad(page, padding_value)
+        else:
+            offset = get_contiguous_offset(size, strips)
+            if offset is not None:
+                width, height = size
+                data = self._pad(self._data[offset:offset + width * height].reshape((height, width)),
+                                 padding_value)
+            elif size[0] > self.width or size[1] > self.height:
+                # Cropped like the images decoded by PIL
+                page = copy_tiff_strips(self._data, strips,
+                                        np.empty((size[1], size[0]), dtype=np.uint8))
+                data = self._pad(page, padding_value)
+            else:
+                copy_tiff_strips(self._data, strips, pad_borders(self._get_padding_buffer(),
+                                                                 size[0], size[1], padding_value))
+                data = self._padding_buffer
+
+        stride = index - self._last_index if self._last_index is not None else 1
+        if stride > 0:
+            for i in range(1, self.readahead + 1):
+                self._prefetch(index + i * stride)
+        self._last_index = index
+        return data
+
+    def close(self):
+        """Close the file handles"""
+        self._image.close()
+        self._file.close()
+
+
+class H5VolumeStack(ContainerStack):
+    """Stack of the planes of a 3D (z, y, x) uint8 dataset of an HDF5 file,
+    kept open while reading"""
+
+    def __init__(self, filename, dataset_path):
+        ContainerStack.__init__(self, filename)
+        self.dataset_path = dataset_path
+        self._file = h5py.File(filename, 'r')
+        dataset = self._file[dataset_path]
+        if dataset.ndim != 3 or dataset.dtype != np.uint8:
+            raise ValueError("%s:%s is not a 3D uint8 dataset" % (filename, dataset_path))
+        if dataset.chunks is not None:
+            # Keep a full plane of chunks in the chunk cache, so that every
+            # chunk is read once when reading the slices in order
+            plane_chunks = -(-dataset.shape[1] // dataset.chunks[1]) * \
+                -(-dataset.shape[2] // dataset.chunks[2])
+            cache_size = plane_chunks * int(np.prod(dataset.chunks))
+            self._file.close()
+            self._file = h5py.File(filename, 'r', rdcc_nbytes=max(cache_size, 1024*1024),
+                                   rdcc_nslots=max(plane_chunks * 10, 521))
+            dataset = self._file[dataset_path]
+        self.dataset = dataset
+        self.num_slices, self.height, self.width = (int(x) for x in dataset.shape)
+        self._slice_buffer = np.empty((self.height, self.width), dtype=np.uint8)
+
+    def __str__(self):
+        return "H5VolumeStack %s:%s [%d, %d, %d]" % (self.filename, self.dataset_path,
+                                                     self.width, self.height,
+                                                     self.num_slices)
+
+    def get_array(self, index, padding_value=0):
+        """Get a plane as an array, padded to the stack dimensions, in a
+        buffer reused by the next call"""
+        assert isinstance(index, int)
+        shape = self.dataset.shape[1:]
+        if self._slice_buffer.shape != shape:
+            self._slice_buffer = np.empty(shape, dtype=np.uint8)
+        with get_instrumentation().timer('decode'):
+            self.dataset.read_direct(self._slice_buffer, np.s_[index])
+        return self._pad(self._slice_buffer, padding_value)
+
+    def close(self):
+        """Close the file handle"""
+        self._file.close()
@@ -6,11 +6,18 @@
 # Do not distribute without further notice.
 
 import math
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from .image_utils import compress_and_serialize
+from .codecs import get_codec
+from .buffer_pool import get_buffer_pool
+from .instrumentation import get_instrumentation
 from .block_provider import BlockProvider
 
+_instrumentation = get_instrumentation()
+
+# Threads encoding the tiles of a block, the codecs release the GIL
+ENCODE_THREADS = 4
+
 
 class DataBlock:
     """A block of a volume or image stack"""
@@ -29,29 +36,47 @@ class DataBlock:
         self.depth = 0
         self.nominal_size = nominal_size
         self.volume = None
+        self._pooled = False
 
     def allocate(self, width, height, depth):
-        """Allocate memory for the block"""
+        """Allocate memory for the block, from the buffer pool"""
         assert isinstance(width, int)
         assert isinstance(height, int)
         assert isinstance(depth, int)
 
-        self.volume = np.empty([depth, height, width], dtype=np.uint8)
+        self.release()
+        self.volume = get_buffer_pool().acquire((depth, height, width))
+        self._pooled = True
         self.width, self.height, self.depth = width, height, depth
 
     def allocateAndSet(self, width, height, depth, value):
-        """Allocate memory for the block"""
+        """Allocate memory for the block, from the buffer pool, and fill it
+        with a value"""
         assert isinstance(width, int)
         assert isinstance(height, int)
         assert isinstance(depth, int)
         assert isinstance(value, int)
 
-        if value is 0:
-            self.volume = np.zeros([depth, height, width], dtype=np.uint8)
-        else:
-            self.volume = np.full([depth, height, width], value,dtype=np.uint8)
+        self.release()
+        self.volume = get_buffer_pool().acquire((depth, height, width), fill_value=value)
+        self._pooled = True
         self.width, self.height, self.depth = width, height, depth
 
+    def wrap(self, volume):
+        """Use a (depth, height, width) uint8 array as the block data, without
+        copy"""
+        self.release()
+        self.volume = volume
+        self.depth, self.height, self.width = (int(x) for x in volume.shape)
+
+    def release(self):
+        """Give the memory of the block back to the buffer pool, the block is
+        invalid afterwards. Blocks read from a file are only dereferenced."""
+        if self._pooled:
+            get_buffer_pool().release(self.volume)
+            self._pooled = False
+        self.volume = None
+
     def __str__(self):
         return "Block (%d, %d, %d), dim: [%d, %d, %d]" %\
                (self.u, self.v, self.z, self.width, self.height, self.depth)
@@ -60,42 +85,56 @@ class DataBlock:
         """Does this block hold volume data"""
         return self.volume is not None
 
-    def to_x_tiles(self, format_, source):
-        """Export the block in tiles (compressed using *format_*)
-        along the x axis"""
-        x_tiles = []
-        for x in range(0, self.width):
-            from PIL import ImageOps
-            if source == 0:  # source is X
-                im = Image.fromarray(self.volume[:, :, x],mode='L').rotate(-90)
-                im = ImageOps.mirror(im)
-            elif source == 1:  # source is Y
-                im = Image.fromarray(self.volume[:, :, x], mode='L')
-            else:  # source is Z
-                im = Image.fromarray(self.volume[:, :, x], mode='L').rotate(-90)
-
-            tile = compress_and_serialize(im, format_)
-            x_tiles.append(tile)
-        return x_tiles
-
-    def to_y_tiles(self, format_, source):
-        """Export the block in tiles (compressed using *format_*)
-        along the y axis"""
-        y_tiles = []
-        for y in range(0, self.height):
-            from PIL import ImageOps
-            if source == 0:  # source is X
-                im = Image.fromarray(self.volume[:, y, :], mode='L').rotate(90)
-                im = ImageOps.flip(im)
-            elif source == 1:  # source is Y
-                im = Image.fromarray(self.volume[:, y, :], mode='L')
-            else:  # source is Z
-                im = Image.fromarray(self.volume[:, y, :], mode='L')
-                im = ImageOps.flip(im)
-
-            tile = compress_and_serialize(im, format_)
-            y_tiles.append(tile)
-        return y_tiles
+    def get_x_slices(self, source):
+        """Get a (width, rows, columns) view of the block, oriented as the x
+        tiles of the projection of the given source axis"""
+        if source == 0:  # source is X
+            return self.volume.transpose(2, 1, 0)
+        elif source == 1:  # source is Y
+            return self.volume.transpose(2, 0, 1)
+        else:  # source is Z
+            return self.volume[::-1].transpose(2, 1, 0)
+
+    def get_y_slices(self, source):
+        """Get a (height, rows, columns) view of the block, oriented as the y
+        tiles of the projection of the given source axis"""
+        if source == 0:  # source is X
+            return self.volume.transpose(1, 2, 0)
+        elif source == 1:  # source is Y
+            return self.volume.transpose(1, 0, 2)
+        else:  # source is Z
+            return self.volume[::-1].transpose(1, 0, 2)
+
+    @staticmethod
+    def _encode_slices(codec, slices, num_threads):
+        """Copy oriented slices into a contiguous buffer and encode them in
+        parallel"""
+        pool = get_buffer_pool()
+        with _instrumentation.timer('block_transpose'):
+            data = pool.acquire(slices.shape)
+            np.copyto(data, slices)
+
+        def encode(index):
+            with _instrumentation.timer('encode'):
+                return codec.encode(data[index])
+
+        try:
+            if num_threads <= 1 or len(data) <= 1:
+                return [encode(i) for i in range(len(data))]
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                return list(executor.map(encode, range(len(data))))
+        finally:
+            pool.release(data)
+
+    def to_x_tiles(self, codec, source, num_threads=ENCODE_THREADS):
+        """Export the block in tiles (compressed using *codec*, a Codec or a
+        format name) along the x axis"""
+        return self._encode_slices(get_codec(codec), self.get_x_slices(source), num_threads)
+
+    def to_y_tiles(self, codec, source, num_threads=ENCODE_THREADS):
+        """Export the block in tiles (compressed using *codec*, a Codec or a
+        format name) along the y axis"""
+        return self._encode_slices(get_codec(codec), self.get_y_slices(source), num_threads)
 
     def get_subblock_count(self, subblock_size):
         """Get the number of subblocks of size <subblock_size> that can be
@@ -169,3 +208,4 @@ class DataBlock:
                              u*source.get_block_size()]
                     end = [start[0]+shape[0], start[1]+shape[1], start[2]+shape[2]]
                     self.volume[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = src_block.volume[:]
+                    src_block.release()
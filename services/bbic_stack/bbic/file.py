@@ -7,22 +7,53 @@
 # Do not distribute without further notice.
 
 import h5py
+import math
+import os
 import sys
+import time
+import numpy as np
 
 from .volume import *
 from .stack import *
-from .image_utils import get_compressed_tile
+from .pyramid import Pyramid
+from .journal import WriteJournal
+from .level_scratch import LevelScratch
+from .scheduler import BlockScheduler
+from .reslice_workers import ResliceWorkers
+from .buffer_pool import get_buffer_pool
+from .instrumentation import get_instrumentation
+from .tracing import get_tracer
 
 BBIC_UNKNOWN_VERSION = 0
 BBIC_CURRENT_VERSION = 1
 
+# Number of slice rounds between two flushes of the write journal
+JOURNAL_INTERVAL = 16
+
+# Read-only files can be opened without file locks from h5py 3.5
+_H5PY_LOCKING = tuple(int(x) for x in h5py.__version__.split('.')[:2]) >= (3, 5)
+
 #import tqdm
 
+_instrumentation = get_instrumentation()
+_tracer = get_tracer()
+
 class File:
     """Read/write BBIC volumes to/from hdf5"""
 
-    def __init__(self, filename, mode='r', mpi_comm=None):
-        """Open a volume file"""
+    def __init__(self, filename, mode='r', mpi_comm=None, tile_cache=None, driver=None,
+                 swmr=False):
+        """Open a volume file, optionally decoding the tiles of its stacks
+        through a TileCache. Small files can be read into memory at once with
+        the 'core' driver.
+
+        Read-only files are opened without file locks and never written to:
+        missing levels are None instead of being created, and the stacks,
+        volumes and levels are read once and cached.
+
+        With *swmr*, writable files can be switched to HDF5 single-writer /
+        multiple-reader mode by write(), and read-only files can be read
+        while they are being written, see Stack.refresh()."""
         self.version = BBIC_UNKNOWN_VERSION
         self.filename = filename
         self.mpi_comm = mpi_comm
@@ -36,21 +67,49 @@ class File:
         self.bbic = None
         self.num_stacks = 0
         self.num_volumes = 0
+        self.tile_cache = tile_cache
+        self.driver = driver
+        self.swmr = swmr
+        self.read_only = True
+        self._stacks = {}
+        self._volumes = {}
+        self.h5file = None
         self._open(mode)
 
     def __del__(self):
         """Close the file"""
-        self.h5file.close()
+        if self.h5file is not None:
+            self.h5file.close()
 
     def _open(self, mode):
         """Open the h5 file"""
+        self.read_only = mode == 'r'
+        self._stacks = {}
+        self._volumes = {}
+        options = {}
+        if self.read_only and _H5PY_LOCKING:
+            options['locking'] = False
+        if self.swmr:
+            if self.read_only:
+                options['swmr'] = True
+            else:
+                options['libver'] = 'latest'
         if self.mpi_comm is not None and self.mpi_comm.Get_size() > 1:
+            if self.swmr:
+                raise ValueError("SWMR mode is not supported with MPI")
             if not h5py.get_config().mpi:
                 raise RuntimeError("ERROR: h5py is lacking MPI support, aborting!")
-            self.h5file = h5py.File(self.filename, mode, driver='mpio', comm=self.mpi_comm)
+            self.h5file = h5py.File(self.filename, mode, driver='mpio', comm=self.mpi_comm, **options)
+        else:
+            if self.driver is not None:
+                options['driver'] = self.driver
+            self.h5file = h5py.File(self.filename, mode, **options)
+        if self.read_only:
+            self.bbic = self.h5file.get('bbic')
+            if self.bbic is None:
+                raise ValueError("%s is not a BBIC file" % self.filename)
         else:
-            self.h5file = h5py.File(self.filename, mode)
-        self.bbic = self.h5file.require_group('bbic')
+            self.bbic = self.h5file.require_group('bbic')
         self._read_attrs()
         if mode is not 'r':
             self.version = BBIC_CURRENT_VERSION
@@ -82,12 +141,17 @@ class File:
         """Get a volume by its index"""
         assert isinstance(volume_index, int)
 
-        index = 'volumes/%d' % volume_index
-        if index not in self.bbic:
+        if volume_index in self._volumes:
+            return self._volumes[volume_index]
+        volume_group = self.bbic.get('volumes/%d' % volume_index)
+        if volume_group is None:
             return None
 
-        volume = Volume(self.bbic[index])
+        volume = Volume(volume_group)
         volume.read_attrs()
+        volume.read_only = self.read_only
+        if self.read_only:
+            self._volumes[volume_index] = volume
         return volume
 
     def create_volume(self, volume_index=0):
@@ -107,11 +171,17 @@ class File:
         """Get a stack by its index"""
         assert isinstance(stack_index, int)
 
-        index = 'stacks/%d' % stack_index
-        if index not in self.bbic:
+        if stack_index in self._stacks:
+            return self._stacks[stack_index]
+        stack_group = self.bbic.get('stacks/%d' % stack_index)
+        if stack_group is None:
             return None
-        stack = Stack(self.bbic[index], stack_index)
+        stack = Stack(stack_group, stack_index)
         stack.read_attrs()
+        stack.read_only = self.read_only
+        stack.tile_cache = self.tile_cache
+        if self.read_only:
+            self._stacks[stack_index] = stack
         return stack
 
     def create_stack(self, stack_index=0):
@@ -125,69 +195,147 @@ class File:
 
         stack = Stack(stack_group, stack_index)
         stack.write_attrs()
+        stack.tile_cache = self.tile_cache
         return stack
 
+    def _replace_stack(self, stack_index):
+        """Create an empty stack, removing a previous (incomplete) one"""
+        stack_path = 'stacks/%d' % stack_index
+        if stack_path in self.bbic:
+            del self.bbic[stack_path]
+        return self.create_stack(stack_index)
+
     def _all_store_tiles(self, local_tiles, local_tile_sizes, levels, local_slice_index):
-        """Store serialized tiles in the level group"""
+        """Store serialized tiles in the level group.
+
+        A positive tile size is the length of a serialized tile, a negative
+        one -(value+1) marks a tile of a single value, 0 marks no tile.
+        A negative local_slice_index means that this process has no slice
+        to store but takes part in the MPI dataset allocation."""
 
         if self.mpi_comm is not None:
             # create empty tile datasets across all MPI processes
-            all_tile_sizes = self.mpi_comm.allgather(local_tile_sizes)
-
-            for i in range(len(all_tile_sizes)):
-                for l in range(len(levels)):
-                    slice_index = local_slice_index - self.mpi_comm.Get_rank() + i
-                    if slice_index >= levels[l].num_slices:
-                        pass
-                    for v in range(0, len(all_tile_sizes[i][l])):
-                        for u in range(0, len(all_tile_sizes[i][l][v])):
-                            if all_tile_sizes[i][l][v][u] > 0:
-                                levels[l].allocate_tile(all_tile_sizes[i][l][v][u], u, v, slice_index)
+            with _instrumentation.timer('mpi_allgather'):
+                all_tile_sizes = self.mpi_comm.allgather((local_slice_index, local_tile_sizes))
+
+            with _instrumentation.timer('h5_allocate'):
+                for slice_index, tile_sizes in all_tile_sizes:
+                    if slice_index < 0:
+                        continue
+                    for l in range(len(levels)):
+                        for v in range(0, len(tile_sizes[l])):
+                            for u in range(0, len(tile_sizes[l][v])):
+                                size = tile_sizes[l][v][u]
+                                if size > 0:
+                                    levels[l].allocate_tile(size, u, v, slice_index)
+                                elif size < 0:
+                                    levels[l].link_uniform_tile(-size - 1, u, v, slice_index)
+
+        if local_slice_index < 0:
+            return
 
         # write local tiles
-        for l in range(len(levels)):
-            if local_slice_index >= levels[l].num_slices:
-                pass
-            for v in range(0, len(local_tile_sizes[l])):
-                for u in range(0, len(local_tile_sizes[l][v])):
-                    if local_tile_sizes[l][v][u] > 0:
-                        levels[l].store_tile(local_tiles[l][v][u], u, v, local_slice_index)
-
-    def _export_image_to_tiles(self, im, levels, slice_index, tile_size, format_, filter_):
-        """Split an image into tiles and write them in the level_group"""
+        with _instrumentation.timer('h5_store'):
+            for l in range(len(levels)):
+                for v in range(0, len(local_tile_sizes[l])):
+                    for u in range(0, len(local_tile_sizes[l][v])):
+                        size = local_tile_sizes[l][v][u]
+                        if size > 0:
+                            levels[l].store_tile(local_tiles[l][v][u], u, v, local_slice_index)
+                        elif size < 0 and self.mpi_comm is None:
+                            levels[l].link_uniform_tile(-size - 1, u, v, local_slice_index)
+
+    def _export_pyramid_to_tiles(self, pyramid, levels, first_level, slice_index, codec,
+                                 dedup=True):
+        """Split the levels of a slice pyramid into tiles and write them in the level groups.
+
+        With *dedup*, tiles of a single value are not encoded but linked to
+        a tile shared by the whole stack."""
         tiles = []
         tile_sizes = []
         for l in range(len(levels)):
-            (w, h) = im.size
             tiles.append([])
             tile_sizes.append([])
-            for y in range(0, h, tile_size):
-                index = int(y/tile_size)
+            for v in range(levels[l].num_y_tiles):
                 tiles[l].append([])
                 tile_sizes[l].append([])
-                for x in range(0, w, tile_size):
-                    tile = get_compressed_tile(im, x, y, tile_size, format_)
-                    tiles[l][index].append(tile)
-                    tile_sizes[l][index].append(len(tile))
-            im = im.resize((im.size[0] >> 1, im.size[1] >> 1) if im.size[0] >> 1 > 0 else (1,1), filter_)
+                for u in range(levels[l].num_x_tiles):
+                    data = pyramid.get_tile(first_level + l, u, v)
+                    if dedup and data.min() == data.max():
+                        tiles[l][v].append(None)
+                        tile_sizes[l][v].append(-int(data[0, 0]) - 1)
+                        _instrumentation.count('uniform_tiles')
+                        continue
+                    with _instrumentation.timer('encode'):
+                        tile = codec.encode(data)
+                    tiles[l][v].append(tile)
+                    tile_sizes[l][v].append(len(tile))
+                    _instrumentation.count('encoded_tiles')
+                    _instrumentation.count('encoded_bytes', len(tile))
 
         self._all_store_tiles(tiles, tile_sizes, levels, slice_index)
 
-    def _wait_all(self, levels, slice_index):
-        """Wait for other processes to finish export_image_to_tiles()"""
-        tiles = [[[0 for u in range(level.num_x_tiles)] for v in range(level.num_y_tiles)] for level in levels]
-        tile_sizes = [[[0 for u in range(level.num_x_tiles)] for v in range(level.num_y_tiles)] for level in levels]
-        self._all_store_tiles(tiles, tile_sizes, levels, slice_index)
+    def _wait_all(self, levels):
+        """Wait for other processes to finish _export_pyramid_to_tiles()"""
+        self._all_store_tiles(None, None, levels, -1)
+
+    def _open_journal(self, stack, level_offset, resume):
+        """Open the journal of the slices written in the levels >= level_offset"""
+        name = 'completed_slices' if level_offset == 0 else \
+            'completed_slices_from_level_%d' % level_offset
+        journal = WriteJournal(stack.stack_group, name, stack.num_slices, self.mpi_rank == 0)
+        if not resume:
+            journal.reset()
+        return journal
+
+    def _start_swmr_write(self, stack, levels, journal):
+        """Preallocate the tile indices of the levels and the watermark of the
+        completed slices, then switch the file to single-writer /
+        multiple-reader mode, in which no object can be created anymore"""
+        if self.h5file.swmr_mode:
+            raise RuntimeError("Only one stack can be written per SWMR session")
+        for level in levels:
+            level.create_tile_index()
+        journal.create_watermark(stack.stack_group)
+        journal.commit()
+        self.h5file.flush()
+        self.h5file.swmr_mode = True
+        if self._print_info:
+            print('SWMR mode: slices can be read as they are completed')
+
+    def _checkpoint(self, journal):
+        """Flush the written tiles to disk, then record them in the journal"""
+        with _instrumentation.timer('h5_flush'):
+            self.h5file.flush()
+            journal.commit()
+            self.h5file.flush()
 
     def write(self, image_source, stack, padding_value, interp, start_offset=0,
-              level_offset=0, generate_lods=True, reverse=False):
-        """Write the BBIC image stack"""
+              level_offset=0, generate_lods=True, reverse=False, dedup=True,
+              resume=False, source_level=0, swmr=False):
+        """Write the BBIC image stack, storing tiles of a single value only
+        once per stack if *dedup* is set.
+
+        The completed slices are recorded in a journal in the stack group,
+        with *resume* the slices already completed by a previous
+        (interrupted) write are skipped. The slices of *image_source* are
+        those of level *source_level* (at most level_offset) of the stack.
+
+        With *swmr* (on a file opened with swmr=True, without MPI), the file
+        is switched to single-writer / multiple-reader mode once the tile
+        storage is preallocated, and the number of leading complete slices
+        is published at every journal commit."""
         assert isinstance(image_source, ImageProvider)
         assert isinstance(stack, Stack)
         assert isinstance(start_offset, int)
         assert isinstance(level_offset, int)
         assert isinstance(generate_lods, bool)
-        filter_ = {'nearest': Image.NEAREST, 'linear': Image.LINEAR}[interp]
+        assert isinstance(dedup, bool)
+        assert isinstance(resume, bool)
+        assert isinstance(source_level, int) and source_level <= level_offset
+        assert isinstance(swmr, bool)
+        if swmr and not self.swmr:
+            raise ValueError("The file must be opened with swmr=True to write in SWMR mode")
 
         if self._print_info:
             total_size = int(stack.width * stack.height * stack.num_slices / (1000*1000))
@@ -197,37 +345,124 @@ class File:
         if self._print_info:
             print('Creating level groups...')
         levels = stack.create_levels(self._print_info, generate_lods)
+        codec = stack.get_codec()
+        pyramid = Pyramid(stack.width, stack.height, len(levels), stack.tile_size, interp)
+        journal = self._open_journal(stack, level_offset, resume)
+        if swmr:
+            self._start_swmr_write(stack, levels, journal)
 
         if self._print_info:
+            if resume:
+                print("Resuming: %d slices already complete" % journal.get_complete_count())
             print("Processing slices " + str(start_offset) + " to " + str(stack.num_slices-1) + "...")
 
-        for index in range(self.mpi_rank + start_offset, stack.num_slices, self.mpi_size):
+        self._write_slices(image_source, stack, levels, pyramid, codec, journal,
+                           journal.get_pending(start_offset), padding_value,
+                           level_offset, reverse, dedup, source_level)
+
+        # Wait for all processes to be done filling the stack before returning
+        if self.mpi_comm is not None:
+            with _instrumentation.timer('mpi_barrier'):
+                self.mpi_comm.barrier()
+
+        if self._print_info:
+            self._print_progress(stack.num_slices-1, stack.num_slices)
+            print()
+            print('Done.')
+
+    def _write_slice(self, image_source, stack, levels, pyramid, codec, index,
+                     padding_value, level_offset, reverse, dedup, source_level=0):
+        """Write one slice to the levels >= level_offset, returning its
+        (source_level) data"""
+        with _tracer.span('slice', 'slice', slice=index):
             slice_index = index
             if reverse:
                 slice_index = stack.num_slices - 1 - index
-            im = image_source.get_image(slice_index, padding_value)
-            if level_offset > 0:
-                im = im.resize((im.size[0] >> level_offset, im.size[1] >> level_offset), filter_)
+            data = image_source.get_array(slice_index, padding_value)
             if reverse:
-                from PIL import ImageOps
-                im = ImageOps.mirror(im)
-            self._export_image_to_tiles(im, levels[level_offset:], index, stack.tile_size, stack.format, filter_)
+                data = data[:, ::-1]
+            # Levels below level_offset are only computed to derive the others
+            with _instrumentation.timer('resize'):
+                pyramid.build(data, source_level)
+            self._export_pyramid_to_tiles(pyramid, levels[level_offset:], level_offset,
+                                          index, codec, dedup)
+        return data
+
+    def _write_slices(self, image_source, stack, levels, pyramid, codec, journal,
+                      pending, padding_value, level_offset, reverse, dedup,
+                      source_level=0):
+        """Write the given slices in rounds of one slice per MPI process,
+        recording them in the journal"""
+        num_rounds = int(math.ceil(float(len(pending)) / self.mpi_size))
+        for round_index in range(num_rounds):
+            batch = pending[round_index*self.mpi_size:(round_index+1)*self.mpi_size]
+            if self.mpi_rank < len(batch):
+                self._write_slice(image_source, stack, levels, pyramid, codec,
+                                  batch[self.mpi_rank], padding_value, level_offset,
+                                  reverse, dedup, source_level)
+            else:
+                # Let other mpi processes finish their image
+                with _tracer.span('idle', 'slice'):
+                    self._wait_all(levels[level_offset:])
+
+            journal.mark_complete(batch)
+            if (round_index + 1) % JOURNAL_INTERVAL == 0:
+                self._checkpoint(journal)
             if self._print_info:
-                self._print_progress(index, stack.num_slices)
+                self._print_progress(journal.get_complete_count() - 1, stack.num_slices)
 
-        # Let other mpi processes finish their image
-        extra_slices = stack.num_slices % self.mpi_size
-        if extra_slices > 0 and self.mpi_rank >= extra_slices:
-            slice_index = stack.num_slices - (stack.num_slices % self.mpi_size) + self.mpi_rank
-            self._wait_all(levels[level_offset:], slice_index)
+        self._checkpoint(journal)
+
+    def write_following(self, image_source, stack, padding_value, interp,
+                        generate_lods=True, dedup=True, resume=False,
+                        poll_interval=10.0, idle_timeout=600.0):
+        """Write the BBIC image stack while its source is still growing.
+
+        New slices are tiled as soon as image_source.refresh() reports them,
+        extending num_slices of the stack and of its levels. The write ends
+        when no new slice arrived for *idle_timeout* seconds."""
+        assert isinstance(image_source, ImageProvider)
+        assert isinstance(stack, Stack)
+        assert isinstance(generate_lods, bool)
+        assert isinstance(dedup, bool)
+        assert isinstance(resume, bool)
+
+        if self._print_info:
+            print('Target stack:(%dx%d) [w/h], following %s' %
+                  (stack.width, stack.height, image_source))
+            print('Creating level groups...')
+        levels = stack.create_levels(self._print_info, generate_lods)
+        codec = stack.get_codec()
+        pyramid = Pyramid(stack.width, stack.height, len(levels), stack.tile_size, interp)
+        journal = self._open_journal(stack, 0, resume)
+
+        idle_time = 0.0
+        while True:
+            num_slices = image_source.get_dimensions()[2]
+            if num_slices > stack.num_slices:
+                stack.grow(num_slices, levels)
+                journal.grow(num_slices)
+            pending = journal.get_pending()
+            if pending:
+                idle_time = 0.0
+                if self._print_info:
+                    print("Processing slices %d to %d..." % (pending[0], pending[-1]))
+                self._write_slices(image_source, stack, levels, pyramid, codec, journal,
+                                   pending, padding_value, 0, False, dedup)
+            elif idle_time >= idle_timeout:
+                break
+            else:
+                time.sleep(poll_interval)
+                idle_time += poll_interval
+            image_source.refresh(self.mpi_comm)
 
-        # Wait for all processes to be done filling the stack before returning
         if self.mpi_comm is not None:
-            self.mpi_comm.barrier()
+            with _instrumentation.timer('mpi_barrier'):
+                self.mpi_comm.barrier()
 
         if self._print_info:
-            self._print_progress(stack.num_slices-1, stack.num_slices)
-            print()
+            print('No new slice for %g seconds, stack complete with %d slices' %
+                  (idle_timeout, stack.num_slices))
             print('Done.')
 
     def _print_progress(self, slice_index, num_slices):
@@ -241,20 +476,10 @@ class File:
             print("\rProgress: %i%%" % min(percent, 100))
         #sys.stdout.flush()
 
-    def make_all_stacks(self, source_stack, padding_value,
-                        interp, generate_lods):
-        """Make stacks for the projections in the rest of the dimensions based
-        on the layer0 of the source_stack.
-        For simplicity, it will always perform the operations needed to
-        generate the projections corresponding to the left and upper faces of
-        the volume, viewed from the source stack point of view"""
-        assert isinstance(source_stack, Stack)
-        assert isinstance(padding_value, int)
-        assert isinstance(generate_lods, bool)
-
-        #TODO: Progress init
-        #pbar = tqdm.tqdm(total=3)
-
+    @staticmethod
+    def _get_projection_axes(source_stack):
+        """Get the axes of the stacks corresponding to the left and upper faces
+        of the volume, viewed from the source stack point of view"""
         all_stacks = ['X', 'Y', 'Z']
 
         # remove the stack that we already have, so we keep only the ones that
@@ -268,11 +493,13 @@ class File:
         if source_stack.index == 0:
             stacks_to_generate.reverse()
 
-        if self._print_info:
-            print('Creating stacks for the', stacks_to_generate,
-                  'projections...')
+        return stacks_to_generate
 
-        left_stack = self.create_stack(all_stacks.index(stacks_to_generate[0]))
+    def _create_projection_stacks(self, source_stack, stacks_to_generate):
+        """Create the (empty) left and upper stacks of a source stack,
+        replacing previous ones"""
+        all_stacks = ['X', 'Y', 'Z']
+        left_stack = self._replace_stack(all_stacks.index(stacks_to_generate[0]))
         if source_stack.index == 1:  # volume is viewed from the upper face (Y)
             left_stack.width = source_stack.height
             left_stack.height = source_stack.num_slices
@@ -282,10 +509,11 @@ class File:
         left_stack.num_slices = source_stack.width
         left_stack.tile_size = source_stack.tile_size
         left_stack.format = source_stack.format
+        left_stack.codec_options = dict(source_stack.codec_options)
         left_stack.set_axis(stacks_to_generate[0])
         left_stack.write_attrs()
 
-        upper_stack = self.create_stack(all_stacks.index(stacks_to_generate[1]))
+        upper_stack = self._replace_stack(all_stacks.index(stacks_to_generate[1]))
         if source_stack.index == 0:  # viewed from the X projection face
             upper_stack.width = source_stack.num_slices
             upper_stack.height = source_stack.width
@@ -295,8 +523,67 @@ class File:
         upper_stack.num_slices = source_stack.height
         upper_stack.tile_size = source_stack.tile_size
         upper_stack.format = source_stack.format
+        upper_stack.codec_options = dict(source_stack.codec_options)
         upper_stack.set_axis(stacks_to_generate[1])
         upper_stack.write_attrs()
+        return left_stack, upper_stack
+
+    def _create_level_scratches(self, stacks, interp, padding_value, scratch_dir=None):
+        """Create the level 1 scratches of stacks, in *scratch_dir* or next to
+        the file. Tiles of an odd size cannot be reduced on their own, their
+        levels are built by reading level 0 back (no scratch)."""
+        if any(stack.tile_size % 2 for stack in stacks):
+            return [None] * len(stacks)
+        if scratch_dir is None:
+            scratch_dir = os.path.dirname(os.path.abspath(self.filename))
+        scratch_name = os.path.join(scratch_dir, os.path.basename(self.filename))
+        return [LevelScratch('%s.level1_%d.tmp' % (scratch_name, stack.index), stack,
+                             interp, padding_value, self.mpi_comm) for stack in stacks]
+
+    def _write_projection_lods(self, scratches, stacks, padding_value, interp, dedup):
+        """Build the levels 1-n of stacks from their level 1 scratches, then
+        remove the scratches"""
+        for scratch, stack in zip(scratches, stacks):
+            if scratch is None:
+                self.write(stack.get_level(0), stack, padding_value, interp, 0, 1, dedup=dedup)
+                continue
+            scratch.sync()
+            self.write(scratch, stack, padding_value, interp, 0, 1,
+                       dedup=dedup, source_level=1)
+            scratch.close()
+
+    def make_all_stacks(self, source_stack, padding_value,
+                        interp, generate_lods, dedup=True, scratch_dir=None,
+                        num_processes=1):
+        """Make stacks for the projections in the rest of the dimensions based
+        on the layer0 of the source_stack.
+        For simplicity, it will always perform the operations needed to
+        generate the projections corresponding to the left and upper faces of
+        the volume, viewed from the source stack point of view.
+
+        The tiles of the blocks are also reduced into level 1 scratches (in
+        *scratch_dir*, by default next to the file), from which the other
+        levels are built without reading level 0 back.
+
+        Without MPI, the blocks can be resliced by *num_processes* local
+        processes, this process writing their tiles."""
+        assert isinstance(source_stack, Stack)
+        assert isinstance(padding_value, int)
+        assert isinstance(generate_lods, bool)
+        assert isinstance(dedup, bool)
+        assert isinstance(num_processes, int)
+
+        #TODO: Progress init
+        #pbar = tqdm.tqdm(total=3)
+
+        stacks_to_generate = self._get_projection_axes(source_stack)
+
+        if self._print_info:
+            print('Creating stacks for the', stacks_to_generate,
+                  'projections...')
+
+        left_stack, upper_stack = self._create_projection_stacks(source_stack,
+                                                                 stacks_to_generate)
 
         if self._print_info:
             print('Filling level0 of the', stacks_to_generate,
@@ -305,29 +592,21 @@ class File:
         # Fill level0 for the rest of stacks,
         # splitting block processing across MPI processes
         level0 = source_stack.get_level(0)
+        left_lods = upper_lods = None
+        if generate_lods:
+            left_lods, upper_lods = self._create_level_scratches(
+                [left_stack, upper_stack], interp, padding_value, scratch_dir)
         block_indices = level0.get_block_list()
-        for i in range(0, len(block_indices), self.mpi_size):
-            current_block_range = block_indices[i:i+self.mpi_size]
-            if self.mpi_rank < len(current_block_range):
-                local_block = current_block_range[self.mpi_rank]
-                block = level0.get_block(local_block.u,
-                                         local_block.v,
-                                         local_block.z)
-            else:
-                # Special handling for the remaining blocks
-                block = DataBlock(-1, -1, -1, -1)  # invalid
-
-            self._write_block_to_tiles(block, current_block_range,
-                                       left_stack, upper_stack, source_stack)
-            # TODO: Progress checkpoint 1
-            #pbar.update(1)
-
-            if self._print_info:
-                self._print_progress(i, len(block_indices))
+        if self.mpi_comm is None and num_processes > 1:
+            self._reslice_with_workers(num_processes, source_stack, left_stack, upper_stack,
+                                       left_lods, upper_lods, interp, padding_value)
+        else:
+            self._reslice_blocks(source_stack, left_stack, upper_stack, left_lods, upper_lods)
 
         # Wait for level0 to be complete before reading from it
         if self.mpi_comm is not None:
-            self.mpi_comm.barrier()
+            with _instrumentation.timer('mpi_barrier'):
+                self.mpi_comm.barrier()
 
         if self._print_info:
             self._print_progress(len(block_indices)-1, len(block_indices))
@@ -342,26 +621,233 @@ class File:
                   'projection stacks...')
 
         # Create level[1-n] for the rest of stacks (parallel)
-        level_offset = 1
-        self.write(left_stack.get_level(0), left_stack, padding_value,
-                   interp, 0, level_offset)
+        self._write_projection_lods([left_lods, upper_lods], [left_stack, upper_stack],
+                                    padding_value, interp, dedup)
         # TODO: Progress checkpoint 2
         #pbar.update(1)
-
-        self.write(upper_stack.get_level(0), upper_stack, padding_value,
-                   interp, 0, level_offset)
-        # TODO: Progress checkpoint 3
-        #pbar.update(1)
         #pbar.close()
 
+    def _reslice_blocks(self, source_stack, left_stack, upper_stack, left_lods, upper_lods):
+        """Fill level 0 of the left and upper stacks with the blocks of the
+        source stack, taken on demand by the MPI processes"""
+        level0 = source_stack.get_level(0)
+        left_stack_l0 = left_stack.get_level(0)
+        upper_stack_l0 = upper_stack.get_level(0)
+        block_indices = level0.get_block_list()
+        scheduler = BlockScheduler(len(block_indices), mpi_comm=self.mpi_comm)
+        for epoch in range(scheduler.num_epochs):
+            # Blocks are taken on demand, their tiles kept until the epoch ends
+            blocks = []
+            for index in scheduler.get_blocks(epoch):
+                local_block = block_indices[index]
+                with _instrumentation.timer('block_read'):
+                    block = level0.get_block(local_block.u,
+                                             local_block.v,
+                                             local_block.z)
+                with _tracer.span('block', 'block', block=index):
+                    blocks.append((local_block,
+                                   block.to_x_tiles(left_stack.get_codec(), source_stack.index),
+                                   block.to_y_tiles(upper_stack.get_codec(), source_stack.index)))
+                    if left_lods is not None:
+                        self._reduce_block_tiles(block, left_stack_l0, upper_stack_l0,
+                                                 source_stack.index, left_lods, upper_lods)
+                block.release()
+
+            self._write_blocks_to_tiles(blocks, left_stack, upper_stack, source_stack)
+            # TODO: Progress checkpoint 1
+            #pbar.update(1)
+
+            if self._print_info:
+                self._print_progress(scheduler.get_epoch_range(epoch)[-1], len(block_indices))
+        scheduler.free()
+
+    def _reslice_with_workers(self, num_processes, source_stack, left_stack, upper_stack,
+                              left_lods, upper_lods, interp, padding_value):
+        """Fill level 0 of the left and upper stacks with the blocks of the
+        source stack read by this process and resliced by local worker
+        processes"""
+        block_indices = source_stack.get_level(0).get_block_list()
+        left_stack_l0 = left_stack.get_level(0)
+        upper_stack_l0 = upper_stack.get_level(0)
+        scratches = None if left_lods is None else [left_lods, upper_lods]
+        workers = ResliceWorkers(num_processes, source_stack, left_stack, upper_stack,
+                                 scratches, interp, padding_value)
+        num_blocks = len(block_indices)
+        for count, (index, x_tiles, y_tiles) in enumerate(workers.reslice(range(num_blocks))):
+            self._store_block_tiles(block_indices[index], x_tiles, y_tiles, left_stack_l0,
+                                    upper_stack_l0, source_stack.index)
+            if self._print_info and (count + 1) % num_processes == 0:
+                self._print_progress(count, num_blocks)
+
+    def write_all_stacks(self, image_source, stack, padding_value, interp,
+                         generate_lods=True, reverse=False, dedup=True,
+                         scratch_dir=None):
+        """Write the BBIC image stack and the stacks of the two other
+        projections in a single pass over the source slices.
+
+        Every MPI process keeps a slab of tile_size slices in memory: once
+        its slices are written to *stack*, its blocks are resliced into level
+        0 of the other stacks and reduced into memory-mapped level 1
+        scratches (in *scratch_dir*, by default next to the file), from which
+        the other levels are built at the end."""
+        assert isinstance(image_source, ImageProvider)
+        assert isinstance(stack, Stack)
+        assert isinstance(generate_lods, bool)
+        assert isinstance(reverse, bool)
+        assert isinstance(dedup, bool)
+
+        if self._print_info:
+            print('Target stack:(%dx%dx%d) [w/h/slices], writing all the projections' %
+                  (stack.width, stack.height, stack.num_slices))
+            print('Creating level groups...')
+        levels = stack.create_levels(self._print_info, generate_lods)
+        codec = stack.get_codec()
+        pyramid = Pyramid(stack.width, stack.height, len(levels), stack.tile_size, interp)
+        journal = self._open_journal(stack, 0, False)
+
+        stacks_to_generate = self._get_projection_axes(stack)
+        if self._print_info:
+            print('Creating stacks for the', stacks_to_generate, 'projections...')
+        left_stack, upper_stack = self._create_projection_stacks(stack, stacks_to_generate)
+        left_stack.get_level(0)
+        upper_stack.get_level(0)
+        left_lods = upper_lods = None
+        if generate_lods:
+            left_lods, upper_lods = self._create_level_scratches(
+                [left_stack, upper_stack], interp, padding_value, scratch_dir)
+
+        if self._print_info:
+            print("Processing slices 0 to %d..." % (stack.num_slices-1))
+        tile_size = stack.tile_size
+        num_slabs = int(math.ceil(float(stack.num_slices) / tile_size))
+        block_grid = [(u, v) for v in range(levels[0].num_y_tiles)
+                      for u in range(levels[0].num_x_tiles)]
+        for first_slab in range(0, num_slabs, self.mpi_size):
+            slab_index = first_slab + self.mpi_rank
+            start = slab_index * tile_size
+            end = min(start + tile_size, stack.num_slices)
+            slab = None
+            if slab_index < num_slabs:
+                slab = get_buffer_pool().acquire((end - start, stack.height, stack.width))
+
+            # Write the slices of the slabs, one per process in each round
+            for i in range(tile_size):
+                if start + i < end:
+                    slab[i] = self._write_slice(image_source, stack, levels, pyramid, codec,
+                                                start + i, padding_value, 0, reverse, dedup)
+                else:
+                    with _tracer.span('idle', 'slice'):
+                        self._wait_all(levels)
+
+            # Reslice the blocks of the slabs
+            slab_indices = range(first_slab, min(first_slab + self.mpi_size, num_slabs))
+            for u, v in block_grid:
+                current_block_range = [DataBlock(u, v, z, tile_size) for z in slab_indices]
+                block = DataBlock(u, v, slab_index, tile_size)
+                if slab is not None:
+                    x, y = u * tile_size, v * tile_size
+                    block.wrap(slab[:, y:y + tile_size, x:x + tile_size])
+                with _tracer.span('block', 'block', block=slab_index * len(block_grid) + u +
+                                  v * levels[0].num_x_tiles):
+                    self._write_block_to_tiles(block, current_block_range, left_stack,
+                                               upper_stack, stack, left_lods, upper_lods)
+
+            if slab is not None:
+                get_buffer_pool().release(slab)
+            journal.mark_complete(range(first_slab * tile_size,
+                                        min((first_slab + self.mpi_size) * tile_size,
+                                            stack.num_slices)))
+            self._checkpoint(journal)
+            if self._print_info:
+                self._print_progress(journal.get_complete_count() - 1, stack.num_slices)
+        # The slabs are not needed to build the levels
+        get_buffer_pool().clear()
+
+        if self.mpi_comm is not None:
+            with _instrumentation.timer('mpi_barrier'):
+                self.mpi_comm.barrier()
+        if self._print_info:
+            print()
+            print('Done.')
+
+        if generate_lods:
+            self._write_projection_lods([left_lods, upper_lods], [left_stack, upper_stack],
+                                        padding_value, interp, dedup)
+
+    @staticmethod
+    def _get_x_tile_position(block, x, source_index, left_stack_l0):
+        """Get the (u, v, slice) position in the left stack of the x-th x tile
+        of a block"""
+        if source_index == 0:
+            return (block.z, block.v,
+                    left_stack_l0.num_slices - 1 - (x + block.u * block.nominal_size))
+        elif source_index == 1:
+            return block.v, block.z, x + block.u * block.nominal_size
+        # BUG: using this logic, part of first column is missing
+        return (left_stack_l0.num_x_tiles - 1 - block.z, block.v,
+                x + block.u * block.nominal_size)
+
+    @staticmethod
+    def _get_y_tile_position(block, y, source_index, upper_stack_l0):
+        """Get the (u, v, slice) position in the upper stack of the y-th y tile
+        of a block"""
+        if source_index == 0:
+            return block.z, block.u, y + block.v * block.nominal_size
+        elif source_index == 1:
+            return (block.u, block.z,
+                    upper_stack_l0.num_slices - 1 - (y + block.v * block.nominal_size))
+        # BUG: using this logic, part of first row is missing
+        return (block.u, upper_stack_l0.num_y_tiles - 1 - block.z,
+                y + block.v * block.nominal_size)
+
+    def _allocate_block_tiles(self, blocks_tile_sizes, left_stack_l0, upper_stack_l0,
+                              source_index):
+        """Create the empty datasets of the tiles of blocks, given as a list of
+        (block, x tile sizes, y tile sizes) identical on all MPI processes"""
+        with _instrumentation.timer('h5_allocate'):
+            for blk, x_tile_sizes, y_tile_sizes in blocks_tile_sizes:
+                for x, size in enumerate(x_tile_sizes):
+                    u, v, z = self._get_x_tile_position(blk, x, source_index, left_stack_l0)
+                    left_stack_l0.allocate_tile(size, u, v, z)
+            for blk, x_tile_sizes, y_tile_sizes in blocks_tile_sizes:
+                for y, size in enumerate(y_tile_sizes):
+                    u, v, z = self._get_y_tile_position(blk, y, source_index, upper_stack_l0)
+                    upper_stack_l0.allocate_tile(size, u, v, z)
+
+    def _store_block_tiles(self, block, x_tiles, y_tiles, left_stack_l0, upper_stack_l0,
+                           source_index):
+        """Store the encoded tiles of a block"""
+        with _instrumentation.timer('h5_store'):
+            for x, tile in enumerate(x_tiles):
+                u, v, z = self._get_x_tile_position(block, x, source_index, left_stack_l0)
+                left_stack_l0.store_tile(tile, u, v, z)
+            for y, tile in enumerate(y_tiles):
+                u, v, z = self._get_y_tile_position(block, y, source_index, upper_stack_l0)
+                upper_stack_l0.store_tile(tile, u, v, z)
+
+    @staticmethod
+    def _reduce_block_tiles(block, left_stack_l0, upper_stack_l0, source_index,
+                            left_lods, upper_lods):
+        """Reduce the tiles of a block into the level 1 scratches of the left
+        and upper stacks, whose levels 0 only need their dimensions"""
+        with _instrumentation.timer('resize'):
+            for x, data in enumerate(block.get_x_slices(source_index)):
+                u, v, z = File._get_x_tile_position(block, x, source_index, left_stack_l0)
+                left_lods.add_tile(data, u, v, z)
+            for y, data in enumerate(block.get_y_slices(source_index)):
+                u, v, z = File._get_y_tile_position(block, y, source_index, upper_stack_l0)
+                upper_lods.add_tile(data, u, v, z)
+
     def _write_block_to_tiles(self, block, current_block_range,
-                              left_stack, upper_stack, source_stack):
+                              left_stack, upper_stack, source_stack,
+                              left_lods=None, upper_lods=None):
         """Store a block of tiles to the target level0 groups of the rest of
-        the projections stacks"""
+        the projections stacks, and reduce them into the optional level 1
+        scratches of these stacks"""
 
         # Get all x and y tiles for the block
-        x_tiles = block.to_x_tiles(left_stack.format, source_stack.index) if block.is_valid() else []
-        y_tiles = block.to_y_tiles(upper_stack.format, source_stack.index) if block.is_valid() else []
+        x_tiles = block.to_x_tiles(left_stack.get_codec(), source_stack.index) if block.is_valid() else []
+        y_tiles = block.to_y_tiles(upper_stack.get_codec(), source_stack.index) if block.is_valid() else []
 
         left_stack_l0 = left_stack.get_level(0)
         upper_stack_l0 = upper_stack.get_level(0)
@@ -371,75 +857,43 @@ class File:
             # across all MPI processes
             x_tile_sizes = [len(tile) for tile in x_tiles]
             y_tile_sizes = [len(tile) for tile in y_tiles]
-            all_x_tile_sizes = self.mpi_comm.allgather(x_tile_sizes)
-            all_y_tile_sizes = self.mpi_comm.allgather(y_tile_sizes)
-
-            for i in range(len(all_x_tile_sizes)):
-                for x in range(len(all_x_tile_sizes[i])):
-                    blk = current_block_range[i]
-                    if source_stack.index == 0:
-                        u = blk.z
-                        v = blk.v
-                        z = left_stack_l0.num_slices - 1 - (x + blk.u * blk.nominal_size)
-                    elif source_stack.index == 1:
-                        u = blk.v
-                        v = blk.z
-                        z = x + blk.u * blk.nominal_size
-                    elif source_stack.index == 2:
-                        u = left_stack_l0.num_x_tiles - 1 - blk.z
-                        v = blk.v
-                        z = x + blk.u * blk.nominal_size
-                    left_stack_l0.allocate_tile(all_x_tile_sizes[i][x], u, v, z)
-
-            for i in range(len(all_y_tile_sizes)):
-                for y in range(len(all_y_tile_sizes[i])):
-                    blk = current_block_range[i]
-                    if source_stack.index == 0:
-                        u = blk.z
-                        v = blk.u
-                        z = y + blk.v * blk.nominal_size
-                    elif source_stack.index == 1:
-                        u = blk.u
-                        v = blk.z
-                        z = upper_stack_l0.num_slices - 1 - (y + blk.v * blk.nominal_size)
-                    elif source_stack.index == 2:
-                        u = blk.u
-                        v = upper_stack_l0.num_y_tiles - 1 - blk.z
-                        z = y + blk.v * blk.nominal_size
-                    upper_stack_l0.allocate_tile(all_y_tile_sizes[i][y], u, v, z)
+            with _instrumentation.timer('mpi_allgather'):
+                all_x_tile_sizes = self.mpi_comm.allgather(x_tile_sizes)
+                all_y_tile_sizes = self.mpi_comm.allgather(y_tile_sizes)
+            self._allocate_block_tiles(
+                [(current_block_range[i], all_x_tile_sizes[i], all_y_tile_sizes[i])
+                 for i in range(len(current_block_range))],
+                left_stack_l0, upper_stack_l0, source_stack.index)
 
         if not block.is_valid():
             return
 
         # Write the tiles for the local block
-        for i in range(0, len(x_tiles)):
-            if source_stack.index == 0:
-                u = block.z
-                v = block.v
-                z = left_stack_l0.num_slices - 1 - (i + block.u * block.nominal_size)
-            elif source_stack.index == 1:
-                u = block.v
-                v = block.z
-                z = i + block.u * block.nominal_size
-            else:
-                # BUG: using this logic, part of first column is missing
-                u = left_stack_l0.num_x_tiles - 1 - block.z
-                v = block.v
-                z = i + block.u * block.nominal_size
-            left_stack_l0.store_tile(x_tiles[i], u, v, z)
-
-        for i in range(0, len(y_tiles)):
-            if source_stack.index == 0:
-                u = block.z
-                v = block.u
-                z = i + block.v * block.nominal_size
-            elif source_stack.index == 1:
-                u = block.u
-                v = block.z
-                z = upper_stack_l0.num_slices - 1 - (i + block.v * block.nominal_size)
-            else:
-                u = block.u
-                # BUG: using this logic, part of first row is missing
-                v = upper_stack_l0.num_y_tiles - 1 - block.z
-                z = i + block.v * block.nominal_size
-            upper_stack_l0.store_tile(y_tiles[i], u, v, z)
+        self._store_block_tiles(block, x_tiles, y_tiles, left_stack_l0, upper_stack_l0,
+                                source_stack.index)
+        if left_lods is not None:
+            self._reduce_block_tiles(block, left_stack_l0, upper_stack_l0, source_stack.index,
+                                     left_lods, upper_lods)
+
+    def _write_blocks_to_tiles(self, blocks, left_stack, upper_stack, source_stack):
+        """Store the tiles of the blocks of an epoch, given as a list of
+        (block, x tiles, y tiles) of this process, allocating the tiles of all
+        the processes with a single collective call"""
+        left_stack_l0 = left_stack.get_level(0)
+        upper_stack_l0 = upper_stack.get_level(0)
+
+        if self.mpi_comm is not None:
+            local_tile_sizes = [((blk.u, blk.v, blk.z), [len(tile) for tile in x_tiles],
+                                 [len(tile) for tile in y_tiles])
+                                for blk, x_tiles, y_tiles in blocks]
+            with _instrumentation.timer('mpi_allgather'):
+                all_tile_sizes = self.mpi_comm.allgather(local_tile_sizes)
+            self._allocate_block_tiles(
+                [(DataBlock(u, v, z, source_stack.tile_size), x_tile_sizes, y_tile_sizes)
+                 for rank_tile_sizes in all_tile_sizes
+                 for (u, v, z), x_tile_sizes, y_tile_sizes in rank_tile_sizes],
+                left_stack_l0, upper_stack_l0, source_stack.index)
+
+        for blk, x_tiles, y_tiles in blocks:
+            self._store_block_tiles(blk, x_tiles, y_tiles, left_stack_l0, upper_stack_l0,
+                                    source_stack.index)
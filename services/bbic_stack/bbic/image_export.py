@@ -0,0 +1,86 @@
+# BBIC image export
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .reader_processes import get_reader_context
+
+# Threads encoding and writing the exported images, PIL releases the GIL
+SAVE_THREADS = min(4, os.cpu_count() or 1)
+
+# Images waiting to be saved, per thread
+QUEUED_IMAGES_PER_THREAD = 2
+
+
+def get_rank_items(items, mpi_comm=None):
+    """Get the items exported by this MPI process, dealt round-robin"""
+    if mpi_comm is None:
+        return items
+    return items[mpi_comm.Get_rank()::mpi_comm.Get_size()]
+
+
+class ImageWriter:
+    """Saves images on a thread pool while the caller decodes and stitches
+    the next ones. Blocks when too many images are waiting, to bound the
+    memory used."""
+
+    def __init__(self, num_threads=SAVE_THREADS):
+        assert isinstance(num_threads, int)
+        self._executor = ThreadPoolExecutor(max_workers=max(num_threads, 1))
+        self._max_pending = QUEUED_IMAGES_PER_THREAD * max(num_threads, 1)
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
+        return False
+
+    def save(self, image, filename):
+        """Save a PIL image in the background"""
+        while len(self._pending) >= self._max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(image.save, filename))
+
+    def close(self, wait=True):
+        """Wait for the images being saved, raising their errors"""
+        try:
+            while wait and self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown(wait=wait)
+
+
+def _export_items(filename, group_name, items, args):
+    """Worker process: export the given items of the stack level or volume
+    LOD stored in a group of the file, read-only"""
+    from .file import File
+
+    # /bbic/<stacks|volumes>/<index>/levels/<level>
+    parts = group_name.strip('/').split('/')
+    kind, index, level = parts[-4], int(parts[-3]), int(parts[-1])
+    bbic_file = File(filename, 'r')
+    if kind == 'stacks':
+        provider = bbic_file.get_stack(index).get_level(level)
+    else:
+        provider = bbic_file.get_volume(index).get_lod(level)
+    provider._export_items(items, *args)
+
+
+def export_with_processes(num_processes, group, items, args):
+    """Export the items of the stack level or volume LOD of an HDF5 group
+    with local processes, each reading the file from its own read-only
+    handle. A process dying raises a BrokenProcessPool error."""
+    assert isinstance(num_processes, int)
+    context = get_reader_context(group.file)
+    with ProcessPoolExecutor(num_processes, mp_context=context) as executor:
+        futures = [executor.submit(_export_items, group.file.filename, group.name,
+                                   items[index::num_processes], args)
+                   for index in range(num_processes)]
+        for future in futures:
+            future.result()
@@ -4,6 +4,9 @@
 # Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
 # Do not distribute without further notice.
 
+import numpy as np
+from .instrumentation import get_instrumentation
+
 
 class ImageProvider:
     """Abstract class for image providers"""
@@ -15,3 +18,15 @@ class ImageProvider:
     def get_image(self, slice_index, padding_value=0):
         """Get an image by its slice index, padded with the given value (if needed)"""
         raise NotImplementedError
+
+    def get_array(self, slice_index, padding_value=0):
+        """Get an image by its slice index as a 2D uint8 array, padded with the
+        given value (if needed). The array may be a read-only view or a
+        buffer reused by the next call."""
+        with get_instrumentation().timer('decode'):
+            return np.asarray(self.get_image(slice_index, padding_value))
+
+    def refresh(self, mpi_comm=None):
+        """Look for new slices in a growing source, returning how many were
+        added. Sources of fixed size have none."""
+        return 0
@@ -4,40 +4,166 @@
 # Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
 # Do not distribute without further notice.
 
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+import numpy as np
 try:
     from mpi4py import MPI
 except ImportError:
     pass
 from .image_provider import ImageProvider
+from .image_utils import pad_array
+from .instrumentation import get_instrumentation
+
+SIZE_CACHE_FILENAME = '.bbic_image_sizes.json'
+SIZE_CACHE_VERSION = 1
+
+
+def read_image_size(filename):
+    """Get the (width, height) of an image by reading its header only"""
+    with Image.open(filename) as im:
+        return im.size
+
+
+class ImageSizeCache:
+    """Cache of image sizes stored in a JSON sidecar file, keyed by absolute
+    path and validated with the file modification time and size"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.modified = False
+        try:
+            with open(filename, 'r') as f:
+                content = json.load(f)
+            if content.get('version') == SIZE_CACHE_VERSION:
+                self.entries = content['entries']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def get_size(self, filename):
+        """Get the size of an image, from the cache if the file is unchanged"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2], entry[3]
+        size = read_image_size(path)
+        self.entries[path] = [stat.st_mtime_ns, stat.st_size, size[0], size[1]]
+        self.modified = True
+        return size
+
+    def update(self, entries):
+        """Add entries from another cache (e.g. of other MPI processes)"""
+        for path, entry in entries.items():
+            if self.entries.get(path) != entry:
+                self.entries[path] = entry
+                self.modified = True
+
+    def save(self):
+        """Write the cache if it was modified, ignoring read-only locations"""
+        if not self.modified:
+            return
+        tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump({'version': SIZE_CACHE_VERSION, 'entries': self.entries}, f)
+            os.rename(tmp_filename, self.filename)
+            self.modified = False
+        except (IOError, OSError) as e:
+            print('Warning: could not write the image size cache:', e)
 
 
 class ImageStack(ImageProvider):
     """Image stack reader"""
-    def __init__(self, filename_pattern):
+    def __init__(self, filename_pattern, follow=False):
+        """Open the slices matching a pattern or listed in a text file.
+
+        With *follow*, the slices are only discovered by refresh(), for
+        following a directory that is still being filled."""
         self.filename_pattern = filename_pattern
-        self.filenames = self._get_filenames(filename_pattern)
+        self._padding_buffer = None
+        self.filenames = [] if follow else self._get_filenames(filename_pattern)
         self.num_slices = len(self.filenames)
         self.width = 0
         self.height = 0
+        self._last_stats = {}
+
+    def __str__(self):
+        return "ImageStack %s [%d, %d, %d]" % (self.filename_pattern, self.width,
+                                               self.height, self.num_slices)
 
-    def _get_filenames(self, pattern):
-        """Get the filenames of the input image slices."""
+    def _get_filenames(self, pattern, start=0):
+        """Get the filenames of the input image slices, from the start-th one"""
         filenames = []
         if pattern.find('%') == -1:
+            if not os.path.exists(pattern) and start > 0:
+                return filenames
             with open(pattern, 'rb') as f:
                 filenames = list(filter(lambda y: y != '', map(lambda x: x.strip(), f.read().decode('ascii').split('\n'))))
+            filenames = filenames[start:]
         else:
-            start_idx = 0 if os.path.exists(pattern % 0) else 1
-            slice_idx = start_idx
-            while os.path.exists(pattern % slice_idx):
+            # List the directory once instead of probing every slice
+            directory, basename = os.path.split(pattern)
+            if '%' in directory:
+                exists = os.path.exists
+            else:
+                try:
+                    names = set(os.listdir(directory or '.'))
+                except OSError:
+                    names = set()
+                exists = lambda filename: os.path.basename(filename) in names
+            start_idx = 0 if exists(pattern % 0) else 1
+            slice_idx = start_idx + start
+            while exists(pattern % slice_idx):
                 filenames.append(pattern % slice_idx)
                 slice_idx += 1
         return filenames
 
-    def determine_stack_size(self, mpi_comm=None):
-        """Compute overall stack width and height by opening all images."""
+    def get_default_size_cache(self):
+        """Get the default image size cache file, next to the source"""
+        directory = os.path.dirname(os.path.abspath(self.filename_pattern))
+        return os.path.join(directory, SIZE_CACHE_FILENAME)
+
+    def refresh(self, mpi_comm=None):
+        """Look for new slices, returning how many were added.
+
+        A new file is only accepted once its size and modification time did
+        not change since the previous call, so that slices still being
+        written are not read."""
+        if mpi_comm is None or mpi_comm.Get_rank() == 0:
+            new_filenames = []
+            contiguous = True
+            for filename in self._get_filenames(self.filename_pattern, len(self.filenames)):
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    break
+                stat = (stat.st_size, stat.st_mtime)
+                stable = self._last_stats.get(filename) == stat
+                self._last_stats[filename] = stat
+                # keep the slices contiguous, stop at the first unstable one
+                contiguous = contiguous and stable
+                if contiguous:
+                    del self._last_stats[filename]
+                    new_filenames.append(filename)
+        else:
+            new_filenames = None
+        if mpi_comm is not None:
+            new_filenames = mpi_comm.bcast(new_filenames, root=0)
+
+        self.filenames.extend(new_filenames)
+        self.num_slices = len(self.filenames)
+        return len(new_filenames)
+
+    def determine_stack_size(self, mpi_comm=None, num_threads=16, size_cache=None):
+        """Compute overall stack width and height from the image headers.
+
+        The headers are read by *num_threads* threads on every MPI process,
+        and the sizes can be cached in the *size_cache* JSON file."""
+        assert isinstance(num_threads, int)
         if mpi_comm is None:
             mpi_size = 1
             mpi_rank = 0
@@ -45,15 +171,26 @@ class ImageStack(ImageProvider):
             mpi_size = mpi_comm.Get_size()
             mpi_rank = mpi_comm.Get_rank()
 
-        self.width = self.height = 0
-        for filename in self.filenames[mpi_rank::mpi_size]:
-            im = Image.open(filename)
-            self.width = max(self.width, im.size[0])
-            self.height = max(self.height, im.size[1])
+        cache = ImageSizeCache(size_cache) if size_cache else None
+        get_size = cache.get_size if cache else read_image_size
+        with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            sizes = list(executor.map(get_size, self.filenames[mpi_rank::mpi_size]))
+
+        self.width = max([size[0] for size in sizes] + [0])
+        self.height = max([size[1] for size in sizes] + [0])
         if mpi_comm is not None:
             self.width = mpi_comm.allreduce(self.width, op=MPI.MAX)
             self.height = mpi_comm.allreduce(self.height, op=MPI.MAX)
 
+        if cache:
+            if mpi_comm is not None:
+                all_entries = mpi_comm.gather(cache.entries if cache.modified else {}, root=0)
+                if mpi_rank == 0:
+                    for entries in all_entries:
+                        cache.update(entries)
+            if mpi_rank == 0:
+                cache.save()
+
     def _expand_image(self, im, w, h, color='white'):
         """Return an image expanded to the given size"""
         dx = w - im.size[0]
@@ -76,3 +213,25 @@ class ImageStack(ImageProvider):
         im = self._expand_image(im, self.width, self.height, padding_value)
         return im
 
+
+    def _get_padding_buffer(self):
+        """Get the buffer receiving the padded images"""
+        if self._padding_buffer is None or self._padding_buffer.shape != (self.height, self.width):
+            self._padding_buffer = np.empty((self.height, self.width), dtype=np.uint8)
+        return self._padding_buffer
+
+    def _pad(self, data, padding_value):
+        """Pad an array to the stack dimensions, into a reused buffer"""
+        if data.shape == (self.height, self.width):
+            return data
+        with get_instrumentation().timer('pad'):
+            return pad_array(data, self._get_padding_buffer(), padding_value)
+
+    def get_array(self, index, padding_value=0):
+        """Get an image as an array, padded to the stack dimensions"""
+        with get_instrumentation().timer('decode'):
+            im = Image.open(self.filenames[index])
+            if im.mode != 'L':
+                im = im.convert('L')
+            data = np.asarray(im)
+        return self._pad(data, padding_value)
@@ -13,7 +13,7 @@ def compress_and_serialize(image, format_):
     """Return a byte array containing the serialized image, compressed in the desired format"""
     bytes_buffer = BytesIO()
     image.save(bytes_buffer, format_)
-    array = np.fromstring(bytes_buffer.getvalue(), dtype=np.uint8)
+    array = np.frombuffer(bytes_buffer.getbuffer(), dtype=np.uint8)
     if len(array) == 0:
         raise Exception('zero-length image')
     return array
@@ -26,3 +26,45 @@ def get_compressed_tile(im, x, y, tile_size, format_):
     h1 = min(tile_size, h - y)
     tile = im.crop([x, y, x + w1, y + h1])
     return compress_and_serialize(tile, format_)
+
+
+
+def _get_axis_window(size, out_size):
+    """Get the (destination, source) slices of an axis of an image centered
+    in the output, cropping the source if it is larger"""
+    # Same placement as ImageStack._expand_image, where PIL crops the
+    # image pasted at a negative offset
+    offset = (out_size - size) >> 1
+    if offset >= 0:
+        return slice(offset, offset + size), slice(0, size)
+    return slice(0, out_size), slice(-offset, -offset + out_size)
+
+
+def get_paste_window(width, height, out_width, out_height):
+    """Get the (destination, source) windows, as (rows, columns) slices, of
+    an image of the given size centered in the output"""
+    (dst_y, src_y) = _get_axis_window(height, out_height)
+    (dst_x, src_x) = _get_axis_window(width, out_width)
+    return (dst_y, dst_x), (src_y, src_x)
+
+
+def pad_borders(out, width, height, padding_value=0):
+    """Fill the borders of *out* around a centered area of the given size
+    with the padding value, returning the (unfilled) area as a view. The
+    area is cropped to *out* if the size is larger."""
+    out_h, out_w = out.shape
+    (dst_y, dst_x), _ = get_paste_window(width, height, out_w, out_h)
+    out[:dst_y.start] = padding_value
+    out[dst_y.stop:] = padding_value
+    out[dst_y, :dst_x.start] = padding_value
+    out[dst_y, dst_x.stop:] = padding_value
+    return out[dst_y, dst_x]
+
+
+def pad_array(data, out, padding_value=0):
+    """Copy a 2D array centered into *out*, filling only the borders around
+    it with the padding value, or cropping it if it is larger"""
+    h, w = data.shape
+    _, src = get_paste_window(w, h, out.shape[1], out.shape[0])
+    pad_borders(out, w, h, padding_value)[:] = data[src]
+    return out
@@ -0,0 +1,155 @@
+# BBIC instrumentation
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import json
+import threading
+import time
+from .tracing import get_tracer
+
+
+_tracer = get_tracer()
+
+
+class _NullTimer:
+    """Timer doing nothing, used while the instrumentation is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """Context manager adding its duration to a stage"""
+
+    __slots__ = ['instrumentation', 'name', 'start']
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        self.instrumentation.add_time(self.name, end - self.start)
+        _tracer.add_span(self.name, self.start, end)
+        return False
+
+
+class Instrumentation:
+    """Timers and counters of the processing stages of one process.
+
+    While disabled, timer() returns a shared no-op context manager and
+    count() returns immediately, so the instrumentation can stay in the
+    hot paths. Timed stages are also recorded by the tracer while it is
+    enabled."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.times = {}  # stage -> [count, seconds]
+        self.counters = {}
+
+    def timer(self, name):
+        """Get a context manager measuring the time spent in a stage"""
+        if not self.enabled and not _tracer.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        """Add the duration of one execution of a stage"""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.times.get(name)
+            if entry is None:
+                self.times[name] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    def count(self, name, value=1):
+        """Increment a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        """Clear all the timers and counters"""
+        with self._lock:
+            self.times = {}
+            self.counters = {}
+
+    def get_stats(self):
+        """Get the timers and counters of this process as a dictionary"""
+        with self._lock:
+            return {'times': dict((name, {'count': entry[0], 'seconds': entry[1]})
+                                  for name, entry in self.times.items()),
+                    'counters': dict(self.counters)}
+
+    def gather(self, mpi_comm=None):
+        """Get the statistics of all MPI processes, ordered by rank, on rank 0
+        (None on the other ranks)"""
+        stats = self.get_stats()
+        if mpi_comm is None:
+            return [stats]
+        return mpi_comm.gather(stats, root=0)
+
+
+def format_report(all_stats):
+    """Format the statistics of all processes as a table of the stages,
+    slowest first, with the time of the slowest process"""
+    num_ranks = len(all_stats)
+    names = set()
+    for stats in all_stats:
+        names.update(stats['times'].keys())
+    rows = []
+    for name in names:
+        times = [stats['times'].get(name, {'count': 0, 'seconds': 0.0}) for stats in all_stats]
+        total = sum(t['seconds'] for t in times)
+        count = sum(t['count'] for t in times)
+        slowest = max(t['seconds'] for t in times)
+        rows.append((total, name, count, slowest))
+    rows.sort(reverse=True)
+
+    lines = ['Timings over %d process(es):' % num_ranks,
+             '%-18s %10s %12s %12s %12s %10s' % ('stage', 'count', 'total s', 'mean ms',
+                                                 'max rank s', 'imbalance')]
+    for total, name, count, slowest in rows:
+        mean_rank = total / num_ranks
+        lines.append('%-18s %10d %12.3f %12.3f %12.3f %10.2f' %
+                     (name, count, total, 1000 * total / max(count, 1), slowest,
+                      slowest / mean_rank if mean_rank > 0 else 1.0))
+
+    counters = {}
+    for stats in all_stats:
+        for name, value in stats['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    for name in sorted(counters.keys()):
+        lines.append('%-18s %10d' % (name, counters[name]))
+    return '\n'.join(lines)
+
+
+def export_json(all_stats, filename):
+    """Write the statistics of all processes, by rank, to a JSON file"""
+    with open(filename, 'w') as f:
+        json.dump({'ranks': all_stats}, f, indent=1, sort_keys=True)
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    """Get the instrumentation of this process"""
+    return _instrumentation
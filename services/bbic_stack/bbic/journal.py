@@ -0,0 +1,89 @@
+# BBIC write journal
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import numpy as np
+
+# Dataset of the number of leading slices complete, for live readers
+WATERMARK_NAME = 'slices_complete'
+
+
+class WriteJournal:
+    """Per-slice completion bitmap of a stack being written, stored as a
+    dataset of packed bits so that an interrupted write can be resumed"""
+
+    def __init__(self, group, name, num_slices, writer=True):
+        assert isinstance(num_slices, int)
+        assert isinstance(writer, bool)
+
+        self.num_slices = num_slices
+        self.writer = writer  # only one MPI process writes the bitmap
+        self._completed = np.zeros(num_slices, dtype=bool)
+        self.watermark = None
+        if name in group:
+            self.dataset = group[name]
+            bits = np.unpackbits(self.dataset[:])[:num_slices].astype(bool)
+            self._completed[:len(bits)] = bits
+            if self.dataset.shape[0] < self._num_bytes():
+                self.dataset.resize((self._num_bytes(),))
+        else:
+            self.dataset = group.create_dataset(name, (self._num_bytes(),), np.uint8,
+                                                maxshape=(None,), chunks=True)
+
+    def __str__(self):
+        return "WriteJournal %d/%d slices complete" % (self.get_complete_count(), self.num_slices)
+
+    def _num_bytes(self):
+        return (self.num_slices + 7) >> 3
+
+    def is_complete(self, slice_index):
+        """Check if a slice has been written completely"""
+        return bool(self._completed[slice_index])
+
+    def get_complete_count(self):
+        """Get the number of completed slices"""
+        return int(np.count_nonzero(self._completed))
+
+    def get_watermark(self):
+        """Get the number of leading slices that are all complete"""
+        if self._completed.all():
+            return self.num_slices
+        return int(np.argmin(self._completed))
+
+    def create_watermark(self, group):
+        """Publish the watermark in a dataset of the group on each commit(),
+        for readers of a file written in SWMR mode"""
+        self.watermark = group.require_dataset(WATERMARK_NAME, (1,), np.int64)
+
+    def get_pending(self, start_offset=0):
+        """Get the indices of the slices still to be written"""
+        return [int(i) for i in np.flatnonzero(~self._completed[start_offset:]) + start_offset]
+
+    def mark_complete(self, slice_indices):
+        """Mark slices as complete, they will be stored on the next commit()"""
+        self._completed[list(slice_indices)] = True
+
+    def reset(self):
+        """Mark all the slices as incomplete"""
+        self._completed[:] = False
+
+    def grow(self, num_slices):
+        """Extend the journal to a larger number of slices"""
+        assert isinstance(num_slices, int)
+        if num_slices > self.num_slices:
+            self._completed = np.concatenate([self._completed,
+                                              np.zeros(num_slices - self.num_slices, dtype=bool)])
+            self.num_slices = num_slices
+            self.dataset.resize((self._num_bytes(),))
+
+    def commit(self):
+        """Write the bitmap to the file.
+
+        The tiles of the slices marked complete must have been flushed to
+        disk before, and the file flushed again afterwards."""
+        if self.writer:
+            self.dataset[:] = np.packbits(self._completed)
+            if self.watermark is not None:
+                self.watermark[0] = self.get_watermark()
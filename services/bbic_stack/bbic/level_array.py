@@ -0,0 +1,96 @@
+# BBIC level array
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import numpy as np
+
+
+def _get_axis_indices(key, length):
+    """Get the indices selected on an axis by an int or a slice, and whether
+    the axis is kept in the result"""
+    if isinstance(key, slice):
+        return np.arange(*key.indices(length)), True
+    index = int(key)
+    if index < 0:
+        index += length
+    if not 0 <= index < length:
+        raise IndexError("index %d is out of bounds for axis with size %d" % (key, length))
+    return np.array([index]), False
+
+
+def _split_axis(indices, tile_size):
+    """Split the selected indices of an axis by tile, as a list of
+    (tile index, output range, indices in the tile). The indices are a
+    monotonic progression, so each tile is a contiguous range of the
+    output."""
+    if len(indices) == 0:
+        return []
+    tiles = indices // tile_size
+    starts = [0] + list(np.flatnonzero(np.diff(tiles)) + 1)
+    stops = starts[1:] + [len(indices)]
+    return [(int(tiles[start]), slice(start, stop),
+             indices[start:stop] - tiles[start] * tile_size)
+            for start, stop in zip(starts, stops)]
+
+
+class LevelArray:
+    """Read-only, NumPy-like [z, y, x] view of a StackLevel.
+
+    Indexing with ints and slices (with any step) only decodes the tiles
+    intersecting the selection, straight into the output array, e.g.
+    level.as_array()[10:20, 512:1024, ::4]."""
+
+    dtype = np.dtype(np.uint8)
+    ndim = 3
+
+    def __init__(self, level, padding_value=0):
+        self.level = level
+        self.padding_value = padding_value
+        self.shape = (level.num_slices, level.height, level.width)
+
+    def __str__(self):
+        return "LevelArray%d %s" % (self.level.index, self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        array = self[:, :, :]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for a %d-dimensional array" % self.ndim)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        for item in key:
+            if not isinstance(item, (slice, int, np.integer)):
+                raise IndexError("only integers and slices are valid indices")
+
+        axes = [_get_axis_indices(item, length) for item, length in zip(key, self.shape)]
+        (z, _), (y, _), (x, _) = axes
+        out = np.empty((len(z), len(y), len(x)), dtype=self.dtype)
+        self.read_into(out, z, y, x)
+        return out[tuple(slice(None) if kept else 0 for _, kept in axes)]
+
+    def read_into(self, out, z, y, x):
+        """Decode the pixels at the given slice, row and column indices (each
+        a monotonic progression) into a (len(z), len(y), len(x)) array"""
+        tile_size = self.level.tile_size
+        rows = _split_axis(y, tile_size)
+        columns = _split_axis(x, tile_size)
+        for out_z, slice_index in enumerate(z):
+            for v, out_y, tile_y in rows:
+                for u, out_x, tile_x in columns:
+                    tile = self.level.get_tile_array(u, v, int(slice_index))
+                    if tile_y.max() >= tile.shape[0] or tile_x.max() >= tile.shape[1]:
+                        # Tiles smaller than their place in the level are
+                        # padded, like in StackLevel.get_image()
+                        padded = np.full((tile_size, tile_size), self.padding_value, dtype=self.dtype)
+                        padded[:tile.shape[0], :tile.shape[1]] = tile
+                        tile = padded
+                    out[out_z, out_y, out_x] = tile[np.ix_(tile_y, tile_x)]
+        return out
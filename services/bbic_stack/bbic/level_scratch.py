@@ -0,0 +1,146 @@
+# BBIC level scratch
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+from PIL import Image
+import numpy as np
+try:
+    from mpi4py import MPI
+except ImportError:
+    pass
+from .image_provider import ImageProvider
+from .pyramid import downsample
+
+
+class LevelScratch(ImageProvider):
+    """Level 1 of all the slices of a stack, reduced tile by tile from level 0
+    tiles into a memory-mapped scratch file, then read slice by slice to
+    build the other levels.
+
+    The 2x reductions only combine pixels of the same tile (tiles start at
+    even positions), so the result is the same as reducing whole slices.
+
+    With MPI, the file (on a file system shared by all the MPI processes) is
+    written and read through MPI-IO instead of being memory-mapped, since
+    the pages cached by each node are not kept coherent by file systems such
+    as NFS. The reduced tiles are then stored one after the other, each in a
+    slot of (tile_size / 2)^2 bytes written at once, and a slice is read at
+    once before its tiles are assembled."""
+
+    def __init__(self, filename, stack, interp='linear', padding_value=0, mpi_comm=None,
+                 create=True):
+        """Create the scratch file of a stack, or open an existing one to add
+        tiles from another process"""
+        if stack.tile_size % 2 != 0:
+            raise ValueError("The tile size must be even to reduce tiles")
+        self.filename = filename
+        self.tile_size = stack.tile_size
+        self.interp = interp
+        self.padding_value = padding_value
+        self.mpi_comm = mpi_comm
+        self.level0_width = stack.width
+        self.level0_height = stack.height
+        self.width = stack.width >> 1
+        self.height = stack.height >> 1
+        self.num_slices = stack.num_slices
+        shape = (self.num_slices, self.height, self.width)
+
+        self.data = None
+        self._mpi_file = None
+        if mpi_comm is not None:
+            amode = MPI.MODE_RDWR | (MPI.MODE_CREATE if create else 0)
+            self._mpi_file = MPI.File.Open(mpi_comm, filename, amode)
+            half_tile = self.tile_size >> 1
+            self._num_x_tiles = -(-stack.width // self.tile_size)
+            self._num_y_tiles = -(-stack.height // self.tile_size)
+            # (v, u) tile slots of a slice
+            self._tiles = np.empty((self._num_y_tiles, self._num_x_tiles, half_tile, half_tile),
+                                   dtype=np.uint8)
+            if create:
+                self._mpi_file.Set_size(max(self.num_slices * self._tiles.size, 1))
+            self._reduced = np.empty((half_tile, half_tile), dtype=np.uint8)
+            self._slice = np.empty((self.height, self.width), dtype=np.uint8)
+        else:
+            if create:
+                with open(filename, 'wb') as f:
+                    f.truncate(max(int(np.prod(shape)), 1))
+            self.data = np.memmap(filename, np.uint8, 'r+', shape=shape)
+        self._accumulator = np.empty((self.tile_size >> 1, self.tile_size >> 1), dtype=np.uint16)
+        self._cell = np.empty((self.tile_size, self.tile_size), dtype=np.uint8)
+
+    def __str__(self):
+        return "LevelScratch %s [%d, %d, %d]" % (self.filename, self.width,
+                                                 self.height, self.num_slices)
+
+    def add_tile(self, data, u, v, slice_index):
+        """Reduce a (height, width) level 0 tile into the scratch"""
+        assert isinstance(u, int)
+        assert isinstance(v, int)
+        assert isinstance(slice_index, int)
+
+        height = min(self.tile_size, self.level0_height - v * self.tile_size)
+        width = min(self.tile_size, self.level0_width - u * self.tile_size)
+        if data.shape != (height, width):
+            # Tiles that do not match their place in the level are cropped or
+            # padded, like when the slices are read back
+            cell = self._cell[:height, :width]
+            cell.fill(self.padding_value)
+            data = data[:height, :width]
+            cell[:data.shape[0], :data.shape[1]] = data
+            data = cell
+
+        if self._mpi_file is None:
+            x = (u * self.tile_size) >> 1
+            y = (v * self.tile_size) >> 1
+            dst = self.data[slice_index, y:y + (height >> 1), x:x + (width >> 1)]
+            downsample(data, dst, self.interp, self._accumulator[:dst.shape[0], :dst.shape[1]])
+            return
+        dst = self._reduced[:height >> 1, :width >> 1]
+        downsample(data, dst, self.interp, self._accumulator[:dst.shape[0], :dst.shape[1]])
+        slot = (slice_index * self._num_y_tiles + v) * self._num_x_tiles + u
+        self._mpi_file.Write_at(slot * self._reduced.size, self._reduced)
+
+    def sync(self):
+        """Write the reduced tiles to the file and wait for all processes, so
+        that every process can read all the slices"""
+        if self._mpi_file is None:
+            self.data.flush()
+            return
+        # MPI-IO sync-barrier-sync, making the writes of all the processes
+        # visible to the reads of the others
+        self._mpi_file.Sync()
+        self.mpi_comm.barrier()
+        self._mpi_file.Sync()
+
+    def get_dimensions(self):
+        """Get the dimensions of the level"""
+        return self.width, self.height, self.num_slices
+
+    def get_array(self, slice_index, padding_value=0):
+        """Get a slice of the level as a view of the file, or read into a
+        reused buffer with MPI"""
+        if self._mpi_file is None:
+            return self.data[slice_index]
+        self._mpi_file.Read_at(slice_index * self._tiles.size, self._tiles)
+        half_tile = self.tile_size >> 1
+        tiles = self._tiles.transpose((0, 2, 1, 3)).reshape((self._num_y_tiles * half_tile,
+                                                            self._num_x_tiles * half_tile))
+        self._slice[:] = tiles[:self.height, :self.width]
+        return self._slice
+
+    def get_image(self, slice_index, padding_value=0):
+        """Get a slice of the level"""
+        return Image.fromarray(np.array(self.get_array(slice_index)))
+
+    def close(self):
+        """Release the memory map and remove the scratch file"""
+        self.data = None
+        if self._mpi_file is not None:
+            self._mpi_file.Close()
+            self._mpi_file = None
+            self.mpi_comm.barrier()
+        if self.mpi_comm is None or self.mpi_comm.Get_rank() == 0:
+            os.remove(self.filename)
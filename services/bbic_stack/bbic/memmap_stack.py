@@ -0,0 +1,133 @@
+# BBIC memory-mapped image stack readers
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+from PIL import Image
+import numpy as np
+from .image_provider import ImageProvider
+from .image_stack import ImageStack
+from .image_utils import pad_array, pad_borders
+from .instrumentation import get_instrumentation
+
+
+class RawStack(ImageProvider):
+    """Stack of 8-bit slices stored in a single .npy or .raw file, read
+    through a memory map so that slices are views of the page cache"""
+
+    def __init__(self, filename, width=None, height=None, offset=0):
+        """Open a .npy file of shape (num_slices, height, width), or a .raw
+        file of headerless slices of the given width and height starting at
+        *offset* bytes (the number of slices is deduced from the file size)."""
+        self.filename = filename
+        if os.path.splitext(filename)[1] == '.npy':
+            self.volume = np.load(filename, mmap_mode='r')
+            if self.volume.ndim != 3 or self.volume.dtype != np.uint8:
+                raise ValueError("%s is not a 3D uint8 array" % filename)
+        else:
+            if width is None or height is None:
+                raise ValueError("The slice width and height of %s must be given" % filename)
+            assert isinstance(width, int)
+            assert isinstance(height, int)
+            assert isinstance(offset, int)
+            num_slices = (os.path.getsize(filename) - offset) // (width * height)
+            if num_slices <= 0:
+                raise ValueError("%s is smaller than one %dx%d slice" % (filename, width, height))
+            self.volume = np.memmap(filename, np.uint8, 'r', offset,
+                                    (num_slices, height, width))
+        self.num_slices, self.height, self.width = (int(x) for x in self.volume.shape)
+        self._padding_buffer = None
+
+    def __str__(self):
+        return "RawStack %s [%d, %d, %d]" % (self.filename, self.width,
+                                             self.height, self.num_slices)
+
+    def get_dimensions(self):
+        """Get the dimensions of the stack"""
+        return self.width, self.height, self.num_slices
+
+    def get_array(self, index, padding_value=0):
+        """Get a slice as a read-only view, or padded into a reused buffer if
+        the stack dimensions have been enlarged"""
+        data = self.volume[index]
+        if data.shape == (self.height, self.width):
+            return data
+        if self._padding_buffer is None or self._padding_buffer.shape != (self.height, self.width):
+            self._padding_buffer = np.empty((self.height, self.width), dtype=np.uint8)
+        with get_instrumentation().timer('pad'):
+            return pad_array(data, self._padding_buffer, padding_value)
+
+    def get_image(self, index, padding_value=0):
+        """Get a slice, padded to the stack dimensions"""
+        return Image.fromarray(np.array(self.get_array(index, padding_value)))
+
+
+def get_tiff_strips(im):
+    """Get the (offset, extent, row_bytes) of the raw strips or tiles of the
+    current page of an opened TIFF image, or None if it is not uncompressed
+    8-bit grayscale"""
+    if im.format != 'TIFF' or im.mode != 'L':
+        return None
+    strips = []
+    for decoder, extent, offset, args in im.tile:
+        if decoder != 'raw' or args[0] != 'L':
+            return None
+        row_bytes = args[1] or extent[2] - extent[0]
+        strips.append((offset, extent, row_bytes))
+    return strips
+
+
+def get_contiguous_offset(size, strips):
+    """Get the file offset of a page stored as one contiguous block of rows,
+    or None if its strips are scattered or tiled"""
+    width = size[0]
+    first_offset = strips[0][0]
+    if all(extent[0] == 0 and extent[2] == width and row_bytes == width and
+           offset == first_offset + extent[1] * width
+           for offset, extent, row_bytes in strips):
+        return first_offset
+    return None
+
+
+def copy_tiff_strips(data, strips, out):
+    """Copy raw strips or tiles from the bytes of a TIFF file into a
+    (height, width) array"""
+    for offset, (x0, y0, x1, y1), row_bytes in strips:
+        # The last strip may be truncated, the tiles are not
+        num_bytes = min((y1 - y0) * row_bytes, len(data) - offset)
+        part = data[offset:offset + num_bytes].reshape((-1, row_bytes))
+        out[y0:y0 + part.shape[0], x0:x1] = part[:, :x1 - x0]
+    return out
+
+
+class TiffStack(ImageStack):
+    """Image stack reader mapping the strips (or tiles) of uncompressed 8-bit
+    TIFF slices directly into memory. Other slices are decoded by PIL."""
+
+    def get_array(self, index, padding_value=0):
+        """Get a slice as an array, padded to the stack dimensions.
+
+        Contiguous strips of full slices are returned as a read-only view of
+        the file, others are copied once into the padding buffer."""
+        filename = self.filenames[index]
+        with Image.open(filename) as im:
+            size = im.size
+            strips = get_tiff_strips(im)
+        if strips is None:
+            return ImageStack.get_array(self, index, padding_value)
+
+        data = np.memmap(filename, np.uint8, 'r')
+        offset = get_contiguous_offset(size, strips)
+        if offset is not None:
+            width, height = size
+            return self._pad(data[offset:offset + width * height].reshape((height, width)),
+                             padding_value)
+        if size[0] > self.width or size[1] > self.height:
+            # Cropped like the images decoded by PIL
+            page = copy_tiff_strips(data, strips, np.empty((size[1], size[0]), dtype=np.uint8))
+            return self._pad(page, padding_value)
+        copy_tiff_strips(data, strips, pad_borders(self._get_padding_buffer(), size[0], size[1],
+                                                   padding_value))
+        return self._padding_buffer
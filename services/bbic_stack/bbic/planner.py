@@ -0,0 +1,318 @@
+# BBIC write planner
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import math
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+from .stack import Stack
+from .pyramid import Pyramid
+from .codecs import get_codec
+
+# Approximate memory used by the interpreter, numpy, h5py and PIL
+BASELINE_MEMORY_BYTES = 150 * 1000 * 1000
+# Minimum parallel efficiency of a recommended number of processes
+MIN_EFFICIENCY = 0.5
+
+
+def _create_stack(group, index, width, height, num_slices, tile_size, generate_lods):
+    """Create the geometry of a stack in a (scratch) group"""
+    stack = Stack(group.create_group('%d' % index), index)
+    stack.width, stack.height, stack.num_slices = width, height, num_slices
+    stack.tile_size = tile_size
+    stack.write_attrs()
+    stack.create_levels(False, generate_lods)
+    return stack
+
+
+def _format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1000:
+            return '%.1f %s' % (num_bytes, unit)
+        num_bytes /= 1000.0
+    return '%.1f TB' % num_bytes
+
+
+def _format_seconds(seconds):
+    if seconds < 120:
+        return '%.0f s' % seconds
+    if seconds < 2 * 3600:
+        return '%.1f min' % (seconds / 60)
+    return '%.1f h' % (seconds / 3600)
+
+
+class LevelSample:
+    """Tile statistics of one level, measured on sample slices"""
+
+    def __init__(self, level):
+        self.level = level
+        self.num_tiles = 0
+        self.num_uniform_tiles = 0
+        self.uniform_values = set()
+        self.encoded_bytes = 0
+        self.encoded_pixels = 0
+        self.encode_seconds = 0.0
+
+    def get_uniform_fraction(self):
+        return float(self.num_uniform_tiles) / max(self.num_tiles, 1)
+
+    def get_bytes_per_pixel(self, header_bytes=0):
+        """Get the encoded bytes per pixel, excluding the tile headers"""
+        payload = self.encoded_bytes - header_bytes * (self.num_tiles - self.num_uniform_tiles)
+        return max(payload, 0) / float(max(self.encoded_pixels, 1))
+
+
+class StackPlan:
+    """Predicted tiles, datasets and bytes of a stack, per level"""
+
+    def __init__(self, name, stack, samples, header_bytes, dataset_bytes, group_bytes):
+        self.name = name
+        self.width, self.height, self.num_slices = stack.get_dimensions()
+        self.levels = []
+        for l in range(stack.num_levels):
+            level = stack.get_level(l)
+            nx, ny, _ = level.get_block_count()
+            num_tiles = nx * ny * self.num_slices
+            sample = samples[min(l, len(samples) - 1)]
+            uniform_fraction = sample.get_uniform_fraction()
+            num_encoded = int(round(num_tiles * (1 - uniform_fraction)))
+            num_datasets = num_encoded + len(sample.uniform_values)
+            # One group per slice and per tile column of a slice
+            num_groups = self.num_slices * (1 + nx)
+            pixels = level.width * level.height * self.num_slices * (1 - uniform_fraction)
+            # The tiles of the resliced stacks have other shapes, so the size
+            # is predicted from the pixels and a fixed header per tile
+            self.levels.append({'level': l, 'num_x_tiles': nx, 'num_y_tiles': ny,
+                                'num_tiles': num_tiles, 'num_datasets': num_datasets,
+                                'bytes': pixels * sample.get_bytes_per_pixel(header_bytes) +
+                                num_encoded * header_bytes + num_datasets * dataset_bytes +
+                                num_groups * group_bytes})
+
+    def get_total(self, key):
+        return sum(level[key] for level in self.levels)
+
+    def __str__(self):
+        lines = ['%s [%d, %d, %d]: %d tiles, %d datasets, %s' %
+                 (self.name, self.width, self.height, self.num_slices,
+                  self.get_total('num_tiles'), self.get_total('num_datasets'),
+                  _format_bytes(self.get_total('bytes')))]
+        for level in self.levels:
+            lines.append('  level %(level)d: (%(num_x_tiles)d, %(num_y_tiles)d) tiles/slice, '
+                         '%(num_tiles)d tiles, %(num_datasets)d datasets, ' % level +
+                         _format_bytes(level['bytes']))
+        return '\n'.join(lines)
+
+
+class WritePlan:
+    """Prediction of the output size, memory and runtime of a stack write,
+    extrapolated from a few sample slices"""
+
+    def __init__(self, image_source, tile_size, codec, interp='linear', padding_value=255,
+                 num_samples=4, all_stacks=False, generate_lods=True, dedup=True,
+                 output_dir='.'):
+        assert isinstance(tile_size, int)
+        assert isinstance(num_samples, int)
+        assert isinstance(all_stacks, bool)
+        assert isinstance(generate_lods, bool)
+        assert isinstance(dedup, bool)
+
+        self.codec = get_codec(codec)
+        self.all_stacks = all_stacks
+        self.width, self.height, self.num_slices = image_source.get_dimensions()
+        self.tile_size = tile_size
+        self.stacks = []
+
+        self.dataset_seconds, self.dataset_bytes, self.group_bytes = \
+            _measure_dataset_creation(output_dir)
+        self.header_bytes = len(self.codec.encode(np.zeros((1, 1), dtype=np.uint8)))
+
+        # The stack geometry comes from the Stack code itself, in memory
+        scratch = h5py.File('plan.h5', 'w', driver='core', backing_store=False)
+        stack = _create_stack(scratch, 2, self.width, self.height, self.num_slices,
+                              tile_size, generate_lods)
+        # make_all_stacks() deals the blocks of level 0 to the processes
+        nx, ny, nz = stack.get_level(0).get_block_count()
+        self.num_blocks = nx * ny * nz if all_stacks else 0
+        self._sample(image_source, stack, interp, padding_value, num_samples, dedup)
+        self.stacks.append(StackPlan('source stack', stack, self.samples,
+                                     self.header_bytes, self.dataset_bytes,
+                                     self.group_bytes))
+        if all_stacks:
+            # Resliced stacks, from a sagittal source (see File.make_all_stacks)
+            for index, (width, height, num_slices) in enumerate([
+                    (self.num_slices, self.height, self.width),
+                    (self.width, self.num_slices, self.height)]):
+                derived = _create_stack(scratch, index, width, height, num_slices,
+                                        tile_size, generate_lods)
+                self.stacks.append(StackPlan('resliced stack %d' % index, derived, self.samples,
+                                             self.header_bytes, self.dataset_bytes,
+                                             self.group_bytes))
+        scratch.close()
+
+        self._estimate_runtime()
+        self._estimate_memory()
+
+    def _sample(self, image_source, stack, interp, padding_value, num_samples, dedup):
+        """Decode, downsample and encode sample slices, measuring the time
+        spent and the tiles produced for each level"""
+        num_samples = max(1, min(num_samples, self.num_slices))
+        indices = [int((i + 0.5) * self.num_slices / num_samples) for i in range(num_samples)]
+        pyramid = Pyramid(self.width, self.height, stack.num_levels, self.tile_size, interp)
+        self.samples = [LevelSample(l) for l in range(stack.num_levels)]
+        self.read_seconds = self.pyramid_seconds = self.tile_decode_seconds = 0.0
+        level0_tiles = []
+        for index in indices:
+            start = time.time()
+            data = np.array(image_source.get_array(index, padding_value))
+            self.read_seconds += time.time() - start
+
+            start = time.time()
+            pyramid.build(data)
+            self.pyramid_seconds += time.time() - start
+
+            for l, sample in enumerate(self.samples):
+                nx, ny = pyramid.get_tile_count(l)
+                for v in range(ny):
+                    for u in range(nx):
+                        tile = pyramid.get_tile(l, u, v)
+                        sample.num_tiles += 1
+                        if dedup and tile.min() == tile.max():
+                            sample.num_uniform_tiles += 1
+                            sample.uniform_values.add((int(tile[0, 0]), tile.shape))
+                            continue
+                        start = time.time()
+                        encoded = self.codec.encode(tile)
+                        sample.encode_seconds += time.time() - start
+                        sample.encoded_bytes += len(encoded)
+                        sample.encoded_pixels += tile.size
+                        if l == 0:
+                            level0_tiles.append(encoded)
+
+        # Reslicing reads back the level 0 tiles
+        start = time.time()
+        for tile in level0_tiles:
+            self.codec.decode(tile)
+        self.tile_decode_seconds = time.time() - start
+        self.num_samples = num_samples
+
+    def _estimate_runtime(self):
+        """Extrapolate the compute time (divided among MPI processes) and
+        the dataset creation time (done by every MPI process)"""
+        pixels = float(self.width * self.height * self.num_samples)
+        level0 = self.samples[0]
+        encode_seconds = sum(sample.encode_seconds for sample in self.samples)
+        lod_encode_per_pixel = (encode_seconds - level0.encode_seconds) / pixels
+        encode_per_pixel = level0.encode_seconds / max(level0.encoded_pixels, 1)
+        decode_per_pixel = self.tile_decode_seconds / max(level0.encoded_pixels, 1)
+        pyramid_per_pixel = self.pyramid_seconds / pixels
+
+        per_slice = (self.read_seconds + self.pyramid_seconds + encode_seconds) / self.num_samples
+        self.source_seconds = per_slice * self.num_slices
+        self.reslice_seconds = 0.0
+        if self.all_stacks:
+            voxels = float(self.width * self.height * self.num_slices)
+            # Level 0: read the source blocks once, encode both stacks
+            self.reslice_seconds = voxels * (decode_per_pixel + 2 * encode_per_pixel)
+            # Levels 1-n: read back level 0 of both stacks and downsample
+            self.reslice_seconds += 2 * voxels * (decode_per_pixel + pyramid_per_pixel +
+                                                  lod_encode_per_pixel)
+        self.num_datasets = sum(stack.get_total('num_datasets') for stack in self.stacks)
+        self.allocate_seconds = self.num_datasets * self.dataset_seconds
+
+    def get_runtime(self, num_processes):
+        """Get the predicted runtime in seconds with the given number of MPI
+        processes, which work in rounds of one slice (or block) each"""
+        assert isinstance(num_processes, int)
+        rounds = math.ceil(float(self.num_slices) / num_processes)
+        source_seconds = self.source_seconds * rounds / self.num_slices
+        reslice_seconds = self.reslice_seconds / max(min(num_processes, self.num_blocks), 1)
+        return source_seconds + reslice_seconds + self.allocate_seconds
+
+    def get_recommended_processes(self, max_processes=4096):
+        """Get the largest power-of-two number of MPI processes keeping a
+        parallel efficiency of at least MIN_EFFICIENCY"""
+        serial = self.get_runtime(1)
+        recommended = 1
+        num_processes = 2
+        while num_processes <= min(max_processes, self.get_max_processes()):
+            efficiency = serial / (num_processes * self.get_runtime(num_processes))
+            if efficiency < MIN_EFFICIENCY:
+                break
+            recommended = num_processes
+            num_processes *= 2
+        return recommended
+
+    def get_max_processes(self):
+        """Get the number of MPI processes beyond which none has work"""
+        return max(self.num_slices, self.num_blocks)
+
+    def _estimate_memory(self):
+        """Estimate the peak memory of an MPI process"""
+        slice_bytes = self.width * self.height
+        level0 = self.samples[0]
+        encoded_slice = level0.encoded_bytes / float(self.num_samples) * 4 / 3
+        # Source image, padded slice, pyramid levels and uint16 scratch
+        write_bytes = 2 * slice_bytes + slice_bytes / 3 + slice_bytes / 2 + encoded_slice
+        if self.all_stacks:
+            block_bytes = self.tile_size ** 3
+            # Block, transposed tiles and the pyramid of the resliced slices
+            reslice_bytes = 2 * block_bytes + 2 * block_bytes * level0.get_bytes_per_pixel(self.header_bytes)
+            largest_slice = max(self.num_slices * self.height, self.width * self.num_slices)
+            write_bytes = max(write_bytes, reslice_bytes, 2.5 * largest_slice)
+        self.peak_memory_bytes = BASELINE_MEMORY_BYTES + write_bytes
+
+    def __str__(self):
+        lines = ['Write plan (%d sample slices, %s tiles of %d pixels):' %
+                 (self.num_samples, self.codec.name, self.tile_size)]
+        lines += [str(stack) for stack in self.stacks]
+        total_bytes = sum(stack.get_total('bytes') for stack in self.stacks)
+        lines.append('Total: %d datasets, %s' % (self.num_datasets, _format_bytes(total_bytes)))
+        lines.append('Measured per slice: read %.3f s, downsample %.3f s, encode %.3f s' %
+                     (self.read_seconds / self.num_samples, self.pyramid_seconds / self.num_samples,
+                      sum(s.encode_seconds for s in self.samples) / self.num_samples))
+        lines.append('Dataset creation: %.2f ms each, %s in total (not parallel)' %
+                     (self.dataset_seconds * 1000, _format_seconds(self.allocate_seconds)))
+        lines.append('Metadata: %d bytes per dataset, %d bytes per group' %
+                     (self.dataset_bytes, self.group_bytes))
+        lines.append('Peak memory per process: %s' % _format_bytes(self.peak_memory_bytes))
+        num_processes = 1
+        recommended = self.get_recommended_processes()
+        while num_processes <= recommended * 2 and num_processes <= self.get_max_processes():
+            lines.append('  %5d processes: %s%s' % (num_processes,
+                                                    _format_seconds(self.get_runtime(num_processes)),
+                                                    ' (recommended)' if num_processes == recommended
+                                                    else ''))
+            num_processes *= 2
+        return '\n'.join(lines)
+
+
+def _measure_dataset_creation(directory, num_slices=16, num_tiles=4, size=4096):
+    """Measure the time to create and write a tile dataset in a file of the
+    given directory, and the size of the metadata of a dataset and of a
+    group (with the slice/u/v layout of the tiles)"""
+    data = np.zeros(size, dtype=np.uint8)
+    count = num_slices * num_tiles * num_tiles
+    file_sizes = []
+    for grouped in [False, True]:
+        handle, filename = tempfile.mkstemp('.h5', '.bbic_plan_', directory or '.')
+        os.close(handle)
+        try:
+            with h5py.File(filename, 'w') as h5file:
+                start = time.time()
+                for i in range(count):
+                    name = '%d/%d/%d' % (i // num_tiles ** 2, (i // num_tiles) % num_tiles,
+                                         i % num_tiles) if grouped else '%d' % i
+                    h5file.create_dataset(name, data=data)
+                h5file.flush()
+                seconds = (time.time() - start) / count
+            file_sizes.append(os.path.getsize(filename))
+        finally:
+            os.remove(filename)
+    dataset_bytes = max((file_sizes[0] - count * size) // count, 0)
+    group_bytes = max((file_sizes[1] - file_sizes[0]) // (num_slices * (1 + num_tiles)), 0)
+    return seconds, int(dataset_bytes), int(group_bytes)
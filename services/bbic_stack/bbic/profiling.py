@@ -0,0 +1,136 @@
+# BBIC profiling
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+
+PROFILE_FILENAME = 'rank_%d.prof'
+SNAPSHOT_FILENAME = 'rank_%d.tracemalloc'
+MERGED_FILENAME = 'merged.prof'
+REPORT_FILENAME = 'report.txt'
+# Seconds between two checks of the traced memory for a new peak
+MEMORY_POLL_INTERVAL = 0.5
+
+
+class Profiler:
+    """cProfile (and optionally tracemalloc) profiler of one MPI process.
+
+    Every process writes its statistics to the output directory, then
+    rank 0 merges them into a single pstats file and a text report of the
+    top functions and allocation sites. Only the main thread is profiled.
+
+    With *trace_memory*, a background thread takes a tracemalloc snapshot
+    whenever the traced memory grows 10% above the last snapshot, so the
+    allocation sites are those holding memory at the peak."""
+
+    def __init__(self, directory, mpi_comm=None, trace_memory=False, num_frames=10, top=30):
+        assert isinstance(trace_memory, bool)
+        assert isinstance(num_frames, int)
+        assert isinstance(top, int)
+
+        self.directory = directory
+        self.mpi_comm = mpi_comm
+        self.mpi_size = 1 if mpi_comm is None else mpi_comm.Get_size()
+        self.mpi_rank = 0 if mpi_comm is None else mpi_comm.Get_rank()
+        self.trace_memory = trace_memory
+        self.num_frames = num_frames
+        self.top = top
+        self.peak_memory = 0
+        self._profile = cProfile.Profile()
+        self._peak_snapshot = None
+        self._stop_polling = threading.Event()
+        self._poll_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        self.save()
+        return False
+
+    def start(self):
+        """Start recording"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.trace_memory:
+            tracemalloc.start(self.num_frames)
+            self._poll_thread = threading.Thread(target=self._poll_memory)
+            self._poll_thread.daemon = True
+            self._poll_thread.start()
+        self._profile.enable()
+
+    def _poll_memory(self):
+        """Snapshot the allocations when the traced memory reaches a new peak"""
+        snapshot_size = 0
+        while not self._stop_polling.wait(MEMORY_POLL_INTERVAL):
+            current = tracemalloc.get_traced_memory()[0]
+            if current > snapshot_size * 1.1:
+                self._peak_snapshot = tracemalloc.take_snapshot()
+                snapshot_size = current
+
+    def stop(self):
+        """Stop recording and write the statistics of this process"""
+        self._profile.disable()
+        self._profile.dump_stats(self._get_filename(PROFILE_FILENAME, self.mpi_rank))
+        if self.trace_memory:
+            self._stop_polling.set()
+            self._poll_thread.join()
+            snapshot = self._peak_snapshot or tracemalloc.take_snapshot()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot.dump(self._get_filename(SNAPSHOT_FILENAME, self.mpi_rank))
+
+    def save(self):
+        """Merge the statistics of all processes on rank 0"""
+        peaks = [self.peak_memory]
+        if self.mpi_comm is not None:
+            peaks = self.mpi_comm.gather(self.peak_memory, root=0)
+        if self.mpi_rank != 0:
+            return
+
+        stats = pstats.Stats(*[self._get_filename(PROFILE_FILENAME, rank)
+                               for rank in range(self.mpi_size)])
+        stats.dump_stats(self._get_filename(MERGED_FILENAME))
+
+        report = io.StringIO()
+        report.write('Profile of %d process(es)\n\n' % self.mpi_size)
+        stats.stream = report
+        for key in ['cumulative', 'tottime']:
+            report.write('Top %d functions by %s time:\n' % (self.top, key))
+            stats.sort_stats(key).print_stats(self.top)
+        if self.trace_memory:
+            report.write(self._get_memory_report(peaks))
+        with open(self._get_filename(REPORT_FILENAME), 'w') as f:
+            f.write(report.getvalue())
+        print('Profile written to', self.directory)
+
+    def _get_memory_report(self, peaks):
+        """Rank the allocation sites holding memory at the peak, over all
+        processes"""
+        sites = {}
+        for rank in range(self.mpi_size):
+            snapshot = tracemalloc.Snapshot.load(self._get_filename(SNAPSHOT_FILENAME, rank))
+            for stat in snapshot.statistics('lineno'):
+                frame = stat.traceback[0]
+                key = (frame.filename, frame.lineno)
+                size, count = sites.get(key, (0, 0))
+                sites[key] = (size + stat.size, count + stat.count)
+
+        lines = ['Peak traced memory per rank: %s' %
+                 ', '.join('%d: %.1f MB' % (rank, peak / 1e6) for rank, peak in enumerate(peaks)),
+                 'Top %d allocation sites (memory held at the peak, all ranks):' % self.top]
+        ranked = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)
+        for (filename, lineno), (size, count) in ranked[:self.top]:
+            lines.append('%12.1f KB %8d blocks  %s:%d' % (size / 1e3, count, filename, lineno))
+        return '\n'.join(lines) + '\n'
+
+    def _get_filename(self, name, rank=None):
+        return os.path.join(self.directory, name if rank is None else name % rank)
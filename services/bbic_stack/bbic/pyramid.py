@@ -0,0 +1,105 @@
+# BBIC slice pyramid
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import numpy as np
+
+INTERPOLATIONS = ['nearest', 'linear']
+
+
+def downsample(src, dst, interp='linear', scratch=None):
+    """Reduce a 2D uint8 array by 2 into *dst* (shape (h >> 1, w >> 1)).
+
+    'nearest' picks the odd pixels like PIL.Image.NEAREST does for a 2x
+    reduction, 'linear' averages each 2x2 block (area/box filter).
+    An optional uint16 *scratch* array of the same shape as *dst* avoids
+    allocating the accumulator."""
+    h, w = dst.shape
+    if h == 0 or w == 0:
+        return dst
+
+    if interp == 'nearest':
+        dst[:] = src[1:2*h:2, 1:2*w:2]
+    elif interp == 'linear':
+        if scratch is None:
+            scratch = np.empty((h, w), dtype=np.uint16)
+        np.add(src[0:2*h:2, 0:2*w:2], src[1:2*h:2, 0:2*w:2], out=scratch, dtype=np.uint16)
+        scratch += src[0:2*h:2, 1:2*w:2]
+        scratch += src[1:2*h:2, 1:2*w:2]
+        scratch += 2
+        scratch >>= 2
+        np.copyto(dst, scratch, casting='unsafe')
+    else:
+        raise ValueError("Invalid interpolation: %s" % interp)
+    return dst
+
+
+class Pyramid:
+    """All resolution levels of a slice, stored in preallocated uint8 arrays"""
+
+    def __init__(self, width, height, num_levels, tile_size, interp='linear'):
+        assert isinstance(width, int)
+        assert isinstance(height, int)
+        assert isinstance(num_levels, int)
+        assert isinstance(tile_size, int)
+        if interp not in INTERPOLATIONS:
+            raise ValueError("Invalid interpolation: %s" % interp)
+
+        self.width = width
+        self.height = height
+        self.num_levels = num_levels
+        self.tile_size = tile_size
+        self.interp = interp
+        # Level 0 is the source image itself, the other levels are reused
+        # for every slice
+        self._buffers = [None] + [np.empty((height >> l, width >> l), dtype=np.uint8)
+                                  for l in range(1, num_levels)]
+        self.levels = list(self._buffers)
+        self._scratch = np.empty((height >> 1, width >> 1), dtype=np.uint16)
+
+    def __str__(self):
+        return "Pyramid [%d, %d], #levels: %d, tile size: %d, interp: %s" % \
+               (self.width, self.height, self.num_levels, self.tile_size, self.interp)
+
+    def build(self, image, level=0):
+        """Compute the levels from a uint8 array of the given level (level 0
+        is (height, width)), the levels below it are left empty.
+
+        The array is used as is without copy, so it must not be modified
+        while the pyramid tiles are in use."""
+        assert isinstance(level, int)
+        image = np.asarray(image)
+        if image.shape != (self.height >> level, self.width >> level):
+            raise ValueError("Image of size %s does not match the pyramid size %s" %
+                             (image.shape, (self.height >> level, self.width >> level)))
+        if image.dtype != np.uint8:
+            raise ValueError("Pyramid images must be of type uint8")
+
+        self.levels = [None] * level + [image] + self._buffers[level + 1:]
+        for l in range(level + 1, self.num_levels):
+            dst = self.levels[l]
+            downsample(self.levels[l-1], dst, self.interp, self._scratch[:dst.shape[0], :dst.shape[1]])
+
+    def get_level(self, level):
+        """Get the array of a level"""
+        assert isinstance(level, int)
+        return self.levels[level]
+
+    def get_tile_count(self, level):
+        """Get the number of tiles (x, y) of a level"""
+        assert isinstance(level, int)
+        h, w = self.levels[level].shape if self.levels[level] is not None else \
+            (self.height >> level, self.width >> level)
+        return -(-w // self.tile_size), -(-h // self.tile_size)
+
+    def get_tile(self, level, u, v):
+        """Get a tile of a level as a view (no copy), cropped at the borders"""
+        assert isinstance(level, int)
+        assert isinstance(u, int)
+        assert isinstance(v, int)
+
+        x = u * self.tile_size
+        y = v * self.tile_size
+        return self.levels[level][y:y + self.tile_size, x:x + self.tile_size]
@@ -0,0 +1,38 @@
+# BBIC reader processes
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import multiprocessing
+
+# Seconds waited for a result before checking that the processes are alive
+POLL_INTERVAL = 1.0
+
+
+def get_worker_context():
+    """Get the multiprocessing context of local worker processes"""
+    # Fresh interpreters, which do not inherit the open HDF5 handles
+    return multiprocessing.get_context('spawn')
+
+
+def get_reader_context(h5file):
+    """Get the multiprocessing context of local processes reading an HDF5
+    file from their own read-only File handle, flushing the file first so
+    that they see all its content.
+
+    HDF5 < 1.10 (h5py 2.x) refuses to open the file in the processes while
+    this one holds it open for writing, the readers are meant for files
+    opened read-only."""
+    if h5file.mode != 'r':
+        h5file.flush()
+    return get_worker_context()
+
+
+def check_processes(processes):
+    """Raise a RuntimeError if one of the processes died, e.g. killed by
+    a signal or out of memory, instead of waiting for its results"""
+    for process in processes:
+        if process.exitcode not in (None, 0):
+            raise RuntimeError("Worker process %d died with exit code %d" %
+                               (process.pid, process.exitcode))
@@ -0,0 +1,153 @@
+# BBIC reslicing worker processes
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import queue
+import traceback
+from .reader_processes import POLL_INTERVAL, check_processes, get_worker_context
+
+# Blocks sent to the workers and not resliced yet, per worker
+QUEUED_BLOCKS_PER_WORKER = 4
+
+
+class LevelGeometry:
+    """Dimensions of a stack level, all the workers need to place and
+    reduce its tiles"""
+
+    def __init__(self, level):
+        self.width = level.width
+        self.height = level.height
+        self.num_slices = level.num_slices
+        self.tile_size = level.tile_size
+        self.num_x_tiles = level.num_x_tiles
+        self.num_y_tiles = level.num_y_tiles
+
+
+def _reslice_blocks(source_index, left_args, upper_args, scratch_filenames, interp,
+                    padding_value, tasks, results):
+    """Worker process: encode the x and y tiles of the blocks sent by the
+    writer and reduce them into the level 1 scratches, sending the encoded
+    tiles back. The workers never open the HDF5 file."""
+    try:
+        from .codecs import get_codec
+        from .data_block import DataBlock
+        from .file import File
+        from .level_scratch import LevelScratch
+
+        (left_l0, left_format, left_options) = left_args
+        (upper_l0, upper_format, upper_options) = upper_args
+        left_codec = get_codec(left_format, **left_options)
+        upper_codec = get_codec(upper_format, **upper_options)
+        scratches = None
+        if scratch_filenames is not None:
+            scratches = [LevelScratch(name, level, interp, padding_value, create=False)
+                         for name, level in zip(scratch_filenames, [left_l0, upper_l0])]
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, u, v, z, tile_size, volume = task
+            block = DataBlock(u, v, z, tile_size)
+            block.wrap(volume)
+            # Each process already runs on its own core, the tiles are
+            # encoded without threads
+            x_tiles = block.to_x_tiles(left_codec, source_index, 1)
+            y_tiles = block.to_y_tiles(upper_codec, source_index, 1)
+            if scratches is not None:
+                File._reduce_block_tiles(block, left_l0, upper_l0, source_index, *scratches)
+            results.put((index, x_tiles, y_tiles))
+
+        if scratches is not None:
+            for scratch in scratches:
+                scratch.data.flush()
+        results.put(None)
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+class ResliceWorkers:
+    """Local processes reslicing the blocks of a stack for make_all_stacks()
+    without MPI, the calling process being the single reader and writer of
+    the file.
+
+    The calling process reads the blocks of the source stack and sends them
+    to the workers, which transpose, encode and reduce them."""
+
+    def __init__(self, num_workers, source_stack, left_stack, upper_stack,
+                 scratches=None, interp='linear', padding_value=0):
+        assert isinstance(num_workers, int)
+        self.num_workers = num_workers
+        self.source_level = source_stack.get_level(0)
+        self._block_list = self.source_level.get_block_list()
+        self._args = (source_stack.index,
+                      (LevelGeometry(left_stack.get_level(0)), left_stack.format,
+                       left_stack.codec_options),
+                      (LevelGeometry(upper_stack.get_level(0)), upper_stack.format,
+                       upper_stack.codec_options),
+                      None if scratches is None else [s.filename for s in scratches],
+                      interp, padding_value)
+
+    def __str__(self):
+        return "ResliceWorkers %d processes" % self.num_workers
+
+    def reslice(self, block_indices):
+        """Iterate over the (block index, x tiles, y tiles) of the given
+        blocks of the source stack level 0 list, in the order they are
+        completed. Raises a RuntimeError if a worker fails or dies."""
+        context = get_worker_context()
+        tasks = context.Queue()
+        results = context.Queue()
+        workers = [context.Process(target=_reslice_blocks, args=self._args + (tasks, results))
+                   for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Blocks are sent as results come back, so that at most
+        # QUEUED_BLOCKS_PER_WORKER blocks per worker wait in the queues
+        pending = iter(block_indices)
+        num_unsent = QUEUED_BLOCKS_PER_WORKER * self.num_workers
+        num_running = self.num_workers
+        try:
+            while num_running > 0:
+                while num_unsent > 0:
+                    index = next(pending, None)
+                    if index is None:
+                        for _ in range(self.num_workers):
+                            tasks.put(None)
+                        num_unsent = -1
+                    else:
+                        self._send_block(tasks, index)
+                        num_unsent -= 1
+                try:
+                    result = results.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    check_processes(workers)
+                    continue
+                if result is None:
+                    num_running -= 1
+                    continue
+                if isinstance(result, str):
+                    raise RuntimeError("Reslicing worker failed:\n" + result)
+                if num_unsent >= 0:
+                    num_unsent += 1
+                yield result
+        finally:
+            # Blocks left in the queue when a worker fails are never read,
+            # do not wait for them to be sent at exit
+            tasks.cancel_join_thread()
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    def _send_block(self, tasks, index):
+        """Read a block of the source stack and send it to the workers. Its
+        buffer is not given back to the buffer pool, as the queue pickles it
+        later."""
+        local_block = self._block_list[index]
+        block = self.source_level.get_block(local_block.u, local_block.v, local_block.z)
+        tasks.put((index, block.u, block.v, block.z, block.nominal_size, block.volume))
@@ -0,0 +1,80 @@
+# BBIC block scheduler
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import math
+import numpy as np
+
+# Blocks handed out per MPI process between two collective allocations
+BLOCKS_PER_PROCESS = 4
+
+
+class BlockScheduler:
+    """Hands out the indices of a list of blocks to the MPI processes on
+    demand, so that processes drawing cheap (edge, uniform) blocks take more
+    of them instead of waiting for the others.
+
+    Blocks are scheduled in epochs of *epoch_size* blocks, every process
+    taking part in all the epochs, so that the tiles can be allocated
+    collectively once per epoch. Each epoch has its own counter in an MPI-3
+    window of rank 0, incremented with atomic fetch-and-add operations."""
+
+    def __init__(self, num_blocks, epoch_size=None, mpi_comm=None):
+        assert isinstance(num_blocks, int)
+        self.mpi_comm = mpi_comm
+        self.mpi_size = 1 if mpi_comm is None else mpi_comm.Get_size()
+        self.mpi_rank = 0 if mpi_comm is None else mpi_comm.Get_rank()
+        self.num_blocks = num_blocks
+        self.epoch_size = epoch_size or BLOCKS_PER_PROCESS * self.mpi_size
+        assert isinstance(self.epoch_size, int) and self.epoch_size > 0
+        self.num_epochs = int(math.ceil(float(num_blocks) / self.epoch_size))
+        self._window = None
+
+        if mpi_comm is not None:
+            from mpi4py import MPI
+            self._mpi = MPI
+            counters = np.zeros(max(self.num_epochs, 1), dtype=np.int64)
+            size = counters.nbytes if self.mpi_rank == 0 else 0
+            self._window = MPI.Win.Allocate(size, counters.itemsize, comm=mpi_comm)
+            if self.mpi_rank == 0:
+                self._window.Lock(0)
+                self._window.Put(counters, 0)
+                self._window.Unlock(0)
+            mpi_comm.barrier()
+
+    def __str__(self):
+        return "BlockScheduler %d blocks, %d epochs of %d blocks" % \
+               (self.num_blocks, self.num_epochs, self.epoch_size)
+
+    def get_epoch_range(self, epoch):
+        """Get the range of the block indices of an epoch"""
+        assert isinstance(epoch, int)
+        start = epoch * self.epoch_size
+        return range(start, min(start + self.epoch_size, self.num_blocks))
+
+    def get_blocks(self, epoch):
+        """Iterate over the block indices of an epoch taken by this process"""
+        blocks = self.get_epoch_range(epoch)
+        if self._window is None:
+            for index in blocks:
+                yield index
+            return
+
+        MPI = self._mpi
+        one = np.ones(1, dtype=np.int64)
+        taken = np.zeros(1, dtype=np.int64)
+        while True:
+            self._window.Lock(0, MPI.LOCK_SHARED)
+            self._window.Fetch_and_op(one, taken, 0, epoch, MPI.SUM)
+            self._window.Unlock(0)
+            if taken[0] >= len(blocks):
+                return
+            yield blocks[int(taken[0])]
+
+    def free(self):
+        """Release the MPI window, collectively"""
+        if self._window is not None:
+            self._window.Free()
+            self._window = None
@@ -9,6 +9,7 @@ import numpy as np
 from .block_provider import BlockProvider
 from .image_provider import ImageProvider
 from .data_block import DataBlock
+from .buffer_pool import get_buffer_pool
 
 
 class SliceToBlocks(BlockProvider):
@@ -32,8 +33,9 @@ class SliceToBlocks(BlockProvider):
         assert isinstance(v, int)
         assert isinstance(z, int)
 
-        if self.slice is None or self.slice.index is not z:
-            del self.slice
+        if self.slice is None or self.slice.index != z:
+            if self.slice is not None:
+                self.slice.release()
             self.slice = Slice(z, self.block_size, self.image_provider)
 
         return self.slice.get_block(u, v)
@@ -60,16 +62,25 @@ class Slice:
         assert isinstance(u, int)
         assert isinstance(v, int)
         block = DataBlock(u, v, self.index, self.block_size)
-        block.allocateAndSet(self.block_size, self.block_size, self.block_size, 0)
         x = u*self.block_size
         y = v*self.block_size
         end_x = min(x+self.block_size, self.data.shape[2])
         end_y = min(y+self.block_size, self.data.shape[1])
         dx = end_x-x
         dy = end_y-y
+        if dx == dy == self.block_size:
+            block.allocate(self.block_size, self.block_size, self.block_size)
+        else:
+            block.allocateAndSet(self.block_size, self.block_size, self.block_size, 0)
         block.volume[:, 0:dy, 0:dx] = self.data[:, y:end_y, x:end_x]
         return block
 
+    def release(self):
+        """Give the memory of the slice back to the buffer pool"""
+        if self.data is not None:
+            get_buffer_pool().release(self.data)
+            self.data = None
+
     def _read_data(self, image_provider):
         """Read the slice data from the image provider"""
         assert isinstance(image_provider, ImageProvider)
@@ -79,9 +90,9 @@ class Slice:
         slice_start = self.index*self.block_size
         slice_end = min(slice_start + self.block_size, dim[2])
 
-        self.data = np.zeros((self.block_size, dim[1], dim[0]), dtype=np.uint8)
+        self.data = get_buffer_pool().acquire((self.block_size, dim[1], dim[0]))
+        # Only the slices past the end of the stack need to be cleared
+        self.data[slice_end-slice_start:] = 0
 
         for slice_index in range(slice_start, slice_end):
-            im = image_provider.get_image(slice_index)
-            arr = np.array(im)
-            self.data[slice_index-slice_start, :] = arr[:]
+            self.data[slice_index-slice_start] = image_provider.get_array(slice_index)
@@ -4,14 +4,40 @@
 # Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
 # Do not distribute without further notice.
 
+import json
 import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 from PIL import Image
 import numpy as np
 from .data_block import DataBlock
 from .block_provider import BlockProvider
 from .image_provider import ImageProvider
+from .codecs import get_codec
+from .level_array import LevelArray
+from .image_export import ImageWriter, export_with_processes, get_rank_items
+from .journal import WATERMARK_NAME
+
+# Threads decoding the tiles of a slice or a block, the codecs release the GIL
+DECODE_THREADS = min(4, os.cpu_count() or 1)
+
+# Chunk size of the consolidated tile data of the levels written in SWMR mode
+TILE_DATA_CHUNK = 1 << 20
+
+_decode_executor = None
+_decode_executor_lock = threading.Lock()
+
+
+def _get_decode_executor():
+    """Get the thread pool decoding tiles, shared by all levels so that it
+    is not created for every slice or block"""
+    global _decode_executor
+    with _decode_executor_lock:
+        if _decode_executor is None:
+            _decode_executor = ThreadPoolExecutor(max_workers=DECODE_THREADS)
+        return _decode_executor
 
 
 class Stack:
@@ -25,14 +51,19 @@ class Stack:
         self.num_slices = 0
         self.tile_size = 0
         self.format = "JPEG"
+        self.codec_options = {}
         self.num_levels = 0
         self.is_video = False
         self.fps = 0
         self.description = ""
         self.original_filenames = ""
+        self.axis = None
         self.local_to_world = self._get_local_to_world('Z')
         self.orientation = ''
         self.slice_positions = ''
+        self.tile_cache = None
+        self.read_only = False
+        self._levels = {}
 
     def __str__(self):
         return "Stack%d [%d, %d, %d], tile size: %d, #levels: %d, format: %s" % \
@@ -57,6 +88,8 @@ class Stack:
         self.original_filenames = self.stack_group.attrs["original_filenames"].decode('ascii')
         self.local_to_world = self.stack_group.attrs["local_to_world"]
         self.orientation = self.stack_group.attrs["orientation"].decode('ascii')
+        if "codec_options" in self.stack_group.attrs:
+            self.codec_options = json.loads(self.stack_group.attrs["codec_options"].decode('ascii'))
         if "slice_positions" in self.stack_group:
             self.slice_positions = self.stack_group.attrs["slice_positions"].decode('ascii')
 
@@ -75,9 +108,11 @@ class Stack:
         self.stack_group.attrs.create('local_to_world', self.local_to_world)
         self.stack_group.attrs.create('orientation', self.orientation.encode('ascii'))
         self.stack_group.attrs.create('slice_positions', self.slice_positions.encode('ascii'))
+        self.stack_group.attrs.create('codec_options', json.dumps(self.codec_options).encode('ascii'))
         self.update_modify_time()
 
     def set_axis(self, axis='Z'):
+        self.axis = axis
         self.local_to_world = self._get_local_to_world(axis)
 
     def _get_local_to_world(self, axis):
@@ -115,13 +150,31 @@ class Stack:
     def get_dimensions(self):
         return self.width, self.height, self.num_slices
 
+    def grow(self, num_slices, levels):
+        """Extend the stack and the given levels to a larger number of slices"""
+        assert isinstance(num_slices, int)
+        self.num_slices = num_slices
+        if self.axis is not None:
+            # the local_to_world matrix is centered on the stack
+            self.local_to_world = self._get_local_to_world(self.axis)
+        self.write_attrs()
+        for level in levels:
+            level.num_slices = num_slices
+            level.write_attrs()
+
     def get_level(self, level_index):
-        """Get a level of the stack, creating it if it does not exist"""
+        """Get a level of the stack, creating it if it does not exist. The
+        levels of a read-only stack are read once, missing ones are None."""
         assert isinstance(level_index, int)
-        nx = math.ceil(float(self.width >> level_index) / self.tile_size)
-        ny = math.ceil(float(self.height >> level_index) / self.tile_size)
+        if level_index in self._levels:
+            return self._levels[level_index]
         index = 'levels/%d' % level_index
-        if index not in self.stack_group:
+        level_group = self.stack_group.get(index)
+        if level_group is None:
+            if self.read_only:
+                return None
+            nx = math.ceil(float(self.width >> level_index) / self.tile_size)
+            ny = math.ceil(float(self.height >> level_index) / self.tile_size)
             level_group = self.stack_group.create_group(index)
             level = StackLevel(level_group, level_index, self.tile_size)
             level.num_x_tiles = int(nx)
@@ -129,12 +182,34 @@ class Stack:
             level.num_slices = self.num_slices
             level.write_attrs()
         else:
-            level = StackLevel(self.stack_group[index], level_index, self.tile_size)
+            level = StackLevel(level_group, level_index, self.tile_size)
             level.read_attrs()
         level.width = self.width >> level_index
         level.height = self.height >> level_index
+        level.format = self.format
+        level.codec = self.get_codec()
+        level.tile_cache = self.tile_cache
+        if self.read_only:
+            self._levels[level_index] = level
         return level
 
+    def get_codec(self):
+        """Get the codec for the tiles, configured with the codec options"""
+        return get_codec(self.format, **self.codec_options)
+
+    def refresh(self):
+        """Get the number of leading slices completely written, reloading the
+        tile indices of the levels read so far. For stacks being written by
+        another process in SWMR mode, all other stacks are complete."""
+        watermark = self.stack_group.get(WATERMARK_NAME)
+        if watermark is None:
+            return self.num_slices
+        if self.stack_group.file.swmr_mode:
+            watermark.refresh()
+            for level in self._levels.values():
+                level.refresh()
+        return int(watermark[0])
+
     def _read_format(self):
         """Determine format from the type attribute"""
         type = self.stack_group.attrs["type"]
@@ -192,6 +267,14 @@ class StackLevel(BlockProvider, ImageProvider):
         self.num_slices = 0
         self.width = 0
         self.height = 0
+        self.format = "JPEG"
+        self.codec = None
+        self.tile_cache = None
+        self.num_threads = DECODE_THREADS
+        self.tile_index = None
+        self.tile_data = None
+        self._uniform_tiles = {}
+        self._uniform_tile_data = {}  # (value, width, height) -> encoded tile
 
     def __str__(self):
         return "StackLevel%d [%d, %d, %d], tile size: %d, #tiles: (%d, %d)" % \
@@ -203,6 +286,8 @@ class StackLevel(BlockProvider, ImageProvider):
         self.num_x_tiles = int(self.level_group.attrs['num_x_tiles'])
         self.num_y_tiles = int(self.level_group.attrs['num_y_tiles'])
         self.num_slices = int(self.level_group.attrs['num_slices'])
+        self.tile_index = self.level_group.get('tile_index')
+        self.tile_data = self.level_group.get('tile_data')
 
     def write_attrs(self):
         """Write the attributes from file"""
@@ -212,17 +297,122 @@ class StackLevel(BlockProvider, ImageProvider):
 
     def get_tile(self, u, v, slice_index):
         """Get a tile of the given slice as an Image"""
+        return Image.fromarray(np.ascontiguousarray(self.get_tile_array(u, v, slice_index)))
+
+    def get_tile_data(self, u, v, slice_index):
+        """Get a tile of the given slice as stored, encoded with the codec of
+        the stack, as a uint8 array. Raises KeyError for missing tiles."""
+        assert isinstance(u, int)
+        assert isinstance(v, int)
+        assert isinstance(slice_index, int)
+
+        if self.tile_index is None:
+            # Uniform tiles are links to an encoded tile shared by the stack
+            return self.level_group['%d/%d/%d' % (slice_index, u, v)][:]
+        offset, size = (int(x) for x in self.tile_index[slice_index, v, u])
+        if size == 0:
+            raise KeyError("Tile %d/%d/%d has not been written" % (slice_index, u, v))
+        if size < 0:
+            return self._get_uniform_tile_data(-size - 1, *self.get_tile_dimensions(u, v))
+        return self.tile_data[offset:offset + size]
+
+    def get_tile_array(self, u, v, slice_index):
+        """Get a tile of the given slice as a read-only (height, width) uint8
+        array, from the tile cache if the level has one"""
         assert isinstance(u, int)
         assert isinstance(v, int)
         assert isinstance(slice_index, int)
 
         tile_id = '%d/%d/%d' % (slice_index, u, v)
+        key = self._get_cache_key(tile_id)
+        if key is not None:
+            data = self.tile_cache.get(key)
+            if data is not None:
+                return data
+
+        if self.tile_index is not None:
+            offset, size = (int(x) for x in self.tile_index[slice_index, v, u])
+            if size == 0:
+                raise KeyError("Tile %s has not been written" % tile_id)
+            if size < 0:
+                width, height = self.get_tile_dimensions(u, v)
+                return np.broadcast_to(np.uint8(-size - 1), (height, width))
+            data = self._get_codec().decode(self.tile_data[offset:offset + size])
+            if key is not None:
+                return self.tile_cache.put(key, data)
+            return data
+
         tile = self.level_group[tile_id]
+        # Uniform tiles are links to a shared tile, synthesize them without
+        # allocating their pixels
+        if 'uniform_value' in tile.attrs:
+            return np.broadcast_to(np.uint8(tile.attrs['uniform_value']),
+                                   (int(tile.attrs['height']), int(tile.attrs['width'])))
+
+        data = self._get_codec().decode(tile[:])
+        if key is not None:
+            return self.tile_cache.put(key, data)
+        return data
+
+    def create_tile_index(self):
+        """Preallocate the storage of the tiles for a write in SWMR mode, in
+        which no dataset can be created: the tiles are appended to a single
+        tile_data dataset, and their (offset, size) stored in a tile_index
+        of shape (num_slices, num_y_tiles, num_x_tiles, 2). A negative size
+        -(value+1) marks a tile of a single value, 0 a missing tile."""
+        if self.tile_index is not None:
+            return
+        if len(self.level_group) > 0:
+            raise ValueError("Level %d already has tiles written without SWMR" % self.index)
+        shape = (self.num_slices, self.num_y_tiles, self.num_x_tiles, 2)
+        self.tile_index = self.level_group.create_dataset(
+            'tile_index', shape, np.int64, maxshape=(None,) + shape[1:],
+            chunks=(1,) + shape[1:], fillvalue=0)
+        self.tile_data = self.level_group.create_dataset(
+            'tile_data', (0,), np.uint8, maxshape=(None,), chunks=(TILE_DATA_CHUNK,))
+
+    def refresh(self):
+        """Reload the tile index and data written by a SWMR writer"""
+        if self.tile_index is not None:
+            self.tile_index.refresh()
+            self.tile_data.refresh()
+
+    def _get_cache_key(self, tile_id):
+        """Get the key of a tile in the tile cache, None without cache"""
+        if self.tile_cache is None:
+            return None
+        return self.level_group.file.filename, self.level_group.name, tile_id
+
+    def _read_tiles(self, tiles):
+        """Decode (u, v, slice index, destination) tiles in parallel, copying
+        each tile into its destination array when their shapes match.
+        Returns the decoded tiles and whether they all matched."""
+        def read(tile):
+            u, v, slice_index, dst = tile
+            data = self.get_tile_array(u, v, slice_index)
+            if data.shape != dst.shape:
+                return data, False
+            dst[:] = data
+            return data, True
+
+        if self.num_threads <= 1 or len(tiles) <= 1:
+            results = [read(tile) for tile in tiles]
+        else:
+            results = list(_get_decode_executor().map(read, tiles))
+        return [data for data, _ in results], all(matched for _, matched in results)
 
-        data = tile[:].tostring()
-        bytes_buffer = BytesIO(data)
-        im = Image.open(bytes_buffer)
-        return im
+    def _get_codec(self):
+        """Get the codec for the tiles of this level"""
+        if self.codec is None:
+            self.codec = get_codec(self.format)
+        return self.codec
+
+    def get_tile_dimensions(self, u, v):
+        """Get the width and height of a tile, smaller on the right and bottom borders"""
+        assert isinstance(u, int)
+        assert isinstance(v, int)
+        return (min(self.tile_size, self.width - u * self.tile_size),
+                min(self.tile_size, self.height - v * self.tile_size))
 
     def get_block_size(self):
         """Get the size of the blocks, equivalent to tile_size"""
@@ -240,18 +430,27 @@ class StackLevel(BlockProvider, ImageProvider):
         block_depth = slice_end - slice_start
 
         block = DataBlock(u, v, z, self.tile_size)
-        for slice_index in range(slice_start, slice_end):
-            im = self.get_tile(u, v, slice_index)
-            arr = np.array(im)
-            if block.volume is None:
-                block.allocate(im.size[0], im.size[1], block_depth)
-            block.volume[slice_index-slice_start, :] = arr[:]
+        width, height = self.get_tile_dimensions(u, v)
+        block.allocate(width, height, block_depth)
+        tiles, matched = self._read_tiles([(u, v, slice_index, block.volume[slice_index - slice_start])
+                                           for slice_index in range(slice_start, slice_end)])
+        if not matched:
+            # Tiles of another size than their place in the level, the block
+            # takes the size of the first one
+            block.allocate(tiles[0].shape[1], tiles[0].shape[0], block_depth)
+            for index, data in enumerate(tiles):
+                block.volume[index, :] = data
         return block
 
     def get_dimensions(self):
         """Get the dimensions of the stack"""
         return self.width, self.height, self.num_slices
 
+    def as_array(self, padding_value=0):
+        """Get a lazy [z, y, x] array view of the level, decoding only the
+        tiles of the regions it is indexed with"""
+        return LevelArray(self, padding_value)
+
     def get_block_count(self):
         """Get the number of blocks of size <tile_size> that can be formed
         from this stack"""
@@ -276,23 +475,28 @@ class StackLevel(BlockProvider, ImageProvider):
         assert isinstance(slice_index, int)
         assert isinstance(padding, int)
 
-        tiles = []
-        width = height = 0
-        for v in range(self.num_y_tiles):
-            tiles.append([])
-            for u in range(self.num_x_tiles):
-                tile = self.get_tile(u, v, slice_index)
-                tiles[v].append(tile)
-                if v == 0:
-                    width += tile.size[0]
-            height += tile.size[1]
-
-        image = Image.new('L', (width, height), padding)
-        for v in range(self.num_y_tiles):
-            for u in range(self.num_x_tiles):
-                pos = (u * self.tile_size, v * self.tile_size)
-                image.paste(tiles[v][u], pos)
-        return image
+        # Tiles are decoded straight into their place in the slice
+        image = np.empty((self.height, self.width), dtype=np.uint8)
+        positions = [(u, v) for v in range(self.num_y_tiles) for u in range(self.num_x_tiles)]
+        tiles, matched = self._read_tiles(
+            [(u, v, slice_index, image[v * self.tile_size:(v + 1) * self.tile_size,
+                                       u * self.tile_size:(u + 1) * self.tile_size])
+             for u, v in positions])
+        if matched and self.num_x_tiles * self.tile_size >= self.width and \
+                self.num_y_tiles * self.tile_size >= self.height:
+            return Image.fromarray(image)
+
+        # Tiles of another size than their place in the level, the slice
+        # takes the size of the first row and column of tiles
+        width = sum(tile.shape[1] for tile in tiles[:self.num_x_tiles])
+        height = sum(tile.shape[0] for tile in tiles[::self.num_x_tiles])
+        image = np.full((height, width), padding, dtype=np.uint8)
+        for (u, v), tile in zip(positions, tiles):
+            # Tiles are cropped to the image, like PIL's paste()
+            x, y = u * self.tile_size, v * self.tile_size
+            dst = image[y:y + tile.shape[0], x:x + tile.shape[1]]
+            dst[:] = tile[:dst.shape[0], :dst.shape[1]]
+        return Image.fromarray(image)
 
     def allocate_tile(self, size, u, v, slice_index):
         """Allocate a dataset for the given tile"""
@@ -301,7 +505,12 @@ class StackLevel(BlockProvider, ImageProvider):
         assert isinstance(slice_index, int)
 
         tile_id = '%d/%d/%d' % (slice_index, u, v)
-        self.level_group.create_dataset(tile_id, (size,), np.uint8)
+        try:
+            self.level_group.create_dataset(tile_id, (size,), np.uint8)
+        except (ValueError, RuntimeError):
+            # Left over by an interrupted write
+            del self.level_group[tile_id]
+            self.level_group.create_dataset(tile_id, (size,), np.uint8)
 
     def store_tile(self, tile, u, v, slice_index):
         """Store a serialized tile, creating the dataset
@@ -311,15 +520,89 @@ class StackLevel(BlockProvider, ImageProvider):
         assert isinstance(slice_index, int)
 
         tile_id = '%d/%d/%d' % (slice_index, u, v)
-        if tile_id not in self.level_group:
+        if self.tile_cache is not None:
+            self.tile_cache.discard(self._get_cache_key(tile_id))
+        if self.tile_index is not None:
+            offset = self.tile_data.shape[0]
+            self.tile_data.resize((offset + len(tile),))
+            self.tile_data[offset:] = tile
+            self.tile_index[slice_index, v, u] = (offset, len(tile))
+            return
+        dataset = self.level_group.get(tile_id)
+        if dataset is None:
             self.level_group.create_dataset(tile_id, data=tile)
         else:
-            dataset = self.level_group[tile_id]
-            dataset[:] = tile
-
-    def extract_slices(self, outputdir, format, mpi_comm=None):
-        """Write the stack to disk as a collection of images"""
-        mpi_stride = 1 if mpi_comm is None else mpi_comm.Get_size()
-        for i in range(0, self.num_slices, mpi_stride):
-            im = self.get_image(i)
-            im.save('%s/%d.%s' % (outputdir, i, format))
+            if dataset.shape != tile.shape or 'uniform_value' in dataset.attrs:
+                # Left over by an interrupted write
+                del self.level_group[tile_id]
+                self.level_group.create_dataset(tile_id, data=tile)
+            else:
+                dataset[:] = tile
+
+    def link_uniform_tile(self, value, u, v, slice_index):
+        """Store a tile of a single value as a link to a tile shared by the
+        whole stack, creating the shared tile if it does not exist"""
+        assert isinstance(value, int)
+        assert isinstance(u, int)
+        assert isinstance(v, int)
+        assert isinstance(slice_index, int)
+
+        width, height = self.get_tile_dimensions(u, v)
+        tile_id = '%d/%d/%d' % (slice_index, u, v)
+        if self.tile_cache is not None:
+            self.tile_cache.discard(self._get_cache_key(tile_id))
+        if self.tile_index is not None:
+            self.tile_index[slice_index, v, u] = (0, -value - 1)
+            return
+        uniform_tile = self._get_uniform_tile(value, width, height)
+        try:
+            self.level_group[tile_id] = uniform_tile
+        except (ValueError, RuntimeError, OSError):
+            # Left over by an interrupted write
+            del self.level_group[tile_id]
+            self.level_group[tile_id] = uniform_tile
+
+    def _get_uniform_tile_data(self, value, width, height):
+        """Get a uniform tile of the given size of a SWMR level, encoded once"""
+        key = (value, width, height)
+        data = self._uniform_tile_data.get(key)
+        if data is None:
+            data = self._get_codec().encode(np.full((height, width), value, dtype=np.uint8))
+            data.setflags(write=False)
+            self._uniform_tile_data[key] = data
+        return data
+
+    def _get_uniform_tile(self, value, width, height):
+        """Get the shared dataset for a uniform tile of the given size"""
+        key = (value, width, height)
+        if key not in self._uniform_tiles:
+            stack_group = self.level_group.parent.parent
+            uniform_group = stack_group.require_group('uniform_tiles')
+            name = '%d_%dx%d' % key
+            if name in uniform_group:
+                dataset = uniform_group[name]
+            else:
+                data = np.full((height, width), value, dtype=np.uint8)
+                dataset = uniform_group.create_dataset(name, data=self._get_codec().encode(data))
+                dataset.attrs.create('uniform_value', value)
+                dataset.attrs.create('width', width)
+                dataset.attrs.create('height', height)
+            self._uniform_tiles[key] = dataset
+        return self._uniform_tiles[key]
+
+    def extract_slices(self, outputdir, format, mpi_comm=None, num_processes=1):
+        """Write the stack to disk as a collection of images, the slices being
+        shared by the MPI processes and then by *num_processes* local
+        processes"""
+        slices = get_rank_items(range(self.num_slices), mpi_comm)
+        if num_processes > 1:
+            export_with_processes(num_processes, self.level_group, slices, (outputdir, format))
+        else:
+            self._export_items(slices, outputdir, format)
+
+    def _export_items(self, slices, outputdir, format):
+        """Write the given slices, saving the images while decoding the next
+        ones"""
+        with ImageWriter() as writer:
+            for i in slices:
+                writer.save(self.get_image(i), '%s/%d.%s' % (outputdir, i, format))
@@ -0,0 +1,88 @@
+# BBIC tile cache
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import threading
+from collections import OrderedDict
+
+
+class TileCache:
+    """Thread-safe cache of decoded tiles (2D uint8 arrays), bounded in
+    bytes, evicting the least recently used tiles first.
+
+    The cached arrays are made read-only, as they are shared by all the
+    readers of the tile. A miss is counted when a decoded tile is put, so
+    that the tiles which are never cached (e.g. uniform tiles) are not
+    counted."""
+
+    def __init__(self, max_bytes):
+        assert isinstance(max_bytes, int)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()  # key -> array, least recently used first
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def __str__(self):
+        return "TileCache %d tiles, %.1f / %.1f MB, hits: %d, misses: %d, evictions: %d" % \
+               (len(self._tiles), self.num_bytes / 1e6, self.max_bytes / 1e6,
+                self.num_hits, self.num_misses, self.num_evictions)
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        """Get a cached tile, or None"""
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                return None
+            self._tiles.move_to_end(key)
+            self.num_hits += 1
+            return tile
+
+    def put(self, key, tile):
+        """Add a decoded tile, evicting the least recently used ones to stay
+        within max_bytes. Tiles larger than the cache are not kept."""
+        with self._lock:
+            self.num_misses += 1
+            if tile.nbytes > self.max_bytes:
+                return tile
+            tile.setflags(write=False)
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self.num_bytes -= previous.nbytes
+            self._tiles[key] = tile
+            self.num_bytes += tile.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.num_evictions += 1
+        return tile
+
+    def discard(self, key):
+        """Remove a tile that has been rewritten"""
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+            if tile is not None:
+                self.num_bytes -= tile.nbytes
+
+    def clear(self):
+        """Remove all the tiles"""
+        with self._lock:
+            self._tiles.clear()
+            self.num_bytes = 0
+
+    def get_stats(self):
+        """Get the usage statistics of the cache as a dictionary"""
+        with self._lock:
+            return {'tiles': len(self._tiles),
+                    'bytes': self.num_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.num_hits,
+                    'misses': self.num_misses,
+                    'evictions': self.num_evictions}
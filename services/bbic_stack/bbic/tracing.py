@@ -0,0 +1,137 @@
+# BBIC tracing
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import json
+import threading
+import time
+
+# Events kept per process, later ones are dropped and counted
+MAX_EVENTS = 2000000
+
+
+class _NullSpan:
+    """Span doing nothing, used while the tracer is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Context manager recording a complete event"""
+
+    __slots__ = ['tracer', 'name', 'category', 'args', 'start']
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.add_span(self.name, self.start, time.perf_counter(), self.category, self.args)
+        return False
+
+
+class Tracer:
+    """Timeline of the begin and end of the processing stages of one
+    process, exported as Chrome trace events (chrome://tracing, Perfetto).
+
+    The stages timed by the instrumentation are recorded as well while the
+    tracer is enabled. Events are kept in memory until gathered."""
+
+    def __init__(self, enabled=False, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._thread_ids = {}  # thread ident -> small thread index
+        self.events = []  # (name, category, start us, duration us, thread index, args)
+        self.num_dropped = 0
+
+    def start(self, mpi_comm=None):
+        """Enable the tracer, with the time origin set after a barrier so that
+        the timelines of all MPI processes line up"""
+        if mpi_comm is not None:
+            mpi_comm.barrier()
+        with self._lock:
+            self._origin = time.perf_counter()
+            self.events = []
+            self.num_dropped = 0
+        self.enabled = True
+
+    def span(self, name, category='stage', **args):
+        """Get a context manager recording the time spent in a block of code,
+        with optional arguments shown on the timeline"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def add_span(self, name, start, end, category='stage', args=None):
+        """Record an event between two time.perf_counter() values"""
+        if not self.enabled:
+            return
+        ident = threading.get_ident()
+        with self._lock:
+            if len(self.events) >= self.max_events:
+                self.num_dropped += 1
+                return
+            thread_index = self._thread_ids.setdefault(ident, len(self._thread_ids))
+            self.events.append((name, category, (start - self._origin) * 1e6,
+                                (end - start) * 1e6, thread_index, args or None))
+
+    def gather(self, mpi_comm=None):
+        """Get the events of all MPI processes, ordered by rank, on rank 0
+        (None on the other ranks)"""
+        with self._lock:
+            events = (list(self.events), self.num_dropped)
+        if mpi_comm is None:
+            return [events]
+        return mpi_comm.gather(events, root=0)
+
+
+def export_trace(all_events, filename):
+    """Write the events of all processes as a Chrome trace-event JSON file,
+    one process per MPI rank"""
+    trace = []
+    num_dropped = 0
+    for rank, (events, dropped) in enumerate(all_events):
+        num_dropped += dropped
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': rank, 'tid': 0,
+                      'args': {'name': 'rank %d' % rank}})
+        trace.append({'name': 'process_sort_index', 'ph': 'M', 'pid': rank, 'tid': 0,
+                      'args': {'sort_index': rank}})
+        for tid in sorted(set(event[4] for event in events)):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': rank, 'tid': tid,
+                          'args': {'name': 'main' if tid == 0 else 'worker %d' % tid}})
+        for name, category, start, duration, tid, args in events:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': rank, 'tid': tid,
+                     'ts': round(start, 3), 'dur': round(duration, 3)}
+            if args:
+                event['args'] = args
+            trace.append(event)
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms',
+                   'otherData': {'dropped_events': num_dropped}}, f)
+    if num_dropped:
+        print('Warning: %d trace events dropped' % num_dropped)
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """Get the tracer of this process"""
+    return _tracer
@@ -11,6 +11,8 @@ import scipy.ndimage.filters as filter
 import scipy.ndimage.interpolation as interp
 from .data_block import DataBlock
 from .block_provider import BlockProvider
+from .buffer_pool import get_buffer_pool
+from .image_export import ImageWriter, export_with_processes, get_rank_items
 
 VOLUME_VERSION_UNKNOWN=0
 VOLUME_VERSION_ORIGINAL=1
@@ -39,6 +41,8 @@ class Volume:
         self.block_size = 0
         self.orientation = ""
         self.version = VOLUME_VERSION_CURRENT
+        self.read_only = False
+        self._lods = {}
 
     def read_attrs(self):
         """Read the attributes from file"""
@@ -85,19 +89,23 @@ class Volume:
         return num_blocks_x, num_blocks_y, num_blocks_z
 
     def get_lod(self, lod_index):
-        """Get a LOD of the volume"""
+        """Get a LOD of the volume, read once for read-only volumes"""
         assert isinstance(lod_index, int)
 
-        index = "levels/%d" % lod_index
-        if index not in self.volume_group:
+        if lod_index in self._lods:
+            return self._lods[lod_index]
+        lod_group = self.volume_group.get("levels/%d" % lod_index)
+        if lod_group is None:
             return None
 
-        lod = VolumeLOD(self.volume_group[index], lod_index, self.block_size)
+        lod = VolumeLOD(lod_group, lod_index, self.block_size)
         lod.read_attrs()
         if self.version < 1:
             # Overwrite wrong legacy dimensions with correct ones...
             (lod.width, lod.height, lod.depth) = self.get_dimensions(lod_index)
             lod.num_blocks = self.get_blocks_count(lod_index)
+        if self.read_only:
+            self._lods[lod_index] = lod
         return lod
 
     def fill(self, source, block_size):
@@ -195,12 +203,14 @@ class VolumeLOD(BlockProvider):
             raise ValueError("Invalid block requested")
 
         index = "%d/%d/%d" % (u, v, z)
-        if not index in self.group:
+        dataset = self.group.get(index)
+        if dataset is None:
             self._allocate_block(u, v, z)
+            dataset = self.group[index]
 
         block = DataBlock(u, v, z, self.block_size)
         block.width, block.height, block.depth = self._get_block_size(u, v, z)
-        block.volume = self.group[index]
+        block.volume = dataset
         return block
 
     def get_dimensions(self):
@@ -250,35 +260,49 @@ class VolumeLOD(BlockProvider):
         self.group.create_dataset(index, shape=(self.block_size, self.block_size, self.block_size),
                                   dtype=np.uint8, compression='lzf')
 
-    def extract_slices(self, outputdir, format, axis=0, mpi_comm=None):
-        """Write the volume to disk as a stack of images"""
+    def extract_slices(self, outputdir, format, axis=0, mpi_comm=None, num_processes=1):
+        """Write the volume to disk as a stack of images, the slabs of slices
+        being shared by the MPI processes and then by *num_processes* local
+        processes"""
+        dim = (self.depth, self.height, self.width)
+        n_images = self.block_size  # thickness of the temporary slice, can be reduced if memory consumption is too high
+        (outer_dim, inner_dim1, inner_dim2) = get_indices(axis)
+        slabs = get_rank_items(range(0, dim[outer_dim], n_images), mpi_comm)
+        if num_processes > 1:
+            export_with_processes(num_processes, self.group, slabs, (outputdir, format, axis))
+        else:
+            self._export_items(slabs, outputdir, format, axis)
+
+    def _export_items(self, slabs, outputdir, format, axis):
+        """Write the slices of the given slabs, saving the images while
+        assembling the next ones"""
         tile_size = self.block_size
         ntiles = (self.num_blocks[2], self.num_blocks[1], self.num_blocks[0])
         dim = (self.depth, self.height, self.width)
 
-        mpi_stride = 1 if mpi_comm is None else mpi_comm.Get_size()
-        n_images = self.block_size  # thickness of the temporary slice, can be reduced if memory consumption is too high
+        n_images = self.block_size
         (outer_dim, inner_dim1, inner_dim2) = get_indices(axis)
-        for outer in range(0, dim[outer_dim], n_images*mpi_stride):
-            slice = np.zeros((n_images, ntiles[inner_dim1] * tile_size, ntiles[inner_dim2] * tile_size), dtype=np.uint8)
-            for inner1 in range(ntiles[inner_dim1]):
-                for inner2 in range(ntiles[inner_dim2]):
-                    idx = [0] * 3
-                    idx[outer_dim] = int(outer / tile_size)
-                    idx[inner_dim1] = inner1
-                    idx[inner_dim2] = inner2
-                    block = self.get_block(idx[2], idx[1], idx[0])
-                    dset = block.volume[:]
-                    for n in range(min(n_images, dim[outer_dim] - outer)):
-                        ref = [None] * 3
-                        ref[outer_dim] = (outer + n) % tile_size
-                        ref[inner_dim1] = Ellipsis
-                        ref[inner_dim2] = Ellipsis
-                        slice[n, inner1*tile_size:(inner1+1)*tile_size, inner2*tile_size:(inner2+1)*tile_size] = dset[ref]
-            for n in range(min(n_images, dim[outer_dim] - outer)):
-                im = Image.fromarray(np.squeeze(slice[n, :, :]))
-                im = im.crop((0, 0, dim[inner_dim2], dim[inner_dim1]))
-                im.save('%s/%d.%s' % (outputdir, outer + n, format))
+        with ImageWriter() as writer:
+            for outer in slabs:
+                slice = np.zeros((n_images, ntiles[inner_dim1] * tile_size, ntiles[inner_dim2] * tile_size), dtype=np.uint8)
+                for inner1 in range(ntiles[inner_dim1]):
+                    for inner2 in range(ntiles[inner_dim2]):
+                        idx = [0] * 3
+                        idx[outer_dim] = int(outer / tile_size)
+                        idx[inner_dim1] = inner1
+                        idx[inner_dim2] = inner2
+                        block = self.get_block(idx[2], idx[1], idx[0])
+                        dset = block.volume[:]
+                        for n in range(min(n_images, dim[outer_dim] - outer)):
+                            ref = [None] * 3
+                            ref[outer_dim] = (outer + n) % tile_size
+                            ref[inner_dim1] = np.s_[:]
+                            ref[inner_dim2] = np.s_[:]
+                            slice[n, inner1*tile_size:(inner1+1)*tile_size, inner2*tile_size:(inner2+1)*tile_size] = dset[tuple(ref)]
+                for n in range(min(n_images, dim[outer_dim] - outer)):
+                    im = Image.fromarray(np.squeeze(slice[n, :, :]))
+                    im = im.crop((0, 0, dim[inner_dim2], dim[inner_dim1]))
+                    writer.save(im, '%s/%d.%s' % (outputdir, outer + n, format))
 
     def fill(self, source):
         """Fill from a source of same dimensions and compatible block size"""
@@ -296,6 +320,7 @@ class VolumeLOD(BlockProvider):
                         src_block = source.get_block(u, v, z)
                         shape = src_block.volume.shape
                         block.volume[0:shape[0], 0:shape[1], 0:shape[2]] = src_block.volume[:]
+                        src_block.release()
 
         # Second case: source blocks are larger
         elif source.get_block_size() > self.block_size:
@@ -307,9 +332,12 @@ class VolumeLOD(BlockProvider):
             for z in range(source.get_block_count()[2]):
                 for v in range(source.get_block_count()[1]):
                     for u in range(source.get_block_count()[0]):
-                        subblocks = source.get_block(u, v, z).split(self.block_size)
+                        src_block = source.get_block(u, v, z)
+                        subblocks = src_block.split(self.block_size)
+                        src_block.release()
                         for subblock in subblocks:
                             self.get_block(subblock.u+u*stride, subblock.v+v*stride, subblock.z+z*stride).copy(subblock)
+                            subblock.release()
 
         # Last case: source blocks are smaller
         else:
@@ -350,7 +378,9 @@ class VolumeLODDownsampler(BlockProvider):
         meta_block.allocateAndSet(meta_block_size, meta_block_size, meta_block_size, 0)
         meta_block.width, meta_block.height, meta_block.depth = self._get_meta_block_size(u, v, z)
         meta_block.fill(self.lod, (2*u, 2*v, 2*z))
-        return self._downsample(meta_block)
+        block = self._downsample(meta_block)
+        meta_block.release()
+        return block
 
     def get_dimensions(self):
         """Get the dimensions of the downsampled Volume LOD"""
@@ -374,7 +404,12 @@ class VolumeLODDownsampler(BlockProvider):
         assert isinstance(meta_block, DataBlock)
 
         block = DataBlock(0, 0, 0, meta_block.nominal_size >> 1)
+        pool = get_buffer_pool()
+        tmp_data = pool.acquire(meta_block.volume.shape)
+        filter.median_filter(meta_block.volume, self.filter_size, output=tmp_data)
+        half_shape = tuple(int(round(x * 0.5)) for x in tmp_data.shape)
+        block.allocate(half_shape[2], half_shape[1], half_shape[0])
         block.width, block.height, block.depth = meta_block.width >> 1, meta_block.height >> 1, meta_block.depth >> 1
-        tmp_data = filter.median_filter(meta_block.volume, self.filter_size)
-        block.volume = interp.zoom(tmp_data, 0.5, order=0, prefilter=False)
+        interp.zoom(tmp_data, 0.5, output=block.volume, order=0, prefilter=False)
+        pool.release(tmp_data)
         return block
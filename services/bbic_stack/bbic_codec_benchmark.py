@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# BBIC tile codec benchmark
+# Authors: Christian Tresch, Mateusz Paluchowski    2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import time
+from argparse import ArgumentParser
+from PIL import Image
+import numpy as np
+import bbic
+
+
+def create_parser():
+    parser = ArgumentParser(description='Measure the speed and compression '
+                                        'ratio of the tile codecs on real '
+                                        'slice images')
+    parser.add_argument('source_files', help='Pattern of filenames,'
+                                             'e.g. foo_%%03d_bar.png or a '
+                                             'text file with a list')
+    parser.add_argument('--formats', help='Tile formats to benchmark, '
+                                          'defaults to all the available ones',
+                        nargs='+', choices=bbic.get_codec_names(),
+                        default=bbic.get_codec_names())
+    parser.add_argument('--tile-size', help='Tile image size, defaults to 256',
+                        dest='tile_size', type=int, default=256)
+    parser.add_argument('--samples', help='Number of slices to sample, '
+                                          'defaults to 4',
+                        type=int, default=4)
+    parser.add_argument('--repeat', help='Number of encoding/decoding passes, '
+                                         'defaults to 1',
+                        type=int, default=1)
+    parser.add_argument('--quality', help='Tile quality for the lossy formats '
+                                          '(JPEG, WEBP)',
+                        type=int)
+    return parser
+
+
+def read_tiles(filenames, tile_size):
+    """Read the given slices and split them into tiles"""
+    tiles = []
+    for filename in filenames:
+        im = Image.open(filename)
+        if im.mode != 'L':
+            im = im.convert('L')
+        data = np.asarray(im)
+        for y in range(0, data.shape[0], tile_size):
+            for x in range(0, data.shape[1], tile_size):
+                tiles.append(np.ascontiguousarray(data[y:y + tile_size, x:x + tile_size]))
+    return tiles
+
+
+def main():
+    start_time = time.time()
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    reader = bbic.ImageStack(args.source_files)
+    if reader.num_slices == 0:
+        print('Error: no slice found for', args.source_files)
+        return
+    num_samples = max(1, min(args.samples, reader.num_slices))
+    step = float(reader.num_slices) / num_samples
+    filenames = [reader.filenames[int(i * step)] for i in range(num_samples)]
+    tiles = read_tiles(filenames, args.tile_size)
+    print('Benchmarking %d tiles of %d pixels from %d slices' %
+          (len(tiles), args.tile_size, num_samples))
+
+    print('%-10s %14s %14s %8s' % ('format', 'encode MB/s', 'decode MB/s', 'ratio'))
+    for format_ in args.formats:
+        options = {}
+        if args.quality is not None and format_ in ['JPEG', 'WEBP']:
+            options['quality'] = args.quality
+        result = bbic.benchmark_codec(bbic.get_codec(format_, **options), tiles, args.repeat)
+        print('%-10s %14.1f %14.1f %8.2f' % (format_, result['encode_mbps'],
+                                             result['decode_mbps'], result['ratio']))
+
+    print("--- Execution time: %s seconds ---" % round(time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,24 @@ def create_parser():
     parser.add_argument('--all-stacks', help='Generate additional stacks '
                                              'along the rest of the axes',
                         action='store_true', dest='all_stacks')
+    parser.add_argument('--fused', help='With --all-stacks, write the three '
+                                        'stacks in a single pass over the '
+                                        'source slices, instead of reading '
+                                        'back the written stack',
+                        action='store_true')
+    parser.add_argument('--scratch-dir', help='Directory of the scratch '
+                                              'files of --all-stacks, shared '
+                                              'by all MPI processes, '
+                                              'defaults to the output '
+                                              'directory',
+                        dest='scratch_dir')
+    parser.add_argument('--processes', help='Number of local processes '
+                                            'reslicing the blocks of '
+                                            '--all-stacks when MPI is not '
+                                            'used, or exporting the slices '
+                                            'of --to-images on each MPI '
+                                            'process, defaults to 1',
+                        type=int, default=1)
     parser.add_argument('--description', help='Stack description, defaults to '
                                               'Imported image stack',
                         default='Imported image stack')
@@ -51,9 +69,19 @@ def create_parser():
                                         'defaults to 0', default=0, type=int)
     parser.add_argument('--no-lods', help='Do not generate LODs, only level 0',
                         action='store_true', dest='no_lods')
+    parser.add_argument('--no-dedup', help='Encode every tile, even those of '
+                                           'a single value (e.g. padding)',
+                        action='store_true', dest='no_dedup')
     parser.add_argument('--format', help='Tile image format, defaults to JPEG',
-                        dest='format_', choices=['PNG', 'JPEG', 'TIFF'],
+                        dest='format_', choices=bbic.get_codec_names(),
                         default='JPEG')
+    parser.add_argument('--quality', help='Tile quality for the lossy formats '
+                                          '(JPEG, WEBP), defaults to the '
+                                          'codec default',
+                        type=int)
+    parser.add_argument('--subsampling', help='JPEG chroma subsampling '
+                                              '(0: 4:4:4, 1: 4:2:2, 2: 4:2:0)',
+                        type=int, choices=[0, 1, 2])
     parser.add_argument('--mat', help='Matrix to apply to the automatic '
                                       'voxel-based local_to_world matrix',
                         choices=['X', 'Y', 'Z'], default='Z')
@@ -66,20 +94,182 @@ def create_parser():
     parser.add_argument('--from', help='Start from given slice (for resuming),'
                                        ' defaults to 0',
                         dest='from_', type=int, default=0)
+    parser.add_argument('--resume', help='Resume an interrupted write into '
+                                         'the given BBIC file, skipping the '
+                                         'slices it already completed',
+                        metavar='FILE')
+    parser.add_argument('--follow', help='Follow a directory still being '
+                                         'filled: tile new slices as soon as '
+                                         'they are complete',
+                        action='store_true')
+    parser.add_argument('--swmr', help='Write the stack in HDF5 single-writer '
+                                       '/ multiple-reader mode, so that '
+                                       'the completed slices can be read '
+                                       'while it is being written (without '
+                                       'MPI)',
+                        action='store_true')
+    parser.add_argument('--poll-interval', help='Seconds between two checks '
+                                                'for new slices with --follow, '
+                                                'defaults to 10',
+                        dest='poll_interval', type=float, default=10.0)
+    parser.add_argument('--idle-timeout', help='Stop following when no new '
+                                               'slice arrived for this many '
+                                               'seconds, defaults to 600',
+                        dest='idle_timeout', type=float, default=600.0)
+    parser.add_argument('--stack-size', help='Width and height of the stack '
+                                             'with --follow, defaults to the '
+                                             'size of the first slices',
+                        dest='stack_size', type=int, nargs=2,
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--raw-shape', help='Width and height of the slices '
+                                            'of a .raw source file',
+                        dest='raw_shape', type=int, nargs=2,
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--raw-offset', help='Size of the header to skip in '
+                                             'a .raw source file, defaults to 0',
+                        dest='raw_offset', type=int, default=0)
+    parser.add_argument('--probe-threads', help='Number of threads reading '
+                                                'the image headers to find the '
+                                                'stack size, defaults to 16',
+                        dest='probe_threads', type=int, default=16)
+    parser.add_argument('--size-cache', help='File caching the image sizes, '
+                                             'defaults to a hidden file next '
+                                             'to the source images',
+                        dest='size_cache')
+    parser.add_argument('--no-size-cache', help='Do not cache the image sizes',
+                        dest='no_size_cache', action='store_true')
+    parser.add_argument('--plan', help='Only predict the size, memory and '
+                                       'runtime of the write from sample '
+                                       'slices, without writing',
+                        action='store_true')
+    parser.add_argument('--plan-samples', help='Number of slices sampled by '
+                                               '--plan, defaults to 4',
+                        dest='plan_samples', type=int, default=4)
+    parser.add_argument('--timings', help='Measure the time spent in each '
+                                          'processing stage, printed at the '
+                                          'end or written to the given JSON '
+                                          'file',
+                        nargs='?', const='-', metavar='FILE')
+    parser.add_argument('--trace', help='Record a timeline of the slices, '
+                                        'blocks, stages and MPI calls of '
+                                        'each process to the given Chrome '
+                                        'trace-event JSON file',
+                        metavar='FILE')
+    parser.add_argument('--profile', help='Profile each MPI process and write '
+                                          'the merged profile and a report '
+                                          'to the given directory',
+                        metavar='DIR')
+    parser.add_argument('--profile-memory', help='Also trace the memory '
+                                                 'allocations with --profile',
+                        dest='profile_memory', action='store_true')
     parser.add_argument('--padding-value', help='Padding value for extending '
                                                 'tiles',
-                        default=255, dest='padding_value')
+                        default=255, dest='padding_value', type=int)
     return parser
 
 
-def main():
-    start_time = time.time()
+def get_size_cache(args, reader):
+    """Get the image size cache file from the arguments"""
+    if args.no_size_cache:
+        return None
+    return args.size_cache or reader.get_default_size_cache()
+
+
+def open_image_source(filename_pattern, args, parser, comm):
+    """Open the source slices given to --create-from, depending on their
+    type: a BBIC file, a dataset of an HDF5 file (file.h5:/dataset), a
+    .npy/.raw volume, a multi-page TIFF file, or a pattern or list of
+    images. Return the opened reader and its image provider."""
+    path, _, dataset_path = filename_pattern.partition('.h5:')
+    if dataset_path:
+        reader = bbic.H5VolumeStack(path + '.h5', dataset_path)
+        return reader, reader
 
+    extension = os.path.splitext(filename_pattern)[1]
+    if extension == '.h5':
+        reader = bbic.File(filename_pattern, 'r', comm)
+        return reader, reader.get_stack(0).get_level(0)
+    if extension in ['.npy', '.raw']:
+        if extension == '.raw' and args.raw_shape is None:
+            parser.error('--raw-shape is required for .raw sources')
+        width, height = args.raw_shape or (None, None)
+        reader = bbic.RawStack(filename_pattern, width, height, args.raw_offset)
+        return reader, reader
+
+    is_tiff = extension.lower() in ['.tif', '.tiff']
+    if is_tiff and '%' not in filename_pattern:
+        if args.follow:
+            parser.error('--follow requires a pattern of filenames')
+        reader = bbic.MultiPageTiffStack(filename_pattern)
+        return reader, reader
+
+    # Uncompressed TIFF slices are memory-mapped, others decoded by PIL
+    image_stack_class = bbic.TiffStack if is_tiff else bbic.ImageStack
+    if not args.follow:
+        reader = image_stack_class(filename_pattern)
+        reader.determine_stack_size(comm, args.probe_threads,
+                                    get_size_cache(args, reader))
+        return reader, reader
+
+    reader = image_stack_class(filename_pattern, follow=True)
+    reader.refresh(comm)
+    if args.stack_size:
+        reader.width, reader.height = args.stack_size
+    else:
+        # Take the stack size from the first slices
+        waited = 0.0
+        while reader.num_slices == 0:
+            if waited >= args.idle_timeout:
+                return reader, None
+            time.sleep(args.poll_interval)
+            waited += args.poll_interval
+            reader.refresh(comm)
+        reader.determine_stack_size(comm, args.probe_threads,
+                                    get_size_cache(args, reader))
+    return reader, reader
+
+
+def main():
     parser = create_parser()
     args = parser.parse_args()
+    if args.profile:
+        comm = MPI.COMM_WORLD if MPI_ENABLED else None
+        with bbic.Profiler(args.profile, comm, args.profile_memory):
+            run(parser, args)
+    else:
+        run(parser, args)
+
+
+def run(parser, args):
+    start_time = time.time()
 
-    # Append timestamp to filename
-    output_file = args.stack_filename[:-3]+'_'+str(start_time).replace('.','-')+'.h5'
+    codec_options = {}
+    if args.quality is not None:
+        codec_options['quality'] = args.quality
+    if args.subsampling is not None:
+        codec_options['subsampling'] = args.subsampling
+    try:
+        bbic.get_codec(args.format_, **codec_options)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.fused and (not args.all_stacks or args.follow or args.resume or args.from_):
+        parser.error('--fused requires --all-stacks, and cannot be used with '
+                     '--follow, --resume or --from')
+    if args.swmr and (args.fused or args.follow or MPI_ENABLED):
+        parser.error('--swmr cannot be used with --fused, --follow or MPI')
+    if args.follow and args.orientation.endswith('-reverse'):
+        # The reversed slice order depends on the final number of slices
+        parser.error('--follow cannot be used with a reverse orientation')
+
+    if args.resume:
+        # Reopen the file of the interrupted run as is
+        output_file = args.resume
+    else:
+        # Append timestamp to filename
+        output_file = args.stack_filename[:-3]+'_'+str(start_time).replace('.','-')+'.h5'
+
+    instrumentation = bbic.get_instrumentation()
+    instrumentation.enabled = args.timings is not None
 
     # Create writer
     if MPI_ENABLED:
@@ -90,6 +280,10 @@ def main():
         print("MPI disabled")
         comm = None
 
+    tracer = bbic.get_tracer()
+    if args.trace:
+        tracer.start(comm)
+
     reverse = False
     orientation = args.orientation
     if 'reverse' in orientation:
@@ -103,7 +297,8 @@ def main():
         stack_index = 1
 
     if args.source_files is None:
-        reader = bbic.File(output_file, 'a', comm)
+        # Read the given file as is, without timestamp
+        reader = bbic.File(args.stack_filename, 'r', comm)
         print(reader)
         stack = reader.get_stack(stack_index)
         if stack is None:
@@ -118,29 +313,50 @@ def main():
                 return
 
             print("Exporting to images: ", level)
-            level.extract_slices(args.to_image_dir, args.format_)
+            level.extract_slices(args.to_image_dir, args.format_, comm, args.processes)
         else:
             stack.print_structure()
 
     else:
         # Open source image stack
         filename_pattern = args.source_files
-        extension = os.path.splitext(filename_pattern)[1]
-        source_is_h5 = extension == ".h5"
-        if source_is_h5:
-            reader = bbic.File(filename_pattern, 'r', comm)
-            image_source = reader.get_stack(0).get_level(0)
-        else:
-            reader = bbic.ImageStack(filename_pattern)
-            reader.determine_stack_size(comm)
-            image_source = reader
+        reader, image_source = open_image_source(filename_pattern, args, parser, comm)
+        if image_source is None:
+            print('Error: no slice found for', filename_pattern)
+            return
+        source_is_h5 = isinstance(reader, bbic.File)
+
+        if args.plan:
+            if comm is None or comm.Get_rank() == 0:
+                print(bbic.WritePlan(image_source, args.tile_size,
+                                     bbic.get_codec(args.format_, **codec_options),
+                                     args.interp, args.padding_value,
+                                     args.plan_samples, args.all_stacks,
+                                     not args.no_lods, not args.no_dedup,
+                                     os.path.dirname(os.path.abspath(output_file))))
+            return
 
         # Write the target stack
-        writer = bbic.File(output_file, 'a', comm)
-        stack = writer.create_stack(stack_index)
+        writer = bbic.File(output_file, 'a', comm, swmr=args.swmr)
+        stack = writer.get_stack(stack_index) if args.resume else None
+        if stack is None:
+            stack = writer.create_stack(stack_index)
+        elif stack.get_dimensions()[:2] != image_source.get_dimensions()[:2] or \
+                (stack.num_slices != image_source.get_dimensions()[2] and
+                 not args.follow) or stack.tile_size != args.tile_size:
+            print('Error: the stack to resume does not match the source '
+                  'dimensions or tile size!')
+            return
+        elif stack.format != args.format_.upper() or stack.codec_options != codec_options:
+            # The tiles already written would be decoded with the new codec
+            print('Error: the stack to resume was written with format %s %s, '
+                  'not %s %s!' % (stack.format, stack.codec_options,
+                                  args.format_, codec_options))
+            return
         stack.width, stack.height, stack.num_slices = image_source.get_dimensions()
         stack.tile_size = args.tile_size
         stack.format = args.format_
+        stack.codec_options = codec_options
         stack.description = args.description
         stack.original_filenames = os.path.abspath(filename_pattern)
         stack.set_axis(args.mat)
@@ -150,20 +366,48 @@ def main():
         generate_lods = not args.no_lods
         assert isinstance(generate_lods, bool)
 
-        writer.write(image_source, stack, args.padding_value, args.interp,
-                     args.from_, 0, generate_lods, reverse)
+        dedup = not args.no_dedup
+        if args.fused:
+            writer.write_all_stacks(image_source, stack, args.padding_value,
+                                    args.interp, generate_lods, reverse, dedup,
+                                    args.scratch_dir)
+        elif args.follow:
+            writer.write_following(image_source, stack, args.padding_value,
+                                   args.interp, generate_lods, dedup,
+                                   args.resume is not None, args.poll_interval,
+                                   args.idle_timeout)
+        else:
+            writer.write(image_source, stack, args.padding_value, args.interp,
+                         args.from_, 0, generate_lods, reverse, dedup,
+                         args.resume is not None, swmr=args.swmr)
 
         # Optional: write additional x and y stacks
-        if args.all_stacks:
+        if args.all_stacks and not args.fused:
             if source_is_h5:
                 source_stack = reader.get_stack(stack_index)
             else:
                 writer.close_and_reopen('a')
                 source_stack = writer.get_stack(stack_index)
             writer.make_all_stacks(source_stack, args.padding_value,
-                                   args.interp, generate_lods)
+                                   args.interp, generate_lods, dedup,
+                                   args.scratch_dir, args.processes)
+
+    if instrumentation.enabled:
+        all_stats = instrumentation.gather(comm)
+        if all_stats is not None:
+            if args.timings == '-':
+                print(bbic.instrumentation.format_report(all_stats))
+            else:
+                bbic.instrumentation.export_json(all_stats, args.timings)
+
+    if tracer.enabled:
+        all_events = tracer.gather(comm)
+        if all_events is not None:
+            bbic.tracing.export_trace(all_events, args.trace)
 
     if not MPI_ENABLED or MPI.COMM_WORLD.Get_rank() == 0:
+        if instrumentation.enabled:
+            print(bbic.get_buffer_pool())
         print("--- Execution time: %s seconds ---" %
               round(time.time() - start_time))
 
@@ -28,14 +28,26 @@ def create_parser():
     parser.add_argument('--format', help='Output format for generated images, defaults to png', default='png')
     parser.add_argument('--axis', help='Axis along which to take slices, defaults to 0', choices=[0, 1, 2], default=0, type=int)
     parser.add_argument('--block-size', help='Block size, defaults to 64', dest='block_size', type=int, default=64)
+    parser.add_argument('--processes', help='Number of local processes exporting the slices of --to-images on each MPI process, defaults to 1', type=int, default=1)
+    parser.add_argument('--profile', help='Profile each MPI process and write the merged profile and a report to the given directory', metavar='DIR')
+    parser.add_argument('--profile-memory', help='Also trace the memory allocations with --profile', dest='profile_memory', action='store_true')
+    parser.add_argument('--verbose', help='Print the usage of the buffer pool at the end', action='store_true')
     return parser
 
 
 def main():
-    start_time = time.time()
-
     parser = create_parser()
     args = parser.parse_args()
+    if args.profile:
+        comm = MPI.COMM_WORLD if MPI_ENABLED else None
+        with bbic.Profiler(args.profile, comm, args.profile_memory):
+            run(parser, args)
+    else:
+        run(parser, args)
+
+
+def run(parser, args):
+    start_time = time.time()
 
     if MPI_ENABLED:
         comm = MPI.COMM_WORLD
@@ -81,9 +93,11 @@ def main():
                 return
 
             print("Exporting to images: ", level)
-            level.extract_slices(args.to_image_dir, args.format, args.axis)
+            level.extract_slices(args.to_image_dir, args.format, args.axis, comm, args.processes)
 
     if not MPI_ENABLED or MPI.COMM_WORLD.Get_rank() == 0:
+        if args.verbose:
+            print(bbic.get_buffer_pool())
         print("--- Execution time: %s seconds ---" % round(time.time() - start_time))
 
 if __name__ == '__main__':
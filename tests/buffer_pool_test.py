@@ -0,0 +1,45 @@
+# BBIC buffer pool tests
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'bbic_stack'))
+
+from bbic.buffer_pool import BufferPool, get_buffer_pool
+
+
+def test_reuse():
+    pool = BufferPool()
+    array = pool.acquire((10, 10), fill_value=3)
+    assert array.shape == (10, 10) and (array == 3).all()
+    pool.release(array)
+    assert pool.acquire((20, 20), np.uint16).base is array.base
+    assert pool.get_stats()['hits'] == 1
+
+
+def test_bounds():
+    pool = BufferPool(max_free_bytes=8192, max_pooled_bytes=4096)
+    large = pool.acquire((5000,))
+    small = [pool.acquire((100,)) for _ in range(3)]
+    pool.release(large)
+    for array in small:
+        pool.release(array)
+    stats = pool.get_stats()
+    assert stats['in_use_bytes'] == 0
+    assert stats['free_bytes'] == 8192
+    assert stats['allocated_bytes'] == 8192
+    pool.clear()
+    assert pool.get_stats()['allocated_bytes'] == 0
+
+
+def test_default_pool_is_bounded():
+    pool = get_buffer_pool()
+    assert pool.max_free_bytes is not None
+    assert pool.max_pooled_bytes is not None
@@ -0,0 +1,57 @@
+# BBIC image padding tests
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'bbic_stack'))
+
+from bbic.image_stack import ImageStack
+from bbic.image_utils import pad_array
+from bbic.memmap_stack import TiffStack
+
+# (width, height) of the slices, in a 90x70 stack
+SLICE_SIZES = [(90, 70), (61, 33), (100, 80), (101, 50), (40, 81)]
+
+
+def _write_slices(directory, extension):
+    """Write slices of various sizes, returning the filename pattern"""
+    rng = np.random.RandomState(0)
+    pattern = os.path.join(str(directory), 's_%03d.' + extension)
+    for index, (width, height) in enumerate(SLICE_SIZES):
+        data = rng.randint(0, 256, size=(height, width)).astype(np.uint8)
+        Image.fromarray(data).save(pattern % index)
+    return pattern
+
+
+def _check_stack(stack):
+    stack.width, stack.height = 90, 70
+    for index in range(len(SLICE_SIZES)):
+        with Image.open(stack.filenames[index]) as im:
+            expected = np.asarray(stack._expand_image(im.convert('L'), 90, 70, 7))
+        assert np.array_equal(stack.get_array(index, 7), expected)
+        assert np.array_equal(np.asarray(stack.get_image(index, 7)), expected)
+
+
+def test_image_stack_padding(tmpdir):
+    _check_stack(ImageStack(_write_slices(tmpdir, 'png')))
+
+
+def test_tiff_stack_padding(tmpdir):
+    _check_stack(TiffStack(_write_slices(tmpdir, 'tif')))
+
+
+def test_pad_array_crops_odd_sizes():
+    data = np.arange(7 * 5, dtype=np.uint8).reshape((7, 5))
+    for out_shape in [(4, 2), (7, 3), (9, 5), (3, 8)]:
+        out = pad_array(data, np.empty(out_shape, dtype=np.uint8), 255)
+        expected = ImageStack._expand_image(None, Image.fromarray(data), out_shape[1],
+                                            out_shape[0], 255)
+        assert np.array_equal(out, np.asarray(expected))
@@ -0,0 +1,123 @@
+# BBIC level array tests
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'bbic_stack'))
+
+import bbic
+
+TILE_SIZE = 32
+
+# Selections valid on all the levels
+SLICE_KEYS = [
+    np.s_[:],
+    np.s_[2],
+    np.s_[-1],
+    np.s_[1:4, 10:60, 5:85],
+    np.s_[::2, ::3, ::5],
+    np.s_[::-1, ::-7, ::-2],
+    np.s_[:, 15:17, 31:33],
+    np.s_[-3:, -40:-1, -90:],
+    np.s_[4, -1, -1],
+    np.s_[10:20],
+    np.s_[:, 100:, :],
+    np.s_[np.int64(3), np.int32(-5)],
+]
+
+# Selections of level 0 on tile borders
+LEVEL0_KEYS = [
+    np.s_[:, 31:33, 63:65],
+    np.s_[0, :, 33],
+    np.s_[:, 69],
+    np.s_[1, 64:, 64:],
+]
+
+
+@pytest.fixture(scope='module')
+def bbic_file(tmpdir_factory):
+    """A PNG stack of 5 slices of 90x70 pixels, with partial and uniform
+    tiles"""
+    directory = tmpdir_factory.mktemp('level_array')
+    rng = np.random.RandomState(0)
+    volume = rng.randint(0, 256, size=(5, 70, 90)).astype(np.uint8)
+    volume[:, :TILE_SIZE, :TILE_SIZE] = 7
+    np.save(str(directory.join('volume.npy')), volume)
+    source = bbic.RawStack(str(directory.join('volume.npy')))
+
+    bbic_file = bbic.File(str(directory.join('stack.h5')), 'w')
+    stack = bbic_file.create_stack(2)
+    stack.width, stack.height, stack.num_slices = source.get_dimensions()
+    stack.tile_size = TILE_SIZE
+    stack.format = 'PNG'
+    stack.write_attrs()
+    bbic_file.write(source, stack, 0, 'linear')
+    bbic_file.close_and_reopen('r')
+    return bbic_file
+
+
+def _get_images(level):
+    return np.stack([np.asarray(level.get_image(index)) for index in range(level.num_slices)])
+
+
+@pytest.mark.parametrize('level_index', [0, 1, 2])
+def test_level_array_matches_get_image(bbic_file, level_index):
+    level = bbic_file.get_stack(2).get_level(level_index)
+    array = level.as_array()
+    images = _get_images(level)
+    assert array.shape == images.shape
+    assert np.array_equal(np.asarray(array), images)
+    for key in SLICE_KEYS + (LEVEL0_KEYS if level_index == 0 else []):
+        assert np.array_equal(array[key], images[key]), key
+
+
+def test_level_array_bounds(bbic_file):
+    array = bbic_file.get_stack(2).get_level(0).as_array()
+    with pytest.raises(IndexError):
+        array[5]
+    with pytest.raises(IndexError):
+        array[-6]
+    with pytest.raises(IndexError):
+        array[0, 70]
+    with pytest.raises(IndexError):
+        array[0, 0, -91]
+    with pytest.raises(IndexError):
+        array[0, 0, 0, 0]
+    with pytest.raises(IndexError):
+        array[[0, 1]]
+    assert array[5:].shape == (0, 70, 90)
+
+
+class _ShortTileLevel:
+    """Level of 6x6 pixels in tiles of 4, whose last row and column of
+    tiles are stored one pixel short"""
+
+    index = 0
+    num_slices = 2
+    width = height = 6
+    tile_size = 4
+
+    def __init__(self):
+        self.pixels = np.arange(2 * 6 * 6, dtype=np.uint8).reshape((2, 6, 6))
+
+    def get_tile_array(self, u, v, slice_index):
+        y, x = v * 4, u * 4
+        return self.pixels[slice_index, y:min(y + 4, 5), x:min(x + 4, 5)]
+
+
+def test_level_array_pads_short_tiles():
+    level = _ShortTileLevel()
+    expected = level.pixels.copy()
+    expected[:, 5, :] = 9
+    expected[:, :, 5] = 9
+    array = bbic.LevelArray(level, padding_value=9)
+    for key in [np.s_[:], np.s_[:, ::-1, :], np.s_[::-1, ::-2, ::-3], np.s_[1, 5:3:-1]]:
+        assert np.array_equal(array[key], expected[key]), key
@@ -0,0 +1,82 @@
+# BBIC slice pyramid tests
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'bbic_stack'))
+
+from bbic.pyramid import Pyramid, downsample
+
+# (height, width) of the reduced images, odd sizes included
+SIZES = [(64, 64), (256, 128), (33, 47), (101, 3), (7, 7), (2, 3), (255, 129)]
+
+
+def _noise(height, width):
+    return np.random.RandomState(0).randint(0, 256, size=(height, width)).astype(np.uint8)
+
+
+def _smooth(height, width):
+    y, x = np.mgrid[0:height, 0:width]
+    return (128 + 100 * np.sin(x / 20.0) * np.cos(y / 15.0)).astype(np.uint8)
+
+
+def _pil_resize(data, filter_):
+    """Halve an image like File.write did before the pyramid"""
+    height, width = data.shape
+    return np.asarray(Image.fromarray(data).resize((width >> 1, height >> 1), filter_))
+
+
+def _downsample(data, interp):
+    height, width = data.shape
+    return downsample(data, np.empty((height >> 1, width >> 1), dtype=np.uint8), interp)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_nearest_matches_pil(size):
+    for data in [_noise(*size), _smooth(*size)]:
+        assert np.array_equal(_downsample(data, 'nearest'), _pil_resize(data, Image.NEAREST))
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_linear_is_rounded_box_average(size):
+    data = _noise(*size)
+    height, width = size[0] >> 1, size[1] >> 1
+    blocks = data[:2 * height, :2 * width].reshape((height, 2, width, 2)).astype(np.float64)
+    expected = np.floor(blocks.mean(axis=(1, 3)) + 0.5).astype(np.uint8)
+    assert np.array_equal(_downsample(data, 'linear'), expected)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_linear_close_to_pil_bilinear(size):
+    data = _smooth(*size)
+    difference = np.abs(_downsample(data, 'linear').astype(int) -
+                        _pil_resize(data, Image.BILINEAR).astype(int))
+    if size[0] % 2 == 0 and size[1] % 2 == 0:
+        # Same 2x2 footprint, PIL only weights its neighbours in
+        assert difference.max() <= 2
+        assert difference.mean() < 0.5
+    else:
+        # PIL stretches odd sizes by slightly more than 2
+        assert difference.max() <= 8
+        assert difference.mean() < 3
+
+
+def test_pyramid_cascades_downsample():
+    data = _noise(70, 90)
+    pyramid = Pyramid(90, 70, 4, 32, 'linear')
+    pyramid.build(data)
+    expected = data
+    for level in range(1, 4):
+        expected = _downsample(expected, 'linear')
+        assert np.array_equal(pyramid.get_level(level), expected)
+    assert pyramid.get_tile_count(1) == (2, 2)
+    assert pyramid.get_tile(1, 1, 1).shape == (3, 13)
@@ -0,0 +1,74 @@
+# BBIC tile cache tests
+# Author: Christian Tresch, Mateusz Paluchowski 2017
+#
+# Copyright (c) BBP/EPFL 2014-2015; All rights reserved.
+# Do not distribute without further notice.
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'bbic_stack'))
+
+from bbic.tile_cache import TileCache
+
+
+def _tile(value, size=10):
+    return np.full((size, size), value, dtype=np.uint8)
+
+
+def test_lru_eviction():
+    cache = TileCache(300)
+    for key in 'abc':
+        cache.put(key, _tile(ord(key)))
+    assert len(cache) == 3
+    # 'a' becomes the most recently used, 'b' is evicted first
+    assert cache.get('a')[0, 0] == ord('a')
+    cache.put('d', _tile(ord('d')))
+    assert cache.get('b') is None
+    assert [cache.get(key) is not None for key in 'acd'] == [True, True, True]
+    assert cache.num_evictions == 1
+
+
+def test_byte_accounting():
+    cache = TileCache(1000)
+    cache.put('a', _tile(1))
+    cache.put('b', _tile(2, 20))
+    assert cache.num_bytes == 500
+    # Replacing a tile does not count it twice
+    cache.put('a', _tile(3))
+    assert cache.num_bytes == 500
+    assert cache.get('a')[0, 0] == 3
+    cache.discard('b')
+    assert cache.num_bytes == 100
+    cache.discard('b')
+    assert cache.num_bytes == 100
+    # Tiles larger than the cache are returned but not kept
+    large = _tile(4, 40)
+    assert cache.put('c', large) is large
+    assert cache.get('c') is None
+    assert cache.num_bytes == 100
+    cache.clear()
+    assert len(cache) == 0 and cache.num_bytes == 0
+
+
+def test_cached_tiles_are_read_only():
+    cache = TileCache(1000)
+    tile = cache.put('a', _tile(1))
+    assert not tile.flags.writeable
+    assert not cache.get('a').flags.writeable
+
+
+def test_stats():
+    cache = TileCache(250)
+    assert cache.get('a') is None
+    cache.put('a', _tile(1))
+    cache.put('b', _tile(2))
+    cache.get('a')
+    cache.get('a')
+    cache.put('c', _tile(3))
+    assert cache.get_stats() == {'tiles': 2, 'bytes': 200, 'max_bytes': 250,
+                                 'hits': 2, 'misses': 3, 'evictions': 1}
+    assert str(cache) == "TileCache 2 tiles, 0.0 / 0.0 MB, hits: 2, misses: 3, evictions: 1"